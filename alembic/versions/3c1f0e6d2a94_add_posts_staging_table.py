@@ -0,0 +1,36 @@
+"""Add unlogged staging table for COPY-based post ingest
+
+Revision ID: 3c1f0e6d2a94
+Revises: 8bb687e76733
+Create Date: 2026-10-17 10:12:31.402518
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision: str = "3c1f0e6d2a94"
+down_revision: Union[str, None] = "8bb687e76733"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "posts_staging",
+        sa.Column("did", sa.String(length=255), nullable=False),
+        sa.Column("rkey", sa.String(length=100), nullable=False),
+        sa.Column("cid", sa.String(length=255), nullable=False),
+        sa.Column("post_text", sa.Text(), nullable=False),
+        sa.Column("language", postgresql.ARRAY(sa.String(length=8)), nullable=True),
+        prefixes=["UNLOGGED"],
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("posts_staging")
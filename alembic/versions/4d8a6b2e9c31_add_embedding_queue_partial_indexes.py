@@ -0,0 +1,53 @@
+"""Add partial indexes on the embedding queue, and fail exhausted tasks
+
+Revision ID: 4d8a6b2e9c31
+Revises: c7d2e4f8a915
+Create Date: 2026-10-18 10:14:52.760318
+
+Tasks claimed the maximum number of times were left in the queue before this revision. They
+are moved to `embedding_failures`, in the `lease` stage, such that they can be retried.
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "4d8a6b2e9c31"
+down_revision: Union[str, None] = "c7d2e4f8a915"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# `MAX_ATTEMPTS` in `bsky_topics.db.embedding_queue`
+MAX_ATTEMPTS = 5
+
+
+def upgrade() -> None:
+    op.execute(f"""
+        INSERT INTO embedding_failures (post_id, post_created_at, stage, error, message, failed_at)
+        SELECT post_id, post_created_at, 'lease', 'AttemptsExhausted',
+               'Claimed {MAX_ATTEMPTS} times without completing', now()
+        FROM embedding_queue
+        WHERE attempts >= {MAX_ATTEMPTS}
+        ON CONFLICT DO NOTHING
+    """)
+    op.execute(f"""
+        UPDATE posts SET exclude_for_embedding = TRUE
+        FROM embedding_queue q
+        WHERE posts.id = q.post_id AND posts.created_at = q.post_created_at AND q.attempts >= {MAX_ATTEMPTS}
+    """)
+    op.execute(f"DELETE FROM embedding_queue WHERE attempts >= {MAX_ATTEMPTS}")
+
+    op.create_index("embedding_queue_claimable_idx", "embedding_queue", ["post_id"], unique=False,
+                    postgresql_where=sa.text(f"attempts < {MAX_ATTEMPTS}"))
+    op.create_index("embedding_queue_exhausted_idx", "embedding_queue", ["leased_until"], unique=False,
+                    postgresql_where=sa.text(f"attempts >= {MAX_ATTEMPTS}"))
+
+
+def downgrade() -> None:
+    op.drop_index("embedding_queue_exhausted_idx", table_name="embedding_queue")
+    op.drop_index("embedding_queue_claimable_idx", table_name="embedding_queue")
@@ -0,0 +1,42 @@
+"""Add ingest checkpoint table
+
+Revision ID: 5e7b2d9c41f0
+Revises: 3c1f0e6d2a94
+Create Date: 2026-10-17 11:03:52.118734
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "5e7b2d9c41f0"
+down_revision: Union[str, None] = "3c1f0e6d2a94"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "ingest_checkpoints",
+        sa.Column("name", sa.String(length=100), nullable=False),
+        sa.Column("time_us", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("name"),
+    )
+
+    # Seed the checkpoint from the last indexed post, previously used to determine the cursor.
+    # Rewind two seconds because `indexed_at` is our insert time rather than the event time.
+    op.execute("""
+        INSERT INTO ingest_checkpoints (name, time_us, updated_at)
+        SELECT 'jetstream', (EXTRACT(EPOCH FROM MAX(indexed_at)) * 1000000)::bigint - 2000000, NOW()
+        FROM posts
+        HAVING MAX(indexed_at) IS NOT NULL
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table("ingest_checkpoints")
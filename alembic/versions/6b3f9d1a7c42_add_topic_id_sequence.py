@@ -0,0 +1,31 @@
+"""Add topic ID sequence
+
+Revision ID: 6b3f9d1a7c42
+Revises: 4d8a6b2e9c31
+Create Date: 2026-10-18 11:02:37.194660
+
+Topics replaced before this revision reused the IDs 0 to n - 1, the sequence starts after the
+highest existing topic ID.
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "6b3f9d1a7c42"
+down_revision: Union[str, None] = "4d8a6b2e9c31"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.execute(sa.schema.CreateSequence(sa.Sequence("topic_id_seq")))
+    op.execute("SELECT setval('topic_id_seq', (SELECT coalesce(max(id), 0) + 1 FROM topics), false)")
+
+
+def downgrade() -> None:
+    op.execute(sa.schema.DropSequence(sa.Sequence("topic_id_seq")))
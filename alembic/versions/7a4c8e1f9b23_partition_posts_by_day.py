@@ -0,0 +1,234 @@
+"""Partition posts and post_embeddings by day
+
+Revision ID: 7a4c8e1f9b23
+Revises: 5e7b2d9c41f0
+Create Date: 2026-10-17 13:21:07.552190
+
+Adds a `created_at` column derived from the record key (a TID), and moves existing rows into
+new tables partitioned by day on `created_at`. This rewrites both tables, and rebuilds the HNSW
+index per partition.
+
+"""
+
+from datetime import date, datetime, timedelta, UTC
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import pgvector
+
+
+# revision identifiers, used by Alembic.
+revision: str = "7a4c8e1f9b23"
+down_revision: Union[str, None] = "5e7b2d9c41f0"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+# Decodes the timestamp of a TID, same as `bsky_topics.jetstream.tid_to_time_us`
+TID_FUNCTION = """
+CREATE FUNCTION pg_temp.tid_time_us(tid text) RETURNS bigint AS $$
+DECLARE
+    value numeric := 0;
+    ix int;
+BEGIN
+    IF length(tid) <> 13 THEN
+        RETURN NULL;
+    END IF;
+
+    FOR i IN 1..13 LOOP
+        ix := strpos('234567abcdefghijklmnopqrstuvwxyz', substr(tid, i, 1)) - 1;
+        IF ix < 0 THEN
+            RETURN NULL;
+        END IF;
+
+        value := value * 32 + ix;
+    END LOOP;
+
+    RETURN floor(value / 1024)::bigint;
+END
+$$ LANGUAGE plpgsql IMMUTABLE
+"""
+
+# Same plausibility check as `bsky_topics.jetstream.post_created_at`, relative to `indexed_at`
+# because the event time of existing posts is unknown.
+CREATED_AT_EXPR = """
+CASE
+    WHEN to_timestamp(pg_temp.tid_time_us(rkey) / 1000000.0) AT TIME ZONE 'UTC'
+        BETWEEN indexed_at - interval '1 day' AND indexed_at + interval '10 minutes'
+    THEN to_timestamp(pg_temp.tid_time_us(rkey) / 1000000.0) AT TIME ZONE 'UTC'
+    ELSE indexed_at
+END
+"""
+
+
+def create_partitions(start: date, end: date):
+    """
+    Create daily partitions `<table>_pYYYYMMDD` for all days in `[start, end]`, and the default
+    partitions. Frozen copy of `bsky_topics.db.partitions` at this revision.
+    """
+
+    day = start
+    while day <= end:
+        for table in ["posts", "post_embeddings"]:
+            op.execute(
+                f"CREATE TABLE {table}_p{day:%Y%m%d} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+            )
+
+        day += timedelta(days=1)
+
+    for table in ["posts", "post_embeddings"]:
+        op.execute(f"CREATE TABLE {table}_default PARTITION OF {table} DEFAULT")
+
+
+def upgrade() -> None:
+    conn = op.get_bind()
+
+    # Move existing tables out of the way, including the names of their constraints and indexes
+    op.drop_index("post_embedding_idx", table_name="post_embeddings")
+    op.rename_table("post_embeddings", "post_embeddings_old")
+    op.execute("ALTER TABLE post_embeddings_old RENAME CONSTRAINT post_embeddings_pkey TO post_embeddings_old_pkey")
+    op.execute("ALTER SEQUENCE post_embeddings_id_seq OWNED BY NONE")
+
+    op.rename_table("posts", "posts_old")
+    op.execute("ALTER TABLE posts_old RENAME CONSTRAINT posts_pkey TO posts_old_pkey")
+    op.execute("ALTER TABLE posts_old RENAME CONSTRAINT did_record_key TO did_record_key_old")
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY NONE")
+
+    op.create_table(
+        "posts",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('posts_id_seq')"), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.Column("did", sa.String(length=255), nullable=False),
+        sa.Column("rkey", sa.String(length=100), nullable=False),
+        sa.Column("cid", sa.String(length=255), nullable=False),
+        sa.Column("indexed_at", sa.DateTime(), nullable=False),
+        sa.Column("post_text", sa.String(), nullable=False),
+        sa.Column("language", sa.ARRAY(sa.String(length=8)), nullable=True),
+        sa.Column("exclude_for_embedding", sa.Boolean(), nullable=True, server_default="FALSE"),
+        sa.PrimaryKeyConstraint("id", "created_at"),
+        sa.UniqueConstraint("did", "rkey", "created_at", name="did_record_key"),
+        postgresql_partition_by="RANGE (created_at)",
+    )
+
+    op.create_table(
+        "post_embeddings",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('post_embeddings_id_seq')"),
+                  nullable=False),
+        sa.Column("post_created_at", sa.DateTime(), nullable=False),
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("embedding", pgvector.sqlalchemy.vector.VECTOR(dim=384), nullable=False),
+        sa.PrimaryKeyConstraint("id", "post_created_at"),
+        sa.ForeignKeyConstraint(["post_id", "post_created_at"], ["posts.id", "posts.created_at"],
+                                name="post_embeddings_post_fkey"),
+        postgresql_partition_by="RANGE (post_created_at)",
+    )
+
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    op.execute("ALTER SEQUENCE post_embeddings_id_seq OWNED BY post_embeddings.id")
+
+    # Create partitions covering existing posts, and the upcoming week. The creation time of a
+    # post is at most one day before `indexed_at`.
+    today = datetime.now(UTC).date()
+    first_day = conn.execute(sa.text("SELECT MIN(indexed_at)::date - 1 FROM posts_old")).scalar() or today
+    create_partitions(min(first_day, today), today + timedelta(days=7))
+
+    op.execute(TID_FUNCTION)
+    op.execute(f"""
+        INSERT INTO posts (id, created_at, did, rkey, cid, indexed_at, post_text, language, exclude_for_embedding)
+        SELECT id, {CREATED_AT_EXPR}, did, rkey, cid, indexed_at, post_text, language, exclude_for_embedding
+        FROM posts_old
+        ON CONFLICT DO NOTHING
+    """)
+
+    op.execute("""
+        INSERT INTO post_embeddings (id, post_created_at, post_id, embedding)
+        SELECT e.id, p.created_at, e.post_id, e.embedding
+        FROM post_embeddings_old e
+        JOIN posts p ON p.id = e.post_id
+    """)
+
+    op.drop_table("post_embeddings_old")
+    op.drop_table("posts_old")
+
+    # Created on the partitioned table, this builds a separate index for each partition
+    op.create_index(
+        "post_embedding_idx",
+        "post_embeddings",
+        ["embedding"],
+        unique=False,
+        postgresql_using="hnsw",
+        postgresql_with={"m": 16, "ef_construction": 64},
+        postgresql_ops={"embedding": "vector_cosine_ops"},
+    )
+
+    op.add_column("posts_staging", sa.Column("created_at", sa.DateTime(), nullable=False))
+
+
+def downgrade() -> None:
+    op.drop_column("posts_staging", "created_at")
+
+    op.drop_index("post_embedding_idx", table_name="post_embeddings")
+    op.rename_table("post_embeddings", "post_embeddings_partitioned")
+    op.execute("ALTER TABLE post_embeddings_partitioned RENAME CONSTRAINT post_embeddings_pkey "
+               "TO post_embeddings_partitioned_pkey")
+    op.execute("ALTER SEQUENCE post_embeddings_id_seq OWNED BY NONE")
+
+    op.rename_table("posts", "posts_partitioned")
+    op.execute("ALTER TABLE posts_partitioned RENAME CONSTRAINT posts_pkey TO posts_partitioned_pkey")
+    op.execute("ALTER TABLE posts_partitioned RENAME CONSTRAINT did_record_key TO did_record_key_partitioned")
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY NONE")
+
+    op.create_table(
+        "posts",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('posts_id_seq')"), nullable=False),
+        sa.Column("did", sa.String(length=255), nullable=False),
+        sa.Column("rkey", sa.String(length=100), nullable=False),
+        sa.Column("cid", sa.String(length=255), nullable=False),
+        sa.Column("indexed_at", sa.DateTime(), nullable=False),
+        sa.Column("post_text", sa.String(), nullable=False),
+        sa.Column("language", sa.ARRAY(sa.String(length=8)), nullable=True),
+        sa.Column("exclude_for_embedding", sa.Boolean(), nullable=True, server_default="FALSE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("did", "rkey", name="did_record_key"),
+    )
+
+    op.create_table(
+        "post_embeddings",
+        sa.Column("id", sa.Integer(), server_default=sa.text("nextval('post_embeddings_id_seq')"),
+                  nullable=False),
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("embedding", pgvector.sqlalchemy.vector.VECTOR(dim=384), nullable=False),
+        sa.ForeignKeyConstraint(["post_id"], ["posts.id"]),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    op.execute("ALTER SEQUENCE posts_id_seq OWNED BY posts.id")
+    op.execute("ALTER SEQUENCE post_embeddings_id_seq OWNED BY post_embeddings.id")
+
+    op.execute("""
+        INSERT INTO posts (id, did, rkey, cid, indexed_at, post_text, language, exclude_for_embedding)
+        SELECT id, did, rkey, cid, indexed_at, post_text, language, exclude_for_embedding
+        FROM posts_partitioned
+        ON CONFLICT DO NOTHING
+    """)
+
+    op.execute("""
+        INSERT INTO post_embeddings (id, post_id, embedding)
+        SELECT id, post_id, embedding
+        FROM post_embeddings_partitioned
+    """)
+
+    op.drop_table("post_embeddings_partitioned")
+    op.drop_table("posts_partitioned")
+
+    op.create_index(
+        "post_embedding_idx",
+        "post_embeddings",
+        ["embedding"],
+        unique=False,
+        postgresql_using="hnsw",
+        postgresql_with={"m": 16, "ef_construction": 64},
+        postgresql_ops={"embedding": "vector_cosine_ops"},
+    )
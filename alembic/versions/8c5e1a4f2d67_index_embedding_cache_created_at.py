@@ -0,0 +1,26 @@
+"""Index embedding cache by creation time
+
+Revision ID: 8c5e1a4f2d67
+Revises: 6b3f9d1a7c42
+Create Date: 2026-10-18 14:26:09.513842
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "8c5e1a4f2d67"
+down_revision: Union[str, None] = "6b3f9d1a7c42"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index(op.f("ix_embedding_cache_created_at"), "embedding_cache", ["created_at"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_embedding_cache_created_at"), table_name="embedding_cache")
@@ -0,0 +1,48 @@
+"""Add embedding failures table
+
+Revision ID: a3e9c1f5b072
+Revises: f1c7a2d94e86
+Create Date: 2026-10-17 21:37:14.920563
+
+Posts excluded for embedding before this revision are recorded with an unknown failure, such
+that they can be retried as well.
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "a3e9c1f5b072"
+down_revision: Union[str, None] = "f1c7a2d94e86"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "embedding_failures",
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("post_created_at", sa.DateTime(), nullable=False),
+        sa.Column("stage", sa.String(length=20), nullable=False),
+        sa.Column("error", sa.String(length=100), nullable=False),
+        sa.Column("message", sa.Text(), nullable=False),
+        sa.Column("failed_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("post_id", "post_created_at"),
+    )
+    op.create_index(op.f("ix_embedding_failures_error"), "embedding_failures", ["error"], unique=False)
+
+    op.execute("""
+        INSERT INTO embedding_failures (post_id, post_created_at, stage, error, message, failed_at)
+        SELECT id, created_at, 'unknown', 'unknown', '', now()
+        FROM posts
+        WHERE exclude_for_embedding
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_embedding_failures_error"), table_name="embedding_failures")
+    op.drop_table("embedding_failures")
@@ -0,0 +1,35 @@
+"""Add post deletions table
+
+Revision ID: b41d6f2e8c57
+Revises: 7a4c8e1f9b23
+Create Date: 2026-10-17 15:42:18.306512
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "b41d6f2e8c57"
+down_revision: Union[str, None] = "7a4c8e1f9b23"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "post_deletions",
+        sa.Column("did", sa.String(length=255), nullable=False),
+        sa.Column("rkey", sa.String(length=100), nullable=False),
+        sa.Column("time_us", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("did", "rkey"),
+    )
+    op.create_index(op.f("ix_post_deletions_time_us"), "post_deletions", ["time_us"], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f("ix_post_deletions_time_us"), table_name="post_deletions")
+    op.drop_table("post_deletions")
@@ -0,0 +1,44 @@
+"""Add topics table, and topic assignment of post embeddings
+
+Revision ID: c7d2e4f8a915
+Revises: a3e9c1f5b072
+Create Date: 2026-10-17 23:12:40.581226
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import pgvector
+
+
+# revision identifiers, used by Alembic.
+revision: str = "c7d2e4f8a915"
+down_revision: Union[str, None] = "a3e9c1f5b072"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "topics",
+        sa.Column("id", sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column("centroid", pgvector.sqlalchemy.vector.VECTOR(dim=384), nullable=False),
+        sa.Column("keywords", sa.ARRAY(sa.Text()), nullable=False),
+        sa.Column("num_posts", sa.BigInteger(), nullable=False),
+        sa.Column("updated_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    op.add_column("post_embeddings", sa.Column("topic_id", sa.Integer(), nullable=True))
+    op.add_column("post_embeddings", sa.Column("topic_distance", sa.REAL(), nullable=True))
+    op.create_index("post_embedding_topic_idx", "post_embeddings", ["topic_id", sa.text("post_created_at DESC")],
+                    unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index("post_embedding_topic_idx", table_name="post_embeddings")
+    op.drop_column("post_embeddings", "topic_distance")
+    op.drop_column("post_embeddings", "topic_id")
+    op.drop_table("topics")
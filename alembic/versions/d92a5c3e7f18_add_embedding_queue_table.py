@@ -0,0 +1,49 @@
+"""Add embedding queue table
+
+Revision ID: d92a5c3e7f18
+Revises: b41d6f2e8c57
+Create Date: 2026-10-17 17:08:44.920371
+
+Enqueues all existing posts without an embedding, except those excluded from embedding.
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = "d92a5c3e7f18"
+down_revision: Union[str, None] = "b41d6f2e8c57"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "embedding_queue",
+        sa.Column("post_id", sa.Integer(), nullable=False),
+        sa.Column("post_created_at", sa.DateTime(), nullable=False),
+        sa.Column("enqueued_at", sa.DateTime(), nullable=False),
+        sa.Column("claim_id", sa.Uuid(), nullable=True),
+        sa.Column("leased_until", sa.DateTime(), nullable=True),
+        sa.Column("attempts", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("post_id", "post_created_at"),
+    )
+
+    op.execute("""
+        INSERT INTO embedding_queue (post_id, post_created_at, enqueued_at, attempts)
+        SELECT p.id, p.created_at, NOW(), 0
+        FROM posts p
+        WHERE p.exclude_for_embedding IS NOT TRUE
+          AND NOT EXISTS (
+            SELECT 1 FROM post_embeddings e
+            WHERE e.post_id = p.id AND e.post_created_at = p.created_at
+          )
+    """)
+
+
+def downgrade() -> None:
+    op.drop_table("embedding_queue")
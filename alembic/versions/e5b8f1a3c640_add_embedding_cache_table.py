@@ -0,0 +1,34 @@
+"""Add embedding cache table
+
+Revision ID: e5b8f1a3c640
+Revises: d92a5c3e7f18
+Create Date: 2026-10-17 19:26:03.117842
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+import pgvector
+
+
+# revision identifiers, used by Alembic.
+revision: str = "e5b8f1a3c640"
+down_revision: Union[str, None] = "d92a5c3e7f18"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "embedding_cache",
+        sa.Column("text_hash", sa.LargeBinary(length=16), nullable=False),
+        sa.Column("embedding", pgvector.sqlalchemy.vector.VECTOR(dim=384), nullable=False),
+        sa.Column("created_at", sa.DateTime(), nullable=False),
+        sa.PrimaryKeyConstraint("text_hash"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("embedding_cache")
@@ -0,0 +1,51 @@
+"""Store post embeddings as halfvec
+
+Revision ID: f1c7a2d94e86
+Revises: e5b8f1a3c640
+Create Date: 2026-10-17 20:42:51.308114
+
+Converts `post_embeddings.embedding` from `vector(384)` to `halfvec(384)`, which roughly halves
+the size of the table and of the HNSW index. Postgres rewrites each partition with the converted
+column, such that the old full precision rows don't remain as dead tuples, and no VACUUM is
+needed afterwards. The partitions are locked until the migration completes, so stop embed workers
+and searches while upgrading. Requires pgvector 0.7 or newer.
+
+"""
+
+from typing import Sequence, Union
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision: str = "f1c7a2d94e86"
+down_revision: Union[str, None] = "e5b8f1a3c640"
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def convert_embeddings(column_type: str, opclass: str):
+    """Convert the embedding column to `column_type`, and rebuild the HNSW index with `opclass`."""
+
+    # The index can't be converted, and rebuilding it once afterwards is faster than during the rewrite
+    op.drop_index("post_embedding_idx", table_name="post_embeddings")
+
+    # Changing the column type rewrites the table, unlike adding a column and updating it
+    op.execute(f"""
+        ALTER TABLE post_embeddings ALTER COLUMN embedding TYPE {column_type} USING embedding::{column_type}
+    """)
+
+    op.execute(f"""
+        CREATE INDEX post_embedding_idx ON post_embeddings
+        USING hnsw (embedding {opclass}) WITH (m = 16, ef_construction = 64)
+    """)
+
+
+def upgrade() -> None:
+    convert_embeddings("halfvec(384)", "halfvec_cosine_ops")
+
+
+def downgrade() -> None:
+    op.execute("DROP INDEX IF EXISTS post_embedding_binary_idx")
+
+    convert_embeddings("vector(384)", "vector_cosine_ops")
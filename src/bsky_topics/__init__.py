@@ -1,5 +1,5 @@
 from bsky_topics.commands import cli_main as main
-from bsky_topics.commands import collect, db, embed  # noqa
+from bsky_topics.commands import bench, collect, db, embed, replay, snapshot, topics  # noqa
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,568 @@
+"""
+`bsky_topics.benchmarks` - Reproducible benchmarks for the ingest, embedding and clustering pipelines
+"""
+
+from __future__ import annotations
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, UTC
+import math
+from pathlib import Path
+import random
+import resource
+import string
+import sys
+import time
+from typing import Callable
+import uuid
+
+import numpy
+from numpy.lib.format import open_memmap
+import orjson
+from sqlalchemy import delete, select
+import zstandard
+
+from bsky_topics.db import async_session
+from bsky_topics.db.schema import Post, PostEmbedding, EmbeddingTask
+from bsky_topics.db.search import similar_posts
+from bsky_topics.db.writers import PostWriter, CopyPostWriter, EmbeddingWriter
+from bsky_topics.embeddings import PostEmbedder, mean_pool
+from bsky_topics.jetstream import MAX_MESSAGE_SIZE
+from bsky_topics.segments import read_frames
+
+WORDS = {
+    'en': [
+        "the", "a", "is", "to", "and", "of", "in", "it", "you", "that", "this", "for", "on", "with",
+        "bluesky", "post", "today", "good", "morning", "new", "just", "love", "people", "think", "time",
+        "really", "great", "world", "news", "art", "music", "game", "science", "feed", "thread",
+    ],
+    'ja': [
+        "今日", "は", "いい", "天気", "です", "ね", "新しい", "世界", "音楽", "ゲーム", "ありがとう", "本当に",
+        "みんな", "時間", "朝", "が", "を", "に", "の", "も", "絵", "描きました", "ニュース", "楽しい",
+    ],
+    'pt': [
+        "o", "a", "de", "que", "e", "do", "da", "em", "um", "para", "hoje", "bom", "dia", "novo", "mundo",
+        "tempo", "muito", "gente", "música", "jogo", "arte", "notícias", "amor", "obrigado",
+    ],
+    'de': [
+        "der", "die", "das", "und", "ist", "nicht", "ich", "ein", "zu", "mit", "heute", "gut", "Morgen",
+        "neue", "Welt", "Zeit", "wirklich", "Leute", "Musik", "Spiel", "Kunst", "Nachrichten",
+    ],
+    'es': [
+        "el", "la", "de", "que", "y", "en", "un", "es", "por", "hoy", "buenos", "días", "nuevo", "mundo",
+        "tiempo", "gente", "música", "juego", "muy", "gracias", "arte", "noticias",
+    ],
+}
+
+# Approximate share of each language among posts
+LANGUAGES = {'en': 0.55, 'ja': 0.2, 'pt': 0.1, 'de': 0.08, 'es': 0.07}
+
+# Posts are at most 300 characters, and most are short: the median is roughly 60 characters
+MAX_POST_LENGTH = 300
+MEDIAN_POST_LENGTH = 60
+
+EMOJI = ["😂", "❤️", "🥰", "✨", "🎉", "👀", "🙏", "🔥"]
+
+
+def synthetic_text(rng: random.Random, language: str) -> str:
+    """
+    Generate post text in `language` with a realistic length distribution, consisting of one or
+    more sentences, and occasionally a mention, hashtag, emoji or link.
+    """
+
+    length = min(max(int(rng.lognormvariate(math.log(MEDIAN_POST_LENGTH), 0.9)), 3), MAX_POST_LENGTH)
+    separator = "" if language == 'ja' else " "
+
+    sentences = []
+    num_chars = 0
+    while num_chars < length:
+        sentence = separator.join(rng.choices(WORDS[language], k=rng.randint(3, 15)))
+        if language == 'ja':
+            sentence += rng.choice(["。", "！", "？"])
+        else:
+            sentence = sentence[0].upper() + sentence[1:] + rng.choice([".", ".", ".", "!", "?"])
+
+        sentences.append(sentence)
+        num_chars += len(sentence) + 1
+
+    text = separator.join(sentences)[:length].rstrip()
+
+    if rng.random() < 0.05:
+        text = f"@user{rng.randint(1, 1000)}.bsky.social {text}"
+    if rng.random() < 0.08:
+        text += f" #{rng.choice(WORDS['en'])}"
+    if rng.random() < 0.15:
+        text += " " + rng.choice(EMOJI)
+    if rng.random() < 0.1:
+        text += f" https://example.com/{rng.getrandbits(32):08x}"
+
+    return text[:MAX_POST_LENGTH]
+
+
+def synthetic_posts(num_posts: int, seed: int = 42) -> list[dict]:
+    """
+    Generate posts in the same format as produced by the Jetstream collector, with realistic
+    length and language distributions. The same seed gives the same texts.
+
+    Each call uses fresh DIDs, so generated posts never conflict with existing rows.
+    """
+
+    rng = random.Random(seed)
+    run_id = uuid.uuid4().hex[:12]
+    now = datetime.now(UTC).replace(tzinfo=None)
+
+    posts = []
+    for i in range(num_posts):
+        language = rng.choices(list(LANGUAGES), weights=list(LANGUAGES.values()))[0]
+
+        posts.append({
+            'did': f"did:plc:bench{run_id}{i % 1000:04d}",
+            'rkey': f"{i:013d}",
+            'cid': ''.join(rng.choices(string.ascii_lowercase + string.digits, k=59)),
+            'post_text': synthetic_text(rng, language),
+            'language': [language],
+            'created_at': now - timedelta(seconds=rng.random() * 3600),
+        })
+
+    return posts
+
+
+def recorded_post_texts(directory: str | Path, num_posts: int, zstd_dictionary: bytes | None = None) -> list[str]:
+    """
+    Load the text of the first `num_posts` new posts in Jetstream traffic recorded with
+    `collect --record`. Recordings of compressed traffic require the zstd dictionary.
+    """
+
+    decompressor = None
+    if zstd_dictionary:
+        decompressor = zstandard.ZstdDecompressor(dict_data=zstandard.ZstdCompressionDict(zstd_dictionary))
+
+    texts = []
+    for _, frame in read_frames(directory):
+        if decompressor:
+            frame = decompressor.decompress(frame, max_output_size=MAX_MESSAGE_SIZE)
+
+        commit = orjson.loads(frame).get('commit') or {}
+        if commit.get('operation') != "create" or commit.get('collection') != "app.bsky.feed.post":
+            continue
+
+        text = (commit.get('record') or {}).get('text')
+        if text:
+            texts.append(text)
+
+        if len(texts) >= num_posts:
+            break
+
+    return texts
+
+
+@dataclass
+class IngestBenchmarkResult:
+    write_mode: str
+    batch_size: int
+    num_rows: int
+    num_inserted: int
+    elapsed: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.num_rows / self.elapsed if self.elapsed else 0.0
+
+
+async def benchmark_post_writer(write_mode: str, writer: PostWriter, posts: list[dict],
+                                batch_size: int) -> IngestBenchmarkResult:
+    """
+    Write `posts` in batches of `batch_size` with the given writer, committing each batch.
+
+    Inserted posts are deleted again afterwards.
+    """
+
+    inserted = []
+    start = time.perf_counter()
+    for i in range(0, len(posts), batch_size):
+        async with async_session() as session:
+            inserted.extend(await writer.write(session, posts[i:i+batch_size]))
+            await session.commit()
+
+    elapsed = time.perf_counter() - start
+
+    # Restrict to the partitions of the generated posts
+    await delete_posts(inserted, min(post['created_at'] for post in posts))
+
+    return IngestBenchmarkResult(write_mode, batch_size, len(posts), len(inserted), elapsed)
+
+
+async def insert_synthetic_posts(num_posts: int) -> list[tuple[int, datetime]]:
+    """Insert synthetic posts, and return their (id, created_at) tuples."""
+
+    posts = synthetic_posts(num_posts)
+    created_at = {(post['did'], post['rkey']): post['created_at'] for post in posts}
+
+    async with async_session() as session:
+        ids = await CopyPostWriter().write(session, posts)
+        await session.commit()
+
+        result = await session.execute(
+            select(Post.id, Post.did, Post.rkey)
+            .where(Post.id.in_(ids), Post.created_at >= min(created_at.values()))
+        )
+
+        return [(post_id, created_at[did, rkey]) for post_id, did, rkey in result]
+
+
+async def delete_posts(post_ids: list[int], min_created_at: datetime):
+    """Delete posts created at or after `min_created_at`, with their embeddings and queue entries."""
+
+    async with async_session() as session:
+        for i in range(0, len(post_ids), 10_000):
+            chunk = post_ids[i:i+10_000]
+
+            await session.execute(
+                delete(PostEmbedding)
+                .where(PostEmbedding.post_id.in_(chunk), PostEmbedding.post_created_at >= min_created_at)
+            )
+            await session.execute(
+                delete(Post).where(Post.id.in_(chunk), Post.created_at >= min_created_at)
+            )
+            await session.execute(
+                delete(EmbeddingTask).where(EmbeddingTask.post_id.in_(chunk))
+            )
+
+        await session.commit()
+
+
+@dataclass
+class EmbeddingWriteBenchmarkResult:
+    write_mode: str
+    chunk_size: int
+    num_rows: int
+    elapsed: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.num_rows / self.elapsed if self.elapsed else 0.0
+
+
+async def benchmark_embedding_writer(write_mode: str, writer: EmbeddingWriter, posts: list[tuple[int, datetime]],
+                                     embeddings: numpy.ndarray, chunk_size: int) -> EmbeddingWriteBenchmarkResult:
+    """
+    Write embeddings of `posts` in chunks of `chunk_size` with the given writer, committing each
+    chunk.
+
+    Written embeddings are deleted again afterwards.
+    """
+
+    start = time.perf_counter()
+    for i in range(0, len(posts), chunk_size):
+        async with async_session() as session:
+            await writer.write(session, posts[i:i+chunk_size], embeddings[i:i+chunk_size])
+            await session.commit()
+
+    elapsed = time.perf_counter() - start
+
+    min_created_at = min(created_at for _, created_at in posts)
+    async with async_session() as session:
+        await session.execute(
+            delete(PostEmbedding)
+            .where(PostEmbedding.post_id.in_([post_id for post_id, _ in posts]),
+                   PostEmbedding.post_created_at >= min_created_at)
+        )
+        await session.commit()
+
+    return EmbeddingWriteBenchmarkResult(write_mode, chunk_size, len(posts), elapsed)
+
+
+async def recent_post_texts(num_posts: int) -> list[str]:
+    """Load the text of the most recent posts in the database."""
+
+    async with async_session() as session:
+        result = await session.execute(select(Post.post_text).order_by(Post.id.desc()).limit(num_posts))
+
+        return list(result.scalars())
+
+
+def loop_mean_pool(sentence_embeddings: numpy.ndarray, slices: list[slice]) -> numpy.ndarray:
+    """Reference implementation of `mean_pool`: a Python loop over posts, with float64 output."""
+
+    post_embeddings = numpy.zeros((len(slices), sentence_embeddings.shape[1]))
+    for i, post_slice in enumerate(slices):
+        post_embeddings[i] = sentence_embeddings[post_slice].mean(axis=0)
+
+    return post_embeddings
+
+
+@dataclass
+class EmbedBenchmarkResult:
+    name: str
+    num_posts: int
+    num_segmented: int
+    elapsed: float
+
+    # Cosine similarity of each post embedding with the reference embedding
+    similarities: numpy.ndarray
+
+    @property
+    def posts_per_sec(self) -> float:
+        return self.num_posts / self.elapsed if self.elapsed else 0.0
+
+
+def benchmark_embedder(name: str, embedder: PostEmbedder, posts: list[str], batch_size: int,
+                       pool: Callable[[numpy.ndarray, list[slice]], numpy.ndarray] = mean_pool,
+                       reference: numpy.ndarray | None = None) -> tuple[EmbedBenchmarkResult, numpy.ndarray]:
+    """
+    Embed `posts` in batches of `batch_size` with the current settings of `embedder`, pooling
+    sentence embeddings with `pool`.
+
+    Returns the benchmark result and the computed embeddings. Embeddings are compared with
+    the `reference` embeddings, if given, to measure drift.
+    """
+
+    batches = []
+    start = time.perf_counter()
+    for i in range(0, len(posts), batch_size):
+        segmented = embedder.segment(posts[i:i+batch_size])
+        sentence_embeddings = embedder.encode_sentences(segmented.sentences)
+        batches.append(pool(sentence_embeddings, segmented.slices))
+
+    elapsed = time.perf_counter() - start
+    embeddings = numpy.concatenate(batches)
+
+    if reference is not None:
+        norms = numpy.linalg.norm(embeddings, axis=1) * numpy.linalg.norm(reference, axis=1)
+        similarities = (embeddings * reference).sum(axis=1) / numpy.maximum(norms, 1e-12)
+    else:
+        similarities = numpy.ones(len(posts))
+
+    if embedder.short_post_length is None:
+        num_segmented = len(posts)
+    else:
+        num_segmented = sum(1 for post in posts if len(post) > embedder.short_post_length)
+
+    return EmbedBenchmarkResult(name, len(posts), num_segmented, elapsed, similarities), embeddings
+
+
+async def recent_embeddings(num_posts: int) -> numpy.ndarray:
+    """Load the embeddings of the most recently embedded posts, e.g., to use as search queries."""
+
+    async with async_session() as session:
+        result = await session.execute(
+            select(PostEmbedding.embedding).order_by(PostEmbedding.id.desc()).limit(num_posts)
+        )
+
+        return numpy.array(list(result.scalars()))
+
+
+@dataclass
+class SearchBenchmarkResult:
+    name: str
+    latencies: numpy.ndarray
+
+    # Fraction of the reference results found by each query
+    recalls: numpy.ndarray
+
+
+async def benchmark_search(name: str, queries: numpy.ndarray, limit: int, rerank: int | None = None,
+                           reference: list[set[int]] | None = None) -> tuple[SearchBenchmarkResult, list[set[int]]]:
+    """
+    Run a similarity search for each query, see `bsky_topics.db.search.similar_posts`.
+
+    Returns the benchmark result and the found post IDs of each query. Results are compared
+    with the `reference` results, if given, to measure recall.
+    """
+
+    latencies = []
+    found = []
+    for query in queries:
+        async with async_session() as session:
+            start = time.perf_counter()
+            posts = await similar_posts(session, query, limit, rerank)
+            latencies.append(time.perf_counter() - start)
+
+        found.append({post.post_id for post in posts})
+
+    if reference is not None:
+        recalls = numpy.array([len(f & r) / max(len(r), 1) for f, r in zip(found, reference)])
+    else:
+        recalls = numpy.ones(len(queries))
+
+    return SearchBenchmarkResult(name, numpy.array(latencies), recalls), found
+
+
+def peak_rss() -> int:
+    """Peak resident set size of this process, in bytes."""
+
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # Reported in bytes on macOS, and in kilobytes on Linux
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+@dataclass
+class StageBenchmarkResult:
+    """Batch latencies of a stage of the embed pipeline, and the peak RSS of the process after the stage."""
+
+    stage: str
+    num_posts: int = 0
+    num_sentences: int = 0
+    peak_rss: int = 0
+
+    latencies: list[float] = field(default_factory=list)
+
+    @property
+    def elapsed(self) -> float:
+        return sum(self.latencies)
+
+    @property
+    def posts_per_sec(self) -> float:
+        return self.num_posts / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def sentences_per_sec(self) -> float:
+        return self.num_sentences / self.elapsed if self.elapsed else 0.0
+
+    def latency_percentile(self, q: float) -> float:
+        return float(numpy.percentile(self.latencies, q)) if self.latencies else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            'num_posts': self.num_posts,
+            'num_sentences': self.num_sentences,
+            'num_batches': len(self.latencies),
+            'elapsed': self.elapsed,
+            'posts_per_sec': self.posts_per_sec,
+            'sentences_per_sec': self.sentences_per_sec,
+            'p50_batch_latency': self.latency_percentile(50),
+            'p99_batch_latency': self.latency_percentile(99),
+            'peak_rss': self.peak_rss,
+        }
+
+
+async def benchmark_embed_stages(embedder: PostEmbedder, posts: list[str], batch_size: int,
+                                 writer: EmbeddingWriter | None = None,
+                                 targets: list[tuple[int, datetime]] | None = None,
+                                 warmup_batches: int = 1) -> dict[str, StageBenchmarkResult]:
+    """
+    Run each stage of the embed pipeline on batches of `posts` in turn: sentence segmentation,
+    encoding, pooling and, if a `writer` is given, writing the embeddings, one transaction per
+    batch.
+
+    Embeddings are written for the `targets` posts, given as (id, created_at) tuples, which
+    should be at least `batch_size` existing posts. The first `warmup_batches` are not measured.
+    """
+
+    stages = ['segment', 'encode', 'pool'] + (['write'] if writer else [])
+    results = {stage: StageBenchmarkResult(stage) for stage in stages}
+
+    for i, batch_start in enumerate(range(0, len(posts), batch_size)):
+        batch = posts[batch_start:batch_start+batch_size]
+        measure = i >= warmup_batches
+
+        start = time.perf_counter()
+        segmented = embedder.segment(batch)
+        segmented_at = time.perf_counter()
+        sentence_embeddings = embedder.encode_sentences(segmented.sentences)
+        encoded_at = time.perf_counter()
+        embeddings = mean_pool(sentence_embeddings, segmented.slices)
+        pooled_at = time.perf_counter()
+
+        if not measure:
+            continue
+
+        for stage, elapsed in [('segment', segmented_at - start), ('encode', encoded_at - segmented_at),
+                               ('pool', pooled_at - encoded_at)]:
+            results[stage].latencies.append(elapsed)
+            results[stage].num_posts += len(batch)
+            results[stage].num_sentences += len(segmented.sentences)
+            results[stage].peak_rss = peak_rss()
+
+        if writer:
+            start = time.perf_counter()
+            async with async_session() as session:
+                await writer.write(session, targets[:len(batch)], embeddings)
+                await session.commit()
+
+            results['write'].latencies.append(time.perf_counter() - start)
+            results['write'].num_posts += len(batch)
+            results['write'].num_sentences += len(segmented.sentences)
+            results['write'].peak_rss = peak_rss()
+
+    return results
+
+
+def synthetic_embeddings(path: str | Path, num_rows: int, dim: int = 384, num_topics: int = 1000,
+                         noise: float = 0.5, seed: int = 42) -> numpy.ndarray:
+    """
+    Write normalized embeddings scattered around `num_topics` random directions to a `.npy` file,
+    and return it memory-mapped. Generated in chunks, such that it can be larger than memory.
+    """
+
+    rng = numpy.random.default_rng(seed)
+    topics = rng.standard_normal((num_topics, dim), dtype=numpy.float32)
+    topics /= numpy.linalg.norm(topics, axis=1, keepdims=True)
+
+    embeddings = open_memmap(path, mode='w+', dtype=numpy.float32, shape=(num_rows, dim))
+    for start in range(0, num_rows, 100_000):
+        size = min(100_000, num_rows - start)
+        chunk = topics[rng.integers(num_topics, size=size)]
+        chunk += noise / math.sqrt(dim) * rng.standard_normal((size, dim), dtype=numpy.float32)
+        embeddings[start:start+size] = chunk / numpy.linalg.norm(chunk, axis=1, keepdims=True)
+
+    embeddings.flush()
+
+    return embeddings
+
+
+@dataclass
+class KMeansBenchmarkResult:
+    engine: str
+    num_rows: int
+    n_clusters: int
+    elapsed: float
+    peak_rss: int
+
+    # Mean cosine distance of a fixed sample of rows to their nearest centroid
+    mean_distance: float
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.num_rows / self.elapsed if self.elapsed else 0.0
+
+
+def benchmark_kmeans(engine: str, embeddings: numpy.ndarray, n_clusters: int, batch_size: int,
+                     epochs: int = 1, num_threads: int | None = None,
+                     sample_size: int = 100_000) -> KMeansBenchmarkResult:
+    """
+    Fit `n_clusters` centroids on `embeddings` using `PostClusters` with the given k-means
+    engine, and measure the time to fit, including initialization.
+
+    Centroids are evaluated by the mean cosine distance of a fixed sample of rows to their
+    nearest centroid, lower is better.
+    """
+
+    import torch
+    from bsky_topics.topics import PostClusters, PostsDataset, nearest_centroids
+
+    if num_threads:
+        torch.set_num_threads(num_threads)
+
+    dataset = PostsDataset(numpy.arange(len(embeddings)), embeddings)
+    clusters = PostClusters(dataset, n_clusters, batch_size, engine=engine)
+
+    start = time.perf_counter()
+    if engine == 'torch':
+        clusters.fit(dataset, compute_labels=False, epochs=epochs)
+    else:
+        for _ in range(epochs):
+            clusters.fit(dataset, compute_labels=False)
+
+    elapsed = time.perf_counter() - start
+
+    rng = numpy.random.default_rng(0)
+    sample = numpy.sort(rng.choice(len(embeddings), min(sample_size, len(embeddings)), replace=False))
+    X = torch.nn.functional.normalize(torch.as_tensor(numpy.asarray(embeddings[sample])), dim=1)
+    centroids = torch.nn.functional.normalize(torch.as_tensor(clusters.cluster_centers_, dtype=torch.float32), dim=1)
+
+    # For unit vectors, the squared Euclidean distance is twice the cosine distance
+    distances, _ = nearest_centroids(X, centroids)
+
+    return KMeansBenchmarkResult(engine, len(embeddings) * epochs, n_clusters, elapsed, peak_rss(),
+                                 float(distances.mean()) / 2)
@@ -0,0 +1,496 @@
+import asyncio
+from datetime import datetime, UTC
+import os
+from pathlib import Path
+import platform
+import tempfile
+import time
+
+import click
+import orjson
+import numpy
+from rich.table import Table
+import torch
+
+from bsky_topics.benchmarks import (synthetic_posts, benchmark_post_writer, recent_post_texts, benchmark_embedder,
+                                    loop_mean_pool, insert_synthetic_posts, delete_posts, benchmark_embedding_writer,
+                                    recent_embeddings, benchmark_search, recorded_post_texts, benchmark_embed_stages,
+                                    peak_rss, synthetic_embeddings, benchmark_kmeans)
+from bsky_topics.commands import cli_main
+from bsky_topics.commands.embed import embedder_options
+from bsky_topics.db.writers import WRITE_MODES, EMBEDDING_WRITE_MODES
+from bsky_topics.embeddings import BACKENDS, PostEmbedder, detect_device
+from bsky_topics.snapshots import SnapshotArray, open_snapshots
+
+
+@cli_main.group()
+def bench():
+    """Benchmarks for the ingest, embedding and clustering pipelines."""
+    pass
+
+
+@bench.command()
+@click.option('-n', '--num-posts', type=int, default=50_000, help="Number of synthetic posts to write per run.")
+@click.option('-b', '--batch-size', 'batch_sizes', type=int, multiple=True, default=[64, 1024, 8192],
+              help="Batch size(s) to benchmark. Can be specified multiple times.")
+@click.option('-w', '--write-mode', 'write_modes', type=click.Choice(list(WRITE_MODES)), multiple=True,
+              default=list(WRITE_MODES), help="Write mode(s) to benchmark. Can be specified multiple times.")
+@click.pass_context
+def ingest(ctx, num_posts: int, batch_sizes: tuple[int], write_modes: tuple[str]):
+    """
+    Compare post write throughput (rows/s) of the collector write modes.
+
+    Writes synthetic posts to the configured database, and removes them afterwards.
+    """
+
+    console = ctx.obj['console']
+
+    table = Table(title=f"Post ingest ({num_posts} posts)")
+    table.add_column("Write mode")
+    table.add_column("Batch size", justify="right")
+    table.add_column("Inserted", justify="right")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Rows/s", justify="right")
+
+    results = asyncio.run(run_ingest_benchmarks(num_posts, batch_sizes, write_modes))
+    for result in results:
+        table.add_row(result.write_mode, str(result.batch_size), str(result.num_inserted),
+                      f"{result.elapsed:.2f}", f"{result.rows_per_sec:.0f}")
+
+    console.print(table)
+
+
+async def run_ingest_benchmarks(num_posts: int, batch_sizes: tuple[int], write_modes: tuple[str]):
+    results = []
+    for write_mode in write_modes:
+        for batch_size in batch_sizes:
+            posts = synthetic_posts(num_posts)
+            results.append(
+                await benchmark_post_writer(write_mode, WRITE_MODES[write_mode](), posts, batch_size)
+            )
+
+    return results
+
+
+@bench.command('write-embeddings')
+@click.option('-n', '--num-posts', type=int, default=50_000, help="Number of embeddings to write per run.")
+@click.option('-c', '--chunk-size', 'chunk_sizes', type=int, multiple=True, default=[256, 10_000],
+              help="Number of embeddings to commit at once. Can be specified multiple times.")
+@click.option('-w', '--write-mode', 'write_modes', type=click.Choice(list(EMBEDDING_WRITE_MODES)), multiple=True,
+              default=list(EMBEDDING_WRITE_MODES), help="Write mode(s) to benchmark. Can be specified multiple times.")
+@click.pass_context
+def write_embeddings(ctx, num_posts: int, chunk_sizes: tuple[int], write_modes: tuple[str]):
+    """
+    Compare embedding write throughput (rows/s) of the embedding write modes.
+
+    Writes random embeddings of synthetic posts to the configured database, and removes the posts
+    and embeddings afterwards.
+    """
+
+    console = ctx.obj['console']
+
+    table = Table(title=f"Embedding writes ({num_posts} embeddings)")
+    table.add_column("Write mode")
+    table.add_column("Chunk size", justify="right")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Rows/s", justify="right")
+
+    results = asyncio.run(run_embedding_write_benchmarks(num_posts, chunk_sizes, write_modes))
+    for result in results:
+        table.add_row(result.write_mode, str(result.chunk_size), f"{result.elapsed:.2f}",
+                      f"{result.rows_per_sec:.0f}")
+
+    console.print(table)
+
+
+async def run_embedding_write_benchmarks(num_posts: int, chunk_sizes: tuple[int], write_modes: tuple[str]):
+    posts = await insert_synthetic_posts(num_posts)
+
+    rng = numpy.random.default_rng(42)
+    embeddings = rng.standard_normal((len(posts), 384), dtype=numpy.float32)
+    embeddings /= numpy.linalg.norm(embeddings, axis=1, keepdims=True)
+
+    results = []
+    try:
+        for write_mode in write_modes:
+            for chunk_size in chunk_sizes:
+                results.append(
+                    await benchmark_embedding_writer(write_mode, EMBEDDING_WRITE_MODES[write_mode](), posts,
+                                                     embeddings, chunk_size)
+                )
+    finally:
+        await delete_posts([post_id for post_id, _ in posts], min(created_at for _, created_at in posts))
+
+    return results
+
+
+@bench.command()
+@click.option('-n', '--num-posts', type=int, default=5000, help="Number of posts to embed.")
+@click.option('-b', '--batch-size', type=int, default=256, help="Number of posts to embed in a batch.")
+@click.option('--source', type=click.Choice(['synthetic', 'recording', 'db']), default='synthetic',
+              help="Embed a fixed synthetic corpus, posts from recorded Jetstream traffic, or the most recent "
+                   "posts in the database.")
+@click.option('-r', '--recording', type=click.Path(exists=True, file_okay=False), default=None,
+              help="Directory with Jetstream traffic recorded with `collect --record`.")
+@embedder_options
+@click.option('--db-write/--no-db-write', default=True,
+              help="Also measure writing embeddings to the database, using temporary synthetic posts.")
+@click.option('--warmup', type=int, default=1, help="Number of batches to run before measuring.")
+@click.option('-o', '--output', type=click.Path(dir_okay=False), default=None,
+              help="Write results as JSON to this file, to compare runs with different settings.")
+@click.pass_context
+def embed(ctx, num_posts: int, batch_size: int, source: str, recording: str | None, device: str | None,
+          backend: str, threads: int | None, short_post_length: int | None, max_batch_tokens: int, write_mode: str,
+          db_write: bool, warmup: int, output: str | None):
+    """
+    Measure throughput and latency of each stage of the embed pipeline: sentence segmentation,
+    encoding, pooling and writing embeddings.
+
+    Reports posts/s, sentences/s, p50/p99 batch latency, and the peak RSS of the process after
+    each stage. By default, embeds a fixed synthetic corpus with realistic post length and
+    language distributions.
+    """
+
+    console = ctx.obj['console']
+    config = ctx.obj['config']
+
+    zstd_dictionary = None
+    if source == 'recording' and config.zstd_dictionary:
+        zstd_dictionary = Path(config.zstd_dictionary).read_bytes()
+
+    posts = load_posts(source, num_posts, recording, zstd_dictionary)
+
+    start = time.perf_counter()
+    embedder = PostEmbedder(device, short_post_length, backend, threads, max_batch_tokens or None)
+    load_time = time.perf_counter() - start
+    rss_after_load = peak_rss()
+
+    writer = EMBEDDING_WRITE_MODES[write_mode]() if db_write else None
+    stages = asyncio.run(run_embed_stage_benchmarks(embedder, posts, batch_size, writer, warmup))
+
+    lengths = numpy.array([len(post) for post in posts])
+    num_measured = stages['segment'].num_posts
+    elapsed = sum(stage.elapsed for stage in stages.values())
+
+    results = {
+        'timestamp': datetime.now(UTC).isoformat(),
+        'settings': {
+            'source': source,
+            'num_posts': len(posts),
+            'batch_size': batch_size,
+            'backend': backend,
+            'device': embedder.device,
+            'threads': threads or torch.get_num_threads(),
+            'short_post_length': short_post_length,
+            'max_batch_tokens': max_batch_tokens or None,
+            'write_mode': write_mode if db_write else None,
+            'warmup_batches': warmup,
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'torch': torch.__version__,
+        },
+        'corpus': {
+            'mean_length': float(lengths.mean()),
+            'p50_length': float(numpy.percentile(lengths, 50)),
+            'p99_length': float(numpy.percentile(lengths, 99)),
+        },
+        'model_load_seconds': load_time,
+        'rss_after_load': rss_after_load,
+        'stages': {name: stage.to_dict() for name, stage in stages.items()},
+        'total': {
+            'num_posts': num_measured,
+            'elapsed': elapsed,
+            'posts_per_sec': num_measured / elapsed if elapsed else 0.0,
+        },
+        'peak_rss': peak_rss(),
+    }
+
+    table = Table(title=f"Embed stages ({num_measured} posts, {backend} on {embedder.device}, "
+                        f"batch size {batch_size})")
+    table.add_column("Stage")
+    table.add_column("Posts/s", justify="right")
+    table.add_column("Sentences/s", justify="right")
+    table.add_column("p50 (ms)", justify="right")
+    table.add_column("p99 (ms)", justify="right")
+    table.add_column("Peak RSS (MB)", justify="right")
+
+    for stage in stages.values():
+        table.add_row(stage.stage, f"{stage.posts_per_sec:.0f}", f"{stage.sentences_per_sec:.0f}",
+                      f"{stage.latency_percentile(50) * 1000:.1f}", f"{stage.latency_percentile(99) * 1000:.1f}",
+                      f"{stage.peak_rss / 2**20:.0f}")
+
+    table.add_row("total", f"{results['total']['posts_per_sec']:.0f}", "", "", "", f"{peak_rss() / 2**20:.0f}")
+
+    console.print(table)
+
+    if output:
+        Path(output).write_bytes(orjson.dumps(results, option=orjson.OPT_INDENT_2))
+        console.print(f"Results written to {output}")
+
+
+async def run_embed_stage_benchmarks(embedder: PostEmbedder, posts: list[str], batch_size: int, writer, warmup: int):
+    if not writer:
+        return await benchmark_embed_stages(embedder, posts, batch_size, warmup_batches=warmup)
+
+    targets = await insert_synthetic_posts(batch_size)
+    try:
+        return await benchmark_embed_stages(embedder, posts, batch_size, writer, targets, warmup)
+    finally:
+        await delete_posts([post_id for post_id, _ in targets], min(created_at for _, created_at in targets))
+
+
+@bench.command('embed-settings')
+@click.option('-n', '--num-posts', type=int, default=5000, help="Number of posts to embed per run.")
+@click.option('-b', '--batch-size', type=int, default=256, help="Number of posts to embed in a batch.")
+@click.option('-l', '--short-post-length', 'short_post_lengths', type=int, multiple=True, default=[50, 100, 200],
+              help="Short post length(s) to benchmark. Can be specified multiple times.")
+@click.option('--max-batch-tokens', 'max_batch_tokens', type=int, multiple=True, default=[2048, 8192],
+              help="Token budget(s) of sentence batches to benchmark. Can be specified multiple times.")
+@click.option('-s', '--source', type=click.Choice(['db', 'synthetic']), default='db',
+              help="Embed the most recent posts in the database, or synthetic posts.")
+@click.option('-d', '--device', default=None,
+              help="Device to compute embeddings on, e.g., cuda, mps or cpu. Auto-detected by default.")
+@click.pass_context
+def embed_settings(ctx, num_posts: int, batch_size: int, short_post_lengths: tuple[int], max_batch_tokens: tuple[int],
+                   source: str, device: str | None):
+    """
+    Compare embedding throughput (posts/s) of skipping segmentation for short posts, and of
+    batching sentences by a token budget, and report the drift from the original embeddings.
+
+    The baseline segments every post, and pools sentence embeddings in a Python loop.
+    """
+
+    console = ctx.obj['console']
+    posts = load_posts(source, num_posts)
+
+    embedder = PostEmbedder(device)
+
+    # Warm up, excluding model initialization from the first run
+    embedder.embed(posts[:batch_size])
+
+    baseline, reference = benchmark_embedder("baseline", embedder, posts, batch_size, pool=loop_mean_pool)
+    results = [baseline]
+
+    embedder.short_post_length = None
+    results.append(benchmark_embedder("vectorized pooling", embedder, posts, batch_size, reference=reference)[0])
+
+    for short_post_length in short_post_lengths:
+        embedder.short_post_length = short_post_length
+        results.append(benchmark_embedder(f"short posts <= {short_post_length}", embedder, posts, batch_size,
+                                          reference=reference)[0])
+
+    embedder.short_post_length = None
+    for budget in max_batch_tokens:
+        embedder.max_batch_tokens = budget
+        results.append(benchmark_embedder(f"batches <= {budget} tokens", embedder, posts, batch_size,
+                                          reference=reference)[0])
+
+    table = Table(title=f"Post embedding ({len(posts)} posts)")
+    table.add_column("Mode")
+    table.add_column("Segmented", justify="right")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Posts/s", justify="right")
+    table.add_column("Speedup", justify="right")
+    table.add_column("Mean cos. sim.", justify="right")
+    table.add_column("Min cos. sim.", justify="right")
+
+    for result in results:
+        table.add_row(result.name, str(result.num_segmented), f"{result.elapsed:.2f}",
+                      f"{result.posts_per_sec:.0f}", f"{result.posts_per_sec / baseline.posts_per_sec:.2f}x",
+                      f"{result.similarities.mean():.5f}", f"{result.similarities.min():.5f}")
+
+    console.print(table)
+
+
+@bench.command()
+@click.option('-n', '--num-posts', type=int, default=5000, help="Number of posts to embed per run.")
+@click.option('-b', '--batch-size', type=int, default=256, help="Number of posts to embed in a batch.")
+@click.option('--backend', 'backends', type=click.Choice(BACKENDS[1:]), multiple=True, default=BACKENDS[1:],
+              help="Backend(s) to compare with PyTorch. Can be specified multiple times.")
+@click.option('-s', '--source', type=click.Choice(['db', 'synthetic']), default='db',
+              help="Embed the most recent posts in the database, or synthetic posts.")
+@click.option('-d', '--device', default=None,
+              help="Device to compute embeddings on, e.g., cuda, mps or cpu. Auto-detected by default.")
+@click.option('-t', '--threads', type=int, default=None,
+              help="Number of threads used within each model operation. Defaults to the number of cores.")
+@click.pass_context
+def backends(ctx, num_posts: int, batch_size: int, backends: tuple[str], source: str, device: str | None,
+             threads: int | None):
+    """
+    Compare embedding throughput (posts/s) of the inference backends with PyTorch, and report
+    the drift from the PyTorch embeddings.
+    """
+
+    console = ctx.obj['console']
+    posts = load_posts(source, num_posts)
+
+    results = []
+    reference = None
+    for backend in ['torch', *backends]:
+        embedder = PostEmbedder(device, backend=backend, num_threads=threads)
+        embedder.embed(posts[:batch_size])
+
+        result, embeddings = benchmark_embedder(backend, embedder, posts, batch_size, reference=reference)
+        results.append(result)
+
+        if reference is None:
+            reference = embeddings
+
+        del embedder
+
+    baseline = results[0]
+
+    table = Table(title=f"Embedding backends ({len(posts)} posts, device {device or detect_device()}, "
+                        f"{threads or torch.get_num_threads()} threads)")
+    table.add_column("Backend")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Posts/s", justify="right")
+    table.add_column("Speedup", justify="right")
+    table.add_column("Mean cos. sim.", justify="right")
+    table.add_column("Min cos. sim.", justify="right")
+
+    for result in results:
+        table.add_row(result.name, f"{result.elapsed:.2f}", f"{result.posts_per_sec:.0f}",
+                      f"{result.posts_per_sec / baseline.posts_per_sec:.2f}x",
+                      f"{result.similarities.mean():.5f}", f"{result.similarities.min():.5f}")
+
+    console.print(table)
+
+
+def load_posts(source: str, num_posts: int, recording: str | None = None,
+               zstd_dictionary: bytes | None = None) -> list[str]:
+    if source == 'db':
+        posts = asyncio.run(recent_post_texts(num_posts))
+    elif source == 'recording':
+        if not recording:
+            raise click.UsageError("Specify the directory with recorded traffic using --recording.")
+
+        posts = recorded_post_texts(recording, num_posts, zstd_dictionary)
+    else:
+        posts = [post['post_text'] for post in synthetic_posts(num_posts)]
+
+    if not posts:
+        raise click.ClickException("No posts to embed, collect some posts first or use `--source synthetic`.")
+
+    return posts
+
+
+@bench.command()
+@click.option('-n', '--num-queries', type=int, default=200,
+              help="Number of searches, using embeddings of recent posts as queries.")
+@click.option('-k', '--limit', type=int, default=10, help="Number of similar posts to find per query.")
+@click.option('-r', '--rerank', 'rerank_factors', type=int, multiple=True, default=[4, 10, 40],
+              help="Shortlist N times the number of results from the binary index. Can be specified multiple "
+                   "times.")
+@click.pass_context
+def search(ctx, num_queries: int, limit: int, rerank_factors: tuple[int]):
+    """
+    Compare similarity search latency of the binary quantized index with re-ranking, to the
+    HNSW index on full embeddings, and report the recall of the same results.
+
+    Requires the binary index, see `bsky-topics db binary-index create`.
+    """
+
+    console = ctx.obj['console']
+
+    results = asyncio.run(run_search_benchmarks(num_queries, limit, rerank_factors))
+    if not results:
+        raise click.ClickException("No embeddings to search, compute some embeddings first.")
+
+    table = Table(title=f"Similarity search ({num_queries} queries, {limit} results)")
+    table.add_column("Index")
+    table.add_column("p50 (ms)", justify="right")
+    table.add_column("p99 (ms)", justify="right")
+    table.add_column("Mean recall", justify="right")
+
+    for result in results:
+        p50, p99 = numpy.percentile(result.latencies, [50, 99]) * 1000
+        table.add_row(result.name, f"{p50:.1f}", f"{p99:.1f}", f"{result.recalls.mean():.3f}")
+
+    console.print(table)
+
+
+async def run_search_benchmarks(num_queries: int, limit: int, rerank_factors: tuple[int]):
+    queries = await recent_embeddings(num_queries)
+    if not len(queries):
+        return []
+
+    baseline, reference = await benchmark_search("hnsw", queries, limit)
+    results = [baseline]
+
+    for rerank in rerank_factors:
+        results.append((await benchmark_search(f"binary, re-rank {rerank}x", queries, limit, rerank,
+                                               reference=reference))[0])
+
+    return results
+
+
+@bench.command()
+@click.option('-n', '--num-rows', 'num_rows', type=int, multiple=True, default=[1_000_000, 10_000_000],
+              help="Number of embeddings to cluster. Can be specified multiple times.")
+@click.option('-k', '--n-clusters', type=int, default=10_000, help="Number of clusters.")
+@click.option('-b', '--batch-size', type=int, default=4096, help="Number of embeddings per mini-batch.")
+@click.option('-e', '--engine', 'engines', type=click.Choice(['torch', 'sklearn']), multiple=True,
+              default=['torch', 'sklearn'], help="K-means engine(s) to compare. Can be specified multiple times.")
+@click.option('--epochs', type=int, default=1, help="Number of passes over the embeddings.")
+@click.option('-t', '--threads', type=int, default=None,
+              help="Number of threads used by PyTorch. Defaults to the number of cores.")
+@click.option('-s', '--snapshots', type=click.Path(exists=True, file_okay=False), default=None,
+              help="Cluster embeddings from snapshots exported with `snapshot export`, instead of synthetic "
+                   "embeddings.")
+@click.option('--data-dir', type=click.Path(file_okay=False), default=None,
+              help="Directory to write synthetic embeddings to. Defaults to a temporary directory.")
+@click.pass_context
+def kmeans(ctx, num_rows: tuple[int], n_clusters: int, batch_size: int, engines: tuple[str], epochs: int,
+           threads: int | None, snapshots: str | None, data_dir: str | None):
+    """
+    Compare mini-batch k-means throughput (rows/s) and quality of the PyTorch engine with
+    scikit-learn's MiniBatchKMeans.
+
+    Synthetic embeddings are memory-mapped from disk, 10M embeddings take about 15 GB.
+    """
+
+    console = ctx.obj['console']
+
+    table = Table(title=f"Mini-batch k-means ({n_clusters} clusters, batch size {batch_size}, "
+                        f"{threads or torch.get_num_threads()} threads)")
+    table.add_column("Engine")
+    table.add_column("Rows", justify="right")
+    table.add_column("Time (s)", justify="right")
+    table.add_column("Rows/s", justify="right")
+    table.add_column("Mean cos. dist.", justify="right")
+    table.add_column("Peak RSS (MB)", justify="right")
+
+    with tempfile.TemporaryDirectory(dir=data_dir) as tmp_dir:
+        for n in num_rows:
+            if snapshots:
+                embeddings = first_snapshot_rows(snapshots, n)
+            else:
+                console.print(f"Generating {n} synthetic embeddings...")
+                embeddings = synthetic_embeddings(Path(tmp_dir) / f"embeddings-{n}.npy", n)
+
+            for engine in engines:
+                result = benchmark_kmeans(engine, embeddings, n_clusters, batch_size, epochs, threads)
+                table.add_row(engine, str(result.num_rows), f"{result.elapsed:.1f}", f"{result.rows_per_sec:.0f}",
+                              f"{result.mean_distance:.4f}", f"{result.peak_rss / 2**20:.0f}")
+
+            del embeddings
+
+    console.print(table)
+
+
+def first_snapshot_rows(directory: str, num_rows: int) -> SnapshotArray:
+    """The first `num_rows` embeddings of the snapshots in `directory`, still memory-mapped."""
+
+    chunks = []
+    for chunk in open_snapshots(directory)[1].iter_chunks():
+        remaining = num_rows - sum(len(c) for c in chunks)
+        if remaining <= 0:
+            break
+
+        chunks.append(chunk[:remaining])
+
+    return SnapshotArray(chunks)
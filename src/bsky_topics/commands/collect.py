@@ -1,16 +1,84 @@
 import asyncio
+from pathlib import Path
 
 import click
 
 from bsky_topics.commands import cli_main
+from bsky_topics.db.writers import WRITE_MODES
+from bsky_topics.filters import PostFilter
 from bsky_topics.jetstream import JetstreamCollector
+from bsky_topics.metrics import start_metrics_server
+from bsky_topics.segments import FrameRecorder
 
 
-@cli_main.command()
-@click.pass_context
-def collect(ctx):
+def collector_options(f):
+    """Options to configure the `JetstreamCollector`, shared by commands running a collector."""
+
+    options = [
+        click.option('-b', '--batch-size', type=int, default=64,
+                     help="Maximum number of posts to write in a single batch."),
+        click.option('-f', '--flush-interval', type=float, default=None,
+                     help="Write collected posts at least every N seconds, even if the batch is not full."),
+        click.option('-w', '--write-mode', type=click.Choice(list(WRITE_MODES)), default='insert',
+                     help="How to write posts: multi-row INSERT, or binary COPY via a staging table."),
+        click.option('-z', '--compress', is_flag=True, default=False,
+                     help="Request zstd compressed messages from Jetstream to reduce bandwidth."),
+        click.option('--zstd-dictionary', type=click.Path(exists=True, dir_okay=False), default=None,
+                     help="Path to the Jetstream zstd dictionary. Defaults to `zstd_dictionary` in the config file."),
+        click.option('-n', '--num-writers', type=int, default=2, help="Number of concurrent database writers."),
+        click.option('--spill-dir', type=click.Path(file_okay=False), default="spill",
+                     help="Directory to temporarily store posts when the database can't keep up."),
+        click.option('--max-lag', type=float, default=10.0,
+                     help="When collecting from multiple Jetstream instances, disconnect an instance for a "
+                          "while if it lags more than N seconds behind the others."),
+        click.option('--compact-interval', type=float, default=10.0,
+                     help="Remove deleted posts from the database every N seconds."),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
+def create_collector(ctx, batch_size: int, flush_interval: float | None, write_mode: str, compress: bool,
+                     zstd_dictionary: str | None, num_writers: int, spill_dir: str, max_lag: float,
+                     compact_interval: float, **kwargs) -> JetstreamCollector:
     config = ctx.obj['config']
     console = ctx.obj['console']
 
-    collector = JetstreamCollector(console, config.ws_hostname)
-    asyncio.run(collector.listen())
+    zstd_dict_data = None
+    if compress:
+        zstd_dictionary = zstd_dictionary or config.zstd_dictionary
+        if not zstd_dictionary:
+            raise click.UsageError("Compression requires the Jetstream zstd dictionary, specify it with "
+                                   "--zstd-dictionary or `zstd_dictionary` in the config file.")
+
+        zstd_dict_data = Path(zstd_dictionary).read_bytes()
+
+    return JetstreamCollector(console, config.ws_hostnames, batch_size, flush_interval, write_mode,
+                              zstd_dict_data, num_writers, spill_dir, max_lag=max_lag,
+                              post_filter=PostFilter.from_config(config.filters),
+                              compact_interval=compact_interval, **kwargs)
+
+
+@cli_main.command()
+@collector_options
+@click.option('-r', '--record', type=click.Path(file_okay=False), default=None,
+              help="Record all received messages to zstd compressed segment files in this directory.")
+@click.option('-m', '--metrics', metavar='HOST:PORT', default=None,
+              help="Expose Prometheus metrics on HOST:PORT, e.g., localhost:9100.")
+@click.pass_context
+def collect(ctx, record: str | None, metrics: str | None, **options):
+    if metrics:
+        start_metrics_server(metrics)
+
+    recorder = FrameRecorder(record) if record else None
+
+    collector = create_collector(ctx, recorder=recorder, **options)
+
+    try:
+        asyncio.run(collector.listen())
+    finally:
+        if recorder:
+            recorder.close()
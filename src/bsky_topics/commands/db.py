@@ -1,4 +1,5 @@
 import asyncio
+from datetime import date, datetime, timedelta, UTC
 
 import click
 from sqlalchemy import text
@@ -6,7 +7,11 @@ from alembic.config import Config as AlembicConfig
 from alembic import command
 
 from bsky_topics.commands import cli_main
+from bsky_topics.db import async_session
+from bsky_topics.db.partitions import create_partitions, create_default_partitions, prune_partitions
 from bsky_topics.db.schema import Base
+from bsky_topics.db.search import create_binary_index, drop_binary_index
+from bsky_topics.embedding_cache import prune_cache
 
 
 @cli_main.group()
@@ -20,14 +25,172 @@ def db():
 @click.pass_context
 def init(ctx, alembic_ini="alembic.ini"):
     engine = ctx.obj['db_engine']
+    config = ctx.obj['config']
 
-    asyncio.run(init_db(engine))
+    asyncio.run(init_db(engine, config.partition_days_ahead))
 
     cfg = AlembicConfig(alembic_ini)
     command.stamp(cfg, "head")
 
 
-async def init_db(engine):
+async def init_db(engine, days_ahead: int = 7):
     async with engine.begin() as conn:
         await conn.execute(text('CREATE EXTENSION IF NOT EXISTS vector'))
         await conn.run_sync(Base.metadata.create_all)
+
+        today = datetime.now(UTC).date()
+        await conn.run_sync(create_partitions, today, today + timedelta(days=days_ahead))
+        await conn.run_sync(create_default_partitions)
+
+
+@db.group()
+def partitions():
+    """Manage daily partitions of the posts and post_embeddings tables."""
+    pass
+
+
+@partitions.command()
+@click.option('-d', '--days-ahead', type=int, default=None,
+              help="Create partitions up to N days from today. Defaults to `days_ahead` in the config file.")
+@click.pass_context
+def create(ctx, days_ahead: int | None):
+    """
+    Create daily partitions ahead of time.
+
+    Run this daily, e.g., using cron, such that partitions exist before posts arrive.
+    """
+
+    engine = ctx.obj['db_engine']
+    config = ctx.obj['config']
+    console = ctx.obj['console']
+
+    if days_ahead is None:
+        days_ahead = config.partition_days_ahead
+
+    today = datetime.now(UTC).date()
+    created = asyncio.run(create_daily_partitions(engine, today, today + timedelta(days=days_ahead)))
+
+    console.print(f"Ensured {len(created)} partitions exist, up to {today + timedelta(days=days_ahead)}.")
+
+
+@partitions.command()
+@click.option('-r', '--retention-days', type=int, default=None,
+              help="Remove partitions older than N days. Defaults to `retention_days` in the config file.")
+@click.option('-a', '--archive', is_flag=True, default=False,
+              help="Detach and rename partitions to archive_<partition> instead of dropping them.")
+@click.pass_context
+def prune(ctx, retention_days: int | None, archive: bool):
+    """
+    Drop or archive partitions older than the retention period.
+    """
+
+    engine = ctx.obj['db_engine']
+    config = ctx.obj['config']
+    console = ctx.obj['console']
+
+    if retention_days is None:
+        retention_days = config.retention_days
+
+    if retention_days is None:
+        raise click.UsageError("No retention period configured, specify --retention-days or `retention_days` in "
+                               "the config file.")
+
+    before = datetime.now(UTC).date() - timedelta(days=retention_days)
+    removed = asyncio.run(run_partition_task(engine, prune_partitions, before, archive))
+
+    console.print(f"{'Archived' if archive else 'Dropped'} {len(removed)} partitions older than {before}.")
+
+
+@db.group('binary-index')
+def binary_index():
+    """
+    Manage the HNSW index on binary quantized post embeddings.
+
+    The index is smaller and faster to build than the index on the full embeddings, and is used
+    by similarity searches that re-rank a shortlist of candidates.
+    """
+    pass
+
+
+@binary_index.command('create')
+@click.pass_context
+def create_binary(ctx):
+    """Create the binary index, this can take a while for large tables."""
+
+    engine = ctx.obj['db_engine']
+    console = ctx.obj['console']
+
+    asyncio.run(run_partition_task(engine, create_binary_index))
+
+    console.print("Created the binary quantized embedding index.")
+
+
+@binary_index.command('drop')
+@click.pass_context
+def drop_binary(ctx):
+    engine = ctx.obj['db_engine']
+    console = ctx.obj['console']
+
+    asyncio.run(run_partition_task(engine, drop_binary_index))
+
+    console.print("Dropped the binary quantized embedding index.")
+
+
+@db.group()
+def cache():
+    """Manage the table of embeddings of repeated post texts."""
+    pass
+
+
+@cache.command('prune')
+@click.option('-d', '--max-age-days', type=int, default=30, show_default=True,
+              help="Remove embeddings stored more than N days ago.")
+@click.pass_context
+def prune_cached(ctx, max_age_days: int):
+    """
+    Remove old embeddings from the embedding cache table.
+
+    Run this daily, e.g., using cron, such that the table only holds embeddings of texts repeated
+    recently. Texts still repeated are stored again.
+    """
+
+    console = ctx.obj['console']
+
+    before = datetime.now(UTC).replace(tzinfo=None) - timedelta(days=max_age_days)
+    removed = asyncio.run(prune_cached_embeddings(before))
+
+    console.print(f"Removed {removed} cached embeddings stored before {before:%Y-%m-%d %H:%M}.")
+
+
+async def prune_cached_embeddings(before: datetime) -> int:
+    """Remove cached embeddings in batches, each in its own transaction."""
+
+    removed = 0
+    async with async_session() as session:
+        while True:
+            num_removed = await prune_cache(session, before)
+            await session.commit()
+
+            removed += num_removed
+            if not num_removed:
+                return removed
+
+
+async def create_daily_partitions(engine, start: date, end: date) -> list[str]:
+    """
+    Create partitions of each day in a separate transaction, such that rows are moved out of the
+    default partitions without locking them for all days at once.
+    """
+
+    created = []
+    day = start
+    while day <= end:
+        created.extend(await run_partition_task(engine, create_partitions, day, day))
+        day += timedelta(days=1)
+
+    return created
+
+
+async def run_partition_task(engine, fn, *args):
+    async with engine.begin() as conn:
+        return await conn.run_sync(fn, *args)
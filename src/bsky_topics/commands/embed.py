@@ -1,102 +1,696 @@
 import asyncio
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
 import logging
+import time
 
+import asyncpg
 import click
-from sqlalchemy import select, insert, update
+import numpy
+from rich.table import Table
+from sqlalchemy import select
+from sqlalchemy.exc import StatementError
 
 from bsky_topics.commands import cli_main
 from bsky_topics.db import async_session
-from bsky_topics.db.schema import Post, PostEmbedding
-from bsky_topics.embeddings import PostEmbedder
+from bsky_topics.db.embedding_queue import (DEFAULT_LEASE, Claim, ClaimedPost, PostFailure, claim_posts,
+                                            complete_posts, release_posts, fail_posts, exclude_failed_posts,
+                                            retry_failed_posts, count_failures, count_queued)
+from bsky_topics.db.schema import Post, PostEmbedding, EmbeddingTask
+from bsky_topics.db.writers import EMBEDDING_WRITE_MODES, EmbeddingWriter
+from bsky_topics.embedding_cache import EmbeddingCache
+from bsky_topics.embeddings import BACKENDS, PostEmbedder, SegmentedPosts
+from bsky_topics.metrics import (EMBED_BACKLOG, EMBED_STAGE_SECONDS, EMBED_STAGE_BUSY_SECONDS,
+                                 EMBED_STAGE_UTILISATION, EMBED_QUEUED, EMBED_CACHE_LOOKUPS, EMBED_CACHE_SAVED_SECONDS,
+                                 POSTS_EMBEDDED, POSTS_EXCLUDED, start_metrics_server)
+from bsky_topics.topic_assignment import TopicAssigner, last_topic_update
 
 logger = logging.getLogger(__name__)
 
 
+def embedder_options(f):
+    """Options to configure the `PostEmbedder`, shared by commands computing embeddings."""
+
+    options = [
+        click.option('-d', '--device', default=None,
+                     help="Device to compute embeddings on, e.g., cuda, mps or cpu. Auto-detected by default."),
+        click.option('--backend', type=click.Choice(BACKENDS), default='torch',
+                     help="Run the models with PyTorch, or with ONNX Runtime, optionally with int8 quantized "
+                          "weights. ONNX Runtime is usually faster on CPU."),
+        click.option('-t', '--threads', type=int, default=None,
+                     help="Number of threads used within each model operation. Defaults to the number of cores."),
+        click.option('-s', '--short-post-length', type=int, default=None,
+                     help="Don't split posts of at most N characters into sentences, but embed them as a whole. "
+                          "Most posts are a single sentence, this saves running the segmentation model."),
+        click.option('--max-batch-tokens', type=int, default=8192,
+                     help="Group sentences of similar length into batches of at most N tokens including padding, "
+                          "instead of a fixed number of sentences. Use 0 to disable."),
+        click.option('-w', '--write-mode', type=click.Choice(list(EMBEDDING_WRITE_MODES)), default='copy',
+                     help="Write embeddings with binary COPY, or with INSERT statements."),
+    ]
+
+    for option in reversed(options):
+        f = option(f)
+
+    return f
+
+
 @cli_main.command()
 @click.option('-b', '--batch-size', type=int, default=256, help="Number of posts to process in batch.")
-@click.option('-d', '--device', default="mps", help="(GPU) device use for computing embeddings.")
+@embedder_options
+@click.option('-l', '--lease', type=float, default=300.0,
+              help="Seconds a claimed batch is reserved for this worker. If not completed in time, other "
+                   "workers may claim the batch.")
+@click.option('--cache-size', type=int, default=50_000,
+              help="Reuse embeddings of up to N recently embedded texts for posts with the same text. "
+                   "Use 0 to disable.")
+@click.option('-p', '--prefetch', type=int, default=2,
+              help="Maximum number of batches waiting between each stage of the pipeline.")
+@click.option('-m', '--metrics', metavar='HOST:PORT', default=None,
+              help="Expose Prometheus metrics on HOST:PORT, e.g., localhost:9101.")
+@click.option('--assign-topics/--no-assign-topics', default=True,
+              help="Assign each post the topic with the nearest centroid, if the topics table is not empty.")
+@click.option('--topic-decay', type=float, default=0.0,
+              help="Move topic centroids a fraction towards each assigned post, such that topics follow "
+                   "the conversation. Only enable this for a single worker. Use 0 to keep centroids fixed.")
+@click.option('--topic-sync-interval', type=float, default=300.0,
+              help="Seconds between checking for new topics, and storing updated centroids.")
 @click.pass_context
-def embed(ctx, batch_size: int, device: str = 'mps'):
-    embed_service = PostEmbedService(batch_size, device)
+def embed(ctx, batch_size: int, device: str | None = None, backend: str = 'torch', threads: int | None = None,
+          short_post_length: int | None = None, max_batch_tokens: int = 8192, write_mode: str = 'copy',
+          lease: float = 300.0, cache_size: int = 50_000, prefetch: int = 2, metrics: str | None = None,
+          assign_topics: bool = True, topic_decay: float = 0.0, topic_sync_interval: float = 300.0):
+    """
+    Compute embeddings for posts in the embedding queue.
+
+    Multiple embed workers can run concurrently, also on different machines.
+    """
+
+    if metrics:
+        start_metrics_server(metrics)
+
+    embed_service = PostEmbedService(batch_size, device, timedelta(seconds=lease), prefetch=prefetch,
+                                     short_post_length=short_post_length, cache_size=cache_size, backend=backend,
+                                     num_threads=threads, max_batch_tokens=max_batch_tokens or None,
+                                     write_mode=write_mode, assign_topics=assign_topics, topic_decay=topic_decay,
+                                     topic_sync_interval=topic_sync_interval)
     asyncio.run(embed_service.compute_embeddings())
 
 
+@cli_main.command()
+@click.option('-b', '--batch-size', type=int, default=256, help="Number of posts to process in batch.")
+@click.option('-c', '--commit-every', type=int, default=10_000,
+              help="Commit after writing N embeddings.")
+@click.option('--since', type=click.DateTime(), default=None,
+              help="Only embed posts created at or after this time (UTC).")
+@click.option('--until', type=click.DateTime(), default=None,
+              help="Only embed posts created before this time (UTC).")
+@embedder_options
+@click.option('--assign-topics/--no-assign-topics', default=True,
+              help="Assign each post the topic with the nearest centroid, if the topics table is not empty.")
+@click.pass_context
+def backfill(ctx, batch_size: int, commit_every: int, since: datetime | None, until: datetime | None,
+             device: str | None = None, backend: str = 'torch', threads: int | None = None,
+             short_post_length: int | None = None, max_batch_tokens: int = 8192, write_mode: str = 'copy',
+             assign_topics: bool = True):
+    """
+    Compute embeddings for posts without an embedding, which are not in the embedding queue.
+
+    E.g., posts restored from an archived partition. Embeddings are written in bulk, and
+    committed in chunks. Posts which fail to embed are excluded, like in `embed`.
+    """
+
+    console = ctx.obj['console']
+
+    embedder = PostEmbedder(device, short_post_length, backend, threads, max_batch_tokens or None)
+    writer = EMBEDDING_WRITE_MODES[write_mode]()
+
+    num_written = asyncio.run(backfill_embeddings(embedder, writer, batch_size, commit_every, since, until,
+                                                  assign_topics=assign_topics))
+
+    console.print(f"Stored embeddings of {num_written} posts.")
+
+
+async def backfill_embeddings(embedder: PostEmbedder, writer: EmbeddingWriter, batch_size: int, commit_every: int,
+                              since: datetime | None = None, until: datetime | None = None,
+                              assign_topics: bool = False) -> int:
+    has_embedding = (select(PostEmbedding.id)
+                     .where(PostEmbedding.post_id == Post.id, PostEmbedding.post_created_at == Post.created_at)
+                     .exists())
+    is_queued = (select(EmbeddingTask.post_id)
+                 .where(EmbeddingTask.post_id == Post.id, EmbeddingTask.post_created_at == Post.created_at)
+                 .exists())
+
+    stmt = (select(Post.id, Post.created_at, Post.post_text)
+            .where(~has_embedding, ~is_queued, Post.exclude_for_embedding.isnot(True))
+            .order_by(Post.id)
+            .limit(batch_size))
+
+    if since:
+        stmt = stmt.where(Post.created_at >= since)
+    if until:
+        stmt = stmt.where(Post.created_at < until)
+
+    topics = None
+    if assign_topics:
+        async with async_session() as session:
+            topics = await TopicAssigner.load(session)
+
+    last_id = 0
+    num_written = 0
+    pending_posts = []
+    pending_embeddings = []
+
+    async def write_pending():
+        nonlocal num_written, pending_posts, pending_embeddings
+
+        embeddings = numpy.concatenate(pending_embeddings)
+        async with async_session() as session:
+            num_written += await writer.write(session, pending_posts, embeddings,
+                                              topics.assign(embeddings) if topics else None)
+            await session.commit()
+
+        logger.info("Stored embeddings of %d posts, up to post ID %d", num_written, last_id)
+        pending_posts = []
+        pending_embeddings = []
+
+    async def try_embed(posts: list[ClaimedPost]) -> tuple[str, Exception] | None:
+        return embed_posts(embedder, posts)[1]
+
+    while True:
+        async with async_session() as session:
+            posts = [ClaimedPost(*row) for row in await session.execute(stmt.where(Post.id > last_id))]
+
+        if not posts:
+            break
+
+        embeddings, failure = embed_posts(embedder, posts)
+        if failure:
+            failures = await find_failing_posts(try_embed, posts, failure)
+            if not failures:
+                # Probably a transient error, rerun the backfill to continue
+                raise failure[1]
+
+            log_failures(failures)
+            async with async_session() as session:
+                await exclude_failed_posts(session, failures)
+                await session.commit()
+
+            POSTS_EXCLUDED.inc(len(failures))
+
+            # Embed the other posts again, excluded posts are no longer selected
+            continue
+
+        pending_embeddings.append(embeddings)
+        pending_posts.extend((post.id, post.created_at) for post in posts)
+        last_id = posts[-1].id
+
+        if len(pending_posts) >= commit_every:
+            await write_pending()
+
+    if pending_posts:
+        await write_pending()
+
+    return num_written
+
+
+def embed_posts(embedder: PostEmbedder,
+                posts: list[ClaimedPost]) -> tuple[numpy.ndarray | None, tuple[str, Exception] | None]:
+    """Embed posts, and return their embeddings, or the stage and exception if this fails."""
+
+    stage = 'segment'
+    try:
+        segmented = embedder.segment([post.post_text for post in posts])
+
+        stage = 'encode'
+        return embedder.encode(segmented), None
+    except Exception as e:
+        return None, (stage, e)
+
+
+async def find_failing_posts(try_embed, posts: list[ClaimedPost],
+                             failure: tuple[str, Exception] | None = None) -> list[PostFailure]:
+    """
+    Find the posts which fail to embed by themselves, by recursively bisecting the batch. A
+    single failing post is found in about 2 log2(n) batched calls.
+
+    `try_embed` embeds a list of posts, and returns the stage and exception if this fails.
+    `failure` is the result of embedding all `posts`, if already known.
+    """
+
+    if failure is None:
+        failure = await try_embed(posts)
+
+    if failure is None:
+        return []
+
+    if len(posts) == 1:
+        return [PostFailure(posts[0], *failure)]
+
+    middle = len(posts) // 2
+    return (await find_failing_posts(try_embed, posts[:middle])
+            + await find_failing_posts(try_embed, posts[middle:]))
+
+
+def log_failures(failures: list[PostFailure]):
+    for failure in failures:
+        logger.error("Could not compute embedding for post ID: %d, %s failed with %s, text: %s",
+                     failure.post.id, failure.stage, type(failure.error).__name__, failure.post.post_text)
+
+
+@cli_main.group()
+def failures():
+    """Inspect and retry posts for which computing an embedding failed."""
+    pass
+
+
+@failures.command('list')
+@click.pass_context
+def list_failures(ctx):
+    """Show the number of failed posts by pipeline stage and exception class."""
+
+    console = ctx.obj['console']
+
+    table = Table(title="Embedding failures")
+    table.add_column("Stage")
+    table.add_column("Error")
+    table.add_column("Posts", justify="right")
+
+    for stage, error, num_posts in asyncio.run(run_in_session(count_failures)):
+        table.add_row(stage, error, str(num_posts))
+
+    console.print(table)
+
+
+@failures.command()
+@click.option('-s', '--stage', default=None, help="Only retry posts that failed in this stage, e.g., segment.")
+@click.option('-e', '--error', default=None, help="Only retry posts that failed with this exception class.")
+@click.pass_context
+def retry(ctx, stage: str | None, error: str | None):
+    """Add failed posts back to the embedding queue, e.g., after fixing the cause of the failure."""
+
+    console = ctx.obj['console']
+
+    num_posts = asyncio.run(run_in_session(retry_failed_posts, stage, error, commit=True))
+
+    console.print(f"Added {num_posts} posts back to the embedding queue.")
+
+
+async def run_in_session(fn, *args, commit: bool = False):
+    async with async_session() as session:
+        result = await fn(session, *args)
+
+        if commit:
+            await session.commit()
+
+        return result
+
+
+@dataclass
+class EmbedBatch:
+    """
+    A claimed batch of posts moving through the embed pipeline.
+
+    Only `texts` are embedded, which excludes posts found in the embedding cache, and duplicate
+    texts within the batch. With caching enabled, `post_keys` and `text_keys` are the cache keys
+    of each post and each text respectively.
+    """
+
+    claim: Claim
+    texts: list[str]
+    post_keys: list[bytes] | None = None
+    text_keys: list[bytes] | None = None
+    cached: dict[bytes, numpy.ndarray] = field(default_factory=dict)
+
+    segmented: SegmentedPosts | None = None
+    embeddings: numpy.ndarray | None = None
+
+    def post_embeddings(self) -> list[numpy.ndarray]:
+        """Embeddings of each post, combining cached and computed embeddings."""
+
+        if self.post_keys is None:
+            return list(self.embeddings)
+
+        by_key = dict(self.cached)
+        if self.texts:
+            by_key.update(zip(self.text_keys, self.embeddings))
+
+        return [by_key[key] for key in self.post_keys]
+
+
 class PostEmbedService:
     """
-    Continuously check for posts without an embedding, and compute if needed.
+    Continuously claim posts from the embedding queue, and compute their embeddings.
+
+    The service is a pipeline of stages connected by bounded queues, such that the model and
+    the database are used at the same time: claiming batches from the embedding queue (see
+    `bsky_topics.db.embedding_queue`), sentence segmentation, encoding, and writing embeddings.
+    Up to `prefetch` batches wait between consecutive stages. Segmentation and encoding each run
+    in a dedicated thread, PyTorch and ONNX Runtime release the GIL during inference.
+
+    Every `backlog_interval` seconds, the size of the queue is reported as backlog, together with
+    the utilisation of each stage. The stage with the highest utilisation is the bottleneck.
+
+    Posts with the same text as a recently embedded post reuse its embedding, see
+    `bsky_topics.embedding_cache`. The in-process tier holds up to `cache_size` embeddings,
+    caching is disabled if zero.
+
+    With `assign_topics`, posts are assigned the topic with the nearest centroid when writing
+    their embeddings, see `bsky_topics.topic_assignment`. Every `topic_sync_interval` seconds,
+    new topics are loaded, or, with a `topic_decay` rate, updated centroids are stored.
     """
 
-    def __init__(self, batch_size: int = 256, device: str | None = None):
-        self.embedder = PostEmbedder(device)
+    STAGES = ['fetch', 'segment', 'encode', 'write']
+
+    def __init__(self, batch_size: int = 256, device: str | None = None, lease: timedelta = DEFAULT_LEASE,
+                 backlog_interval: float = 15.0, prefetch: int = 2, short_post_length: int | None = None,
+                 cache_size: int = 50_000, backend: str = 'torch', num_threads: int | None = None,
+                 max_batch_tokens: int | None = None, write_mode: str = 'copy', assign_topics: bool = True,
+                 topic_decay: float = 0.0, topic_sync_interval: float = 300.0):
+        self.embedder = PostEmbedder(device, short_post_length, backend, num_threads, max_batch_tokens)
+        self.writer = EMBEDDING_WRITE_MODES[write_mode]()
+        self.cache = EmbeddingCache(self.embedder.settings_id, cache_size) if cache_size else None
         self.batch_size = batch_size
+        self.lease = lease
+
+        self.assign_topics = assign_topics
+        self.topic_decay = topic_decay
+        self.topic_sync_interval = topic_sync_interval
+        self.topics: TopicAssigner | None = None
         self.backoff_counter = 0
 
+        self.backlog_interval = backlog_interval
+
+        self.claimed_queue: asyncio.Queue[EmbedBatch | None] = asyncio.Queue(prefetch)
+        self.segmented_queue: asyncio.Queue[EmbedBatch | None] = asyncio.Queue(prefetch)
+        self.encoded_queue: asyncio.Queue[EmbedBatch | None] = asyncio.Queue(prefetch)
+
+        # Each model is only used from its own thread
+        self.segment_executor = ThreadPoolExecutor(1, thread_name_prefix="segment")
+        self.encode_executor = ThreadPoolExecutor(1, thread_name_prefix="encode")
+
+        # Seconds each stage spent working
+        self.busy_time: Counter[str] = Counter()
+
+        # Number of texts segmented and encoded, to estimate the time saved by the cache
+        self.num_embedded: int = 0
+
     async def compute_embeddings(self):
-        async with async_session() as session:
-            while True:
-                # Select a batch of posts without an existing embedding
-                subquery = (select(PostEmbedding.id)
-                            .filter(PostEmbedding.post_id == Post.id))
-
-                stmt = (select(Post.id, Post.post_text)
-                        .filter(
-                            ~subquery.exists(),
-                            ~Post.exclude_for_embedding,
-                        )
-                        .order_by(Post.id)
-                        .limit(self.batch_size))
-
-                batch = await session.execute(stmt)
-                batch = list(batch)
-
-                if not batch:
-                    logger.info("Nothing to process, sleeping...")
-                    await asyncio.sleep(2**self.backoff_counter)
-                    self.backoff_counter += 1
-
-                    if self.backoff_counter > 10:
-                        # Quit if no new posts found after 10 retries
-                        return
-                    else:
-                        continue
-
-                # Found a batch of posts to process
-                self.backoff_counter = 0
-
-                post_ids = [p[0] for p in batch]
-                post_texts = [p[1] for p in batch]
+        """Run the pipeline until no new posts are found for a while."""
 
-                try:
-                    embeddings = self.embedder.embed(post_texts)
-                except AssertionError:
-                    await self.exclude_errornous_posts(post_ids, post_texts)
-                    continue
+        monitor = asyncio.create_task(self.monitor())
+
+        if self.assign_topics:
+            await self.load_topics()
+            topic_sync = asyncio.create_task(self.sync_topics())
+        else:
+            topic_sync = None
+
+        try:
+            await asyncio.gather(
+                self.fetch_batches(),
+                self.segment_batches(),
+                self.encode_batches(),
+                self.write_batches(),
+            )
+        finally:
+            monitor.cancel()
+            if topic_sync:
+                topic_sync.cancel()
 
-                new_embeddings = [
-                    {'post_id': post_ids[i], 'embedding': embeddings[i]}
-                    for i in range(len(embeddings))
-                ]
+            self.segment_executor.shutdown()
+            self.encode_executor.shutdown()
 
-                await session.execute(insert(PostEmbedding), new_embeddings)
+    async def run_stage(self, stage: str, fn, *args, executor: ThreadPoolExecutor | None = None):
+        """Run `fn` as part of `stage`, in `executor` if given, and keep track of the time spent."""
+
+        start = time.perf_counter()
+        try:
+            if executor:
+                return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+            else:
+                return await fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.busy_time[stage] += elapsed
+            EMBED_STAGE_BUSY_SECONDS.labels(stage).inc(elapsed)
+
+    async def claim(self) -> Claim:
+        with EMBED_STAGE_SECONDS.labels('fetch').time():
+            async with async_session() as session:
+                claim = await claim_posts(session, self.batch_size, self.lease)
                 await session.commit()
 
-    async def exclude_errornous_posts(self, post_ids: list[int], post_texts: list[str]):
+        return claim
+
+    async def lookup_cached(self, batch: EmbedBatch):
+        """Look up posts in the embedding cache, and only keep texts to embed which are not found."""
+
+        batch.post_keys = [self.cache.key(post.post_text) for post in batch.claim.posts]
+
         async with async_session() as session:
-            exclude = []
+            batch.cached, memory_hits = await self.cache.lookup(session, batch.post_keys)
+
+        # Embed each remaining text once
+        texts = {}
+        for key, post in zip(batch.post_keys, batch.claim.posts):
+            if key not in batch.cached:
+                texts.setdefault(key, post.post_text)
+
+        batch.text_keys = list(texts.keys())
+        batch.texts = list(texts.values())
+
+        num_memory = sum(1 for key in batch.post_keys if key in memory_hits)
+        num_hits = sum(1 for key in batch.post_keys if key in batch.cached)
+        EMBED_CACHE_LOOKUPS.labels('memory').inc(num_memory)
+        EMBED_CACHE_LOOKUPS.labels('table').inc(num_hits - num_memory)
+        EMBED_CACHE_LOOKUPS.labels('miss').inc(len(batch.post_keys) - num_hits)
+
+        if self.num_embedded:
+            seconds_per_text = (self.busy_time['segment'] + self.busy_time['encode']) / self.num_embedded
+            EMBED_CACHE_SAVED_SECONDS.inc((len(batch.post_keys) - len(batch.texts)) * seconds_per_text)
+
+    async def fetch_batches(self):
+        """Pipeline stage claiming batches of posts."""
+
+        while True:
+            claim = await self.run_stage('fetch', self.claim)
+
+            if not claim.posts:
+                EMBED_BACKLOG.set(0)
+
+                logger.info("Nothing to process, sleeping...")
+                await asyncio.sleep(2**self.backoff_counter)
+                self.backoff_counter += 1
+
+                if self.backoff_counter > 10:
+                    # Quit if no new posts found after 10 retries
+                    await self.claimed_queue.put(None)
+                    return
+                else:
+                    continue
+
+            # Found a batch of posts to process
+            self.backoff_counter = 0
+
+            batch = EmbedBatch(claim, [post.post_text for post in claim.posts])
+            if self.cache:
+                await self.run_stage('fetch', self.lookup_cached, batch)
+
+            await self.claimed_queue.put(batch)
+
+    async def segment_batches(self):
+        """Pipeline stage splitting posts into sentences."""
+
+        while (batch := await self.claimed_queue.get()) is not None:
+            if not batch.texts:
+                # All posts found in the cache
+                await self.segmented_queue.put(batch)
+                continue
+
+            try:
+                batch.segmented = await self.run_stage('segment', self.embedder.segment, batch.texts,
+                                                       executor=self.segment_executor)
+            except Exception as e:
+                await self.exclude_failing_posts(batch.claim, 'segment', e)
+                continue
+
+            await self.segmented_queue.put(batch)
 
-            # Try one by one to test which post in a batch caused an error
-            for i, post_text in enumerate(post_texts):
+        await self.segmented_queue.put(None)
+
+    async def encode_batches(self):
+        """Pipeline stage computing post embeddings from sentences."""
+
+        while (batch := await self.segmented_queue.get()) is not None:
+            if batch.segmented is None:
+                await self.encoded_queue.put(batch)
+                continue
+
+            try:
+                batch.embeddings = await self.run_stage('encode', self.embedder.encode, batch.segmented,
+                                                        executor=self.encode_executor)
+            except Exception as e:
+                await self.exclude_failing_posts(batch.claim, 'encode', e)
+                continue
+
+            self.num_embedded += len(batch.texts)
+
+            # Add to the cache right away, such that the next batches benefit
+            if self.cache:
+                counts = Counter(batch.post_keys)
+                for key, embedding in zip(batch.text_keys, batch.embeddings):
+                    self.cache.put(key, embedding, repeated=counts[key] > 1)
+
+            await self.encoded_queue.put(batch)
+
+        await self.encoded_queue.put(None)
+
+    async def write_batches(self):
+        """Pipeline stage storing embeddings."""
+
+        while (batch := await self.encoded_queue.get()) is not None:
+            await self.run_stage('write', self.store_embeddings, batch.claim, batch.post_embeddings())
+
+    async def store_embeddings(self, claim: Claim, embeddings: list[numpy.ndarray]):
+        """
+        Store embeddings of claimed posts, and remove them from the queue.
+
+        Embeddings of posts claimed by another worker in the meantime are discarded. Embeddings
+        of repeated texts are stored in the embedding cache table in the same transaction.
+        """
+
+        with EMBED_STAGE_SECONDS.labels('write').time():
+            async with async_session() as session:
                 try:
-                    self.embedder.embed([post_text])
-                except AssertionError:
-                    logger.error("Could not compute embedding for post ID: %d, text: %s", post_ids[i], post_text)
-                    logger.error("Skipping from processing in the future.")
+                    completed = await complete_posts(session, claim.id, claim.posts)
+
+                    cached_keys = await self.cache.persist(session) if self.cache else []
+
+                    new_posts = [(post.id, post.created_at) for post in claim.posts if post.id in completed]
+                    new_embeddings = [embedding for post, embedding in zip(claim.posts, embeddings)
+                                      if post.id in completed]
+
+                    if new_posts:
+                        new_embeddings = numpy.stack(new_embeddings)
+                        topics = self.topics.assign(new_embeddings) if self.topics else None
+
+                        await self.writer.write(session, new_posts, new_embeddings, topics)
+
+                    await session.commit()
+                except (StatementError, asyncpg.PostgresError) as e:
+                    # E.g., a post was deleted in the meantime. The batch is retried once the lease expires.
+                    logger.exception(e)
+                    return
+
+        if self.cache:
+            self.cache.committed(cached_keys)
+
+        if len(completed) < len(claim.posts):
+            logger.warning("Lease expired for %d posts, discarded their embeddings.",
+                           len(claim.posts) - len(completed))
+
+        POSTS_EMBEDDED.inc(len(new_embeddings))
+
+    async def load_topics(self):
+        async with async_session() as session:
+            self.topics = await TopicAssigner.load(session, self.topic_decay)
 
-                    exclude.append(post_ids[i])
+        if self.topics:
+            logger.info("Assigning posts to %d topics", len(self.topics))
 
+    async def sync_topics(self):
+        """
+        Periodically load topics if they were replaced, or otherwise store centroids updated by
+        this worker.
+        """
 
-            stmt = update(Post).where(Post.id.in_(exclude)).values(exclude_for_embedding=True)
+        while True:
+            await asyncio.sleep(self.topic_sync_interval)
 
-            await session.execute(stmt)
+            try:
+                async with async_session() as session:
+                    last_update = await last_topic_update(session)
+
+                    if self.topics is None or self.topics.loaded_at != last_update:
+                        await self.load_topics()
+                    elif self.topics.decay:
+                        await self.topics.persist(session)
+                        await session.commit()
+
+                        self.topics.loaded_at = await last_topic_update(session)
+            except Exception as e:
+                # E.g., the database connection was lost. Retried in the next interval.
+                logger.exception(e)
+
+    async def monitor(self):
+        """Periodically report the backlog, queue sizes and utilisation of each stage."""
+
+        last_busy_time = Counter()
+        last_time = time.perf_counter()
+
+        while True:
+            await asyncio.sleep(self.backlog_interval)
+
+            async with async_session() as session:
+                EMBED_BACKLOG.set(await count_queued(session))
+
+            EMBED_QUEUED.labels('claimed').set(self.claimed_queue.qsize())
+            EMBED_QUEUED.labels('segmented').set(self.segmented_queue.qsize())
+            EMBED_QUEUED.labels('encoded').set(self.encoded_queue.qsize())
+
+            now = time.perf_counter()
+            utilisation = {
+                stage: (self.busy_time[stage] - last_busy_time[stage]) / (now - last_time)
+                for stage in self.STAGES
+            }
+
+            for stage, value in utilisation.items():
+                EMBED_STAGE_UTILISATION.labels(stage).set(value)
+
+            logger.info("Stage utilisation: %s",
+                        ", ".join(f"{stage} {value:.0%}" for stage, value in utilisation.items()))
+
+            last_busy_time = self.busy_time.copy()
+            last_time = now
+
+    async def try_embed(self, posts: list[ClaimedPost]) -> tuple[str, Exception] | None:
+        """Embed posts, and return the stage and exception if this fails."""
+
+        stage = 'segment'
+        try:
+            segmented = await self.run_stage('segment', self.embedder.segment, [post.post_text for post in posts],
+                                             executor=self.segment_executor)
+
+            stage = 'encode'
+            await self.run_stage('encode', self.embedder.encode, segmented, executor=self.encode_executor)
+        except Exception as e:
+            return stage, e
+
+    async def exclude_failing_posts(self, claim: Claim, stage: str, error: Exception):
+        """
+        Exclude posts of a failed batch which fail to embed by themselves, and record why.
+
+        The remaining posts are released, such that they can be claimed again right away, without
+        counting the failed claim towards their maximum number of attempts. If no post fails by
+        itself, e.g., because the error was transient, all posts are released, and the claim does
+        count, such that a batch which keeps failing is eventually given up.
+        """
+
+        logger.error("Could not compute embeddings of a batch of %d posts, %s failed with %s: %s",
+                     len(claim.posts), stage, type(error).__name__, error)
+
+        failures = await find_failing_posts(self.try_embed, claim.posts, (stage, error))
+        failed_ids = {failure.post.id for failure in failures}
+
+        log_failures(failures)
+
+        async with async_session() as session:
+            await fail_posts(session, claim.id, failures)
+            await release_posts(session, claim.id, [post for post in claim.posts if post.id not in failed_ids],
+                                count_attempt=not failures)
             await session.commit()
 
+        POSTS_EXCLUDED.inc(len(failures))
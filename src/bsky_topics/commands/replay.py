@@ -0,0 +1,52 @@
+import asyncio
+
+import click
+from rich.table import Table
+
+from bsky_topics.commands import cli_main
+from bsky_topics.commands.collect import collector_options, create_collector
+from bsky_topics.replay import replay_into_collector, serve_frames
+
+
+@cli_main.command()
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.option('-s', '--speed', type=float, default=1.0,
+              help="Replay at N times real time. Use 0 to replay as fast as possible.")
+@click.option('--serve', metavar='HOST:PORT', default=None,
+              help="Serve frames from a local websocket server instead of feeding them directly into the "
+                   "collector. Point `ws_hostname` to e.g. ws://localhost:6008 to collect from it.")
+@collector_options
+@click.pass_context
+def replay(ctx, directory: str, speed: float, serve: str | None, **options):
+    """
+    Replay Jetstream traffic recorded with `collect --record`.
+
+    By default, recorded messages are fed straight into a collector, which writes posts to the
+    database, and reports throughput, write latency and catch-up time. If the traffic was recorded
+    with `--compress`, also specify `--compress` here.
+    """
+
+    console = ctx.obj['console']
+
+    if serve:
+        host, _, port = serve.rpartition(':')
+        asyncio.run(serve_frames(directory, host or 'localhost', int(port), speed))
+        return
+
+    # Use a separate checkpoint to not affect the cursor of a live collector
+    collector = create_collector(ctx, checkpoint_name="replay", **options)
+    result = asyncio.run(replay_into_collector(collector, directory, speed))
+
+    table = Table(title=f"Replay of {directory} at speed {speed:g}")
+    table.add_column("Metric")
+    table.add_column("Value", justify="right")
+
+    table.add_row("Messages", str(result.num_messages))
+    table.add_row("Posts inserted", str(result.num_inserted))
+    table.add_row("Elapsed (s)", f"{result.elapsed:.2f}")
+    table.add_row("Messages/s", f"{result.messages_per_sec:.0f}")
+    table.add_row("Write latency p50 (ms)", f"{result.write_latency_percentile(50) * 1000:.1f}")
+    table.add_row("Write latency p99 (ms)", f"{result.write_latency_percentile(99) * 1000:.1f}")
+    table.add_row("Catch-up time (s)", f"{result.catch_up_time:.2f}")
+
+    console.print(table)
@@ -0,0 +1,86 @@
+import asyncio
+from datetime import datetime, date, UTC
+
+import click
+import numpy
+from rich.table import Table
+
+from bsky_topics.commands import cli_main
+from bsky_topics.db.partitions import list_partitions
+from bsky_topics.snapshots import export_snapshots, snapshot_days, snapshot_paths
+
+
+@cli_main.group()
+def snapshot():
+    """Export post embeddings to memory-mapped files, to cluster them without the database."""
+    pass
+
+
+@snapshot.command()
+@click.argument('directory', type=click.Path(file_okay=False))
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="Export embeddings of posts created on or after this day. Defaults to the oldest partition.")
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="Export embeddings of posts created before this day. Defaults to today, such that only "
+                   "complete days are exported.")
+@click.option('-f', '--overwrite', is_flag=True, default=False,
+              help="Export days which already have a snapshot again, e.g., after backfilling embeddings.")
+@click.option('--recheck-days', type=int, default=7, show_default=True,
+              help="Export snapshots of the last N days again if their number of embeddings changed.")
+@click.pass_context
+def export(ctx, directory: str, since: datetime | None, until: datetime | None, overwrite: bool,
+           recheck_days: int):
+    """
+    Export embeddings of each day to DIRECTORY, skipping days exported before.
+
+    Run this daily, e.g., using cron, to keep the snapshots up to date. Embeddings written after
+    their day was exported, e.g., by lagging embed workers, are picked up by exporting recent days
+    again when their number of embeddings changed.
+    """
+
+    engine = ctx.obj['db_engine']
+    console = ctx.obj['console']
+
+    until = until.date() if until else datetime.now(UTC).date()
+    if since:
+        since = since.date()
+    else:
+        since = asyncio.run(oldest_partition_day(engine))
+
+    if since is None:
+        raise click.UsageError("No partitions to export, specify --since.")
+
+    exported = asyncio.run(export_snapshots(directory, since, until, overwrite, recheck_days))
+
+    console.print(f"Exported {sum(num_rows for _, num_rows in exported)} embeddings of {len(exported)} days "
+                  f"to {directory}.")
+
+
+@snapshot.command('list')
+@click.argument('directory', type=click.Path(exists=True, file_okay=False))
+@click.pass_context
+def list_snapshots(ctx, directory: str):
+    """Show the days exported to DIRECTORY, with their number of embeddings."""
+
+    console = ctx.obj['console']
+
+    table = Table(title=f"Snapshots in {directory}")
+    table.add_column("Day")
+    table.add_column("Embeddings", justify="right")
+    table.add_column("Size (MB)", justify="right")
+
+    for day in snapshot_days(directory):
+        ids_path, embeddings_path = snapshot_paths(directory, day)
+        num_rows = len(numpy.load(ids_path, mmap_mode='r'))
+        size = ids_path.stat().st_size + embeddings_path.stat().st_size
+
+        table.add_row(day.isoformat(), str(num_rows), f"{size / 2**20:.1f}")
+
+    console.print(table)
+
+
+async def oldest_partition_day(engine) -> date | None:
+    async with engine.connect() as conn:
+        partitions = await conn.run_sync(list_partitions, 'post_embeddings')
+
+    return partitions[0][1] if partitions else None
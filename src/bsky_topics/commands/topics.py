@@ -0,0 +1,178 @@
+import asyncio
+from datetime import datetime
+import logging
+
+import click
+from rich.table import Table
+from sqlalchemy import select, tuple_
+
+from bsky_topics.commands import cli_main
+from bsky_topics.db import async_session
+from bsky_topics.db.schema import Post, Topic
+from bsky_topics.topic_assignment import TopicAssigner, assign_existing_posts, topic_posts
+
+logger = logging.getLogger(__name__)
+
+
+@cli_main.group()
+def topics():
+    """Compute topics, and inspect the posts assigned to them."""
+    pass
+
+
+@topics.command()
+@click.argument('snapshots', type=click.Path(exists=True, file_okay=False))
+@click.option('--since', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="Only use snapshots of this day and later.")
+@click.option('--until', type=click.DateTime(formats=['%Y-%m-%d']), default=None,
+              help="Only use snapshots before this day.")
+@click.option('-k', '--centroids', type=int, default=10_000,
+              help="Number of fine-grained k-means centroids, which are clustered into topics.")
+@click.option('--min-topic-size', type=int, default=10, help="Minimum number of centroids of a topic.")
+@click.option('--assign-outliers', is_flag=True, default=False,
+              help="Assign posts HDBSCAN considers noise to the most similar topic.")
+@click.option('--epochs', type=int, default=1, help="Number of k-means passes over the embeddings.")
+@click.option('--checkpoint', type=click.Path(dir_okay=False), default=None,
+              help="Save k-means progress to this file, and resume from it if it exists.")
+@click.option('-n', '--num-keywords', type=int, default=10, help="Number of keywords to compute per topic.")
+@click.option('--save/--no-save', default=True,
+              help="Replace the topics assigned to new posts by the embed workers.")
+@click.pass_context
+def fit(ctx, snapshots: str, since: datetime | None, until: datetime | None, centroids: int, min_topic_size: int,
+        assign_outliers: bool, epochs: int, checkpoint: str | None, num_keywords: int, save: bool):
+    """
+    Compute topics of all posts in the embedding snapshots in SNAPSHOTS.
+
+    Posts are clustered into many centroids with k-means, and only the centroids are clustered
+    into topics with UMAP and HDBSCAN. Keywords are computed from post texts in the database.
+    """
+
+    # Loading the topic modeling libraries is slow, only do so when needed
+    from bsky_topics.topics import PostsDataset, TwoLevelTopics
+
+    console = ctx.obj['console']
+
+    dataset = PostsDataset.from_snapshots(snapshots, since.date() if since else None, until.date() if until else None)
+    logger.info("Clustering %d posts into %d centroids", len(dataset), centroids)
+
+    model = TwoLevelTopics(centroids, min_topic_size, assign_outliers=assign_outliers)
+    model.fit(dataset, epochs=epochs, checkpoint=checkpoint)
+
+    keywords, topic_ids = asyncio.run(fit_keywords(model, dataset, num_keywords, save))
+
+    table = Table(title=f"Topics of {len(dataset)} posts")
+    table.add_column("Topic", justify="right")
+    table.add_column("Posts", justify="right")
+    table.add_column("Keywords")
+
+    for topic_id, num_posts, topic_keywords in zip(topic_ids, model.topic_sizes, keywords):
+        table.add_row(str(topic_id), str(num_posts), ", ".join(topic_keywords))
+
+    console.print(table)
+
+    if save:
+        console.print(f"Saved {len(keywords)} topics, assign posts embedded before with `topics assign`.")
+
+
+async def fit_keywords(model, dataset, num_keywords: int, save: bool) -> tuple[list[list[str]], list[int]]:
+    """Compute the keywords of each topic, and the topic IDs, which are assigned when saved."""
+
+    keywords = await model.compute_keywords(dataset, num_keywords)
+    topic_ids = list(range(len(keywords)))
+
+    if save:
+        async with async_session() as session:
+            topic_ids = await model.save(session, keywords)
+            await session.commit()
+
+    return keywords, topic_ids
+
+
+@topics.command('list')
+@click.option('-k', '--num-keywords', type=int, default=8, help="Number of keywords to show per topic.")
+@click.pass_context
+def list_topics(ctx, num_keywords: int):
+    """Show all topics with their number of posts and keywords."""
+
+    console = ctx.obj['console']
+
+    table = Table(title="Topics")
+    table.add_column("Topic", justify="right")
+    table.add_column("Posts", justify="right")
+    table.add_column("Keywords")
+
+    for topic_id, num_posts, keywords in asyncio.run(load_topic_keywords()):
+        table.add_row(str(topic_id), str(num_posts), ", ".join(keywords[:num_keywords]))
+
+    console.print(table)
+
+
+async def load_topic_keywords() -> list[tuple[int, int, list[str]]]:
+    async with async_session() as session:
+        result = await session.execute(select(Topic.id, Topic.num_posts, Topic.keywords).order_by(Topic.id))
+
+        return [tuple(row) for row in result]
+
+
+@topics.command()
+@click.argument('topic_id', type=int)
+@click.option('-l', '--limit', type=int, default=20, help="Number of posts to show.")
+@click.pass_context
+def posts(ctx, topic_id: int, limit: int):
+    """Show the most recent posts assigned to TOPIC_ID."""
+
+    console = ctx.obj['console']
+
+    table = Table(title=f"Posts of topic {topic_id}")
+    table.add_column("Created at")
+    table.add_column("Text")
+
+    for created_at, text in asyncio.run(load_topic_posts(topic_id, limit)):
+        table.add_row(created_at.isoformat(timespec='seconds'), text)
+
+    console.print(table)
+
+
+async def load_topic_posts(topic_id: int, limit: int) -> list[tuple[datetime, str]]:
+    async with async_session() as session:
+        keys = await topic_posts(session, topic_id, limit)
+        if not keys:
+            return []
+
+        result = await session.execute(
+            select(Post.created_at, Post.post_text)
+            .where(tuple_(Post.id, Post.created_at).in_(keys))
+            .order_by(Post.created_at.desc())
+        )
+
+        return [tuple(row) for row in result]
+
+
+@topics.command()
+@click.option('--since', type=click.DateTime(), required=True,
+              help="Assign topics to posts created at or after this time (UTC).")
+@click.option('--until', type=click.DateTime(), required=True,
+              help="Assign topics to posts created before this time (UTC).")
+@click.option('-b', '--batch-size', type=int, default=10_000, help="Number of embeddings to assign per transaction.")
+@click.pass_context
+def assign(ctx, since: datetime, until: datetime, batch_size: int):
+    """
+    Assign topics to posts embedded before, e.g., after replacing the topics.
+
+    New posts are assigned a topic by the embed workers.
+    """
+
+    console = ctx.obj['console']
+
+    num_assigned = asyncio.run(assign_topics(since, until, batch_size))
+
+    console.print(f"Assigned topics to {num_assigned} posts.")
+
+
+async def assign_topics(since: datetime, until: datetime, batch_size: int) -> int:
+    async with async_session() as session:
+        assigner = await TopicAssigner.load(session)
+        if assigner is None:
+            raise click.ClickException("No topics to assign posts to.")
+
+        return await assign_existing_posts(session, assigner, since, until, batch_size)
@@ -15,7 +15,19 @@ class Config:
         if not loaded_config:
             loaded_config = {}
 
-        self.ws_hostname = loaded_config.get('ws_hostname', DEFAULT_WS_URL)
+        # One or more Jetstream instances to collect posts from
+        self.ws_hostnames = loaded_config.get('ws_hostname', DEFAULT_WS_URL)
+        if isinstance(self.ws_hostnames, str):
+            self.ws_hostnames = [self.ws_hostnames]
+        self.zstd_dictionary = loaded_config.get('zstd_dictionary')
+
+        # Rules determining which posts to store, see `bsky_topics.filters.PostFilter`
+        self.filters = loaded_config.get('filters', {})
+
+        # Daily partitions of posts and embeddings to create ahead of time, and the number of days
+        # to keep partitions. Partitions are kept forever if retention is not set.
+        self.partition_days_ahead = loaded_config.get('partitions', {}).get('days_ahead', 7)
+        self.retention_days = loaded_config.get('partitions', {}).get('retention_days')
         self.db_url = URL.create(
             "postgresql+asyncpg",
             username=loaded_config.get('postgres', {}).get('username'),
@@ -0,0 +1,73 @@
+"""
+Record deleted posts, and remove them from the database in bulk
+
+Deletions are first stored in `post_deletions`, and later applied to `posts` and
+`post_embeddings` with set-based deletes joining against it. Functions in this module do not
+commit, the caller is responsible for committing the session.
+"""
+
+from typing import Sequence
+
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bsky_topics.db.schema import Post, PostEmbedding, PostDeletion
+
+DELETION_COLUMNS = ['did', 'rkey', 'time_us']
+
+
+async def record_deletions(session: AsyncSession, rows: Sequence[dict]):
+    """Store deleted posts, keys in `rows` other than `DELETION_COLUMNS` are ignored."""
+
+    stmt = insert(PostDeletion).on_conflict_do_nothing()
+
+    await session.execute(stmt, [{c: row[c] for c in DELETION_COLUMNS} for row in rows])
+
+
+async def compact_deletions(session: AsyncSession, until_time_us: int, max_deletions: int = 10_000) -> tuple[int, int]:
+    """
+    Remove posts and embeddings of deletions received at or before `until_time_us`.
+
+    At most (approximately) `max_deletions` of the oldest deletions are applied, to limit the
+    size of the transaction. Applied deletions are removed from `post_deletions`.
+
+    Returns the number of applied deletions, and the number of removed posts.
+    """
+
+    # Lower the cutoff if there are more deletions to apply than allowed in a single pass
+    cutoff = await session.scalar(
+        select(PostDeletion.time_us)
+        .where(PostDeletion.time_us <= until_time_us)
+        .order_by(PostDeletion.time_us)
+        .offset(max_deletions - 1)
+        .limit(1)
+    )
+    if cutoff is not None:
+        until_time_us = cutoff
+
+    matches_deletion = (
+        Post.did == PostDeletion.did,
+        Post.rkey == PostDeletion.rkey,
+        PostDeletion.time_us <= until_time_us,
+    )
+
+    await session.execute(
+        delete(PostEmbedding)
+        .where(PostEmbedding.post_id == Post.id, PostEmbedding.post_created_at == Post.created_at,
+               *matches_deletion)
+    )
+
+    result = await session.execute(
+        delete(Post)
+        .where(*matches_deletion)
+        .returning(Post.id)
+    )
+    num_posts = len(result.all())
+
+    result = await session.execute(
+        delete(PostDeletion)
+        .where(PostDeletion.time_us <= until_time_us)
+    )
+
+    return result.rowcount, num_posts
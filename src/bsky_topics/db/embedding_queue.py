@@ -0,0 +1,292 @@
+"""
+Queue of posts waiting for an embedding, shared by concurrent embed workers
+
+Workers claim a batch of posts using `SELECT ... FOR UPDATE SKIP LOCKED`, such that concurrent
+workers never claim the same posts, and claiming takes the same time regardless of the size of
+the `posts` table. A claim is leased for a limited time: if a worker crashes, its posts can be
+claimed by another worker once the lease expires.
+
+Functions in this module do not commit, the caller is responsible for committing the session.
+Claims should be committed right away, such that other workers see them.
+"""
+
+from __future__ import annotations
+from datetime import datetime, timedelta
+from typing import NamedTuple, Sequence
+import uuid
+
+from sqlalchemy import Interval, select, insert, update, delete, func, literal, literal_column, or_, and_, tuple_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bsky_topics.db.schema import Post, EmbeddingTask, EmbeddingFailure
+
+DEFAULT_LEASE = timedelta(minutes=5)
+
+# Posts claimed this many times without completing are removed from the queue, and recorded as
+# failed in the `lease` stage. The partial indexes on `embedding_queue` depend on this value.
+MAX_ATTEMPTS = 5
+
+# Rendered as a constant rather than a parameter, such that the planner can use the partial indexes
+MAX_ATTEMPTS_SQL = literal_column(str(MAX_ATTEMPTS))
+
+
+class ClaimedPost(NamedTuple):
+    id: int
+    created_at: datetime
+    post_text: str
+
+
+class Claim(NamedTuple):
+    id: uuid.UUID
+    posts: list[ClaimedPost]
+
+
+class PostFailure(NamedTuple):
+    post: ClaimedPost
+    stage: str
+    error: BaseException
+
+
+def enqueue_stmt(inserted):
+    """
+    Build an `INSERT ... SELECT` adding posts to the queue, from a selectable with `id` and
+    `created_at` columns, e.g., a CTE of newly inserted posts.
+    """
+
+    return (insert(EmbeddingTask)
+            .from_select(['post_id', 'post_created_at', 'enqueued_at', 'attempts'],
+                         select(inserted.c.id, inserted.c.created_at, func.now(), 0)))
+
+
+async def enqueue_posts(session: AsyncSession, posts: Sequence[tuple[int, datetime]]):
+    """Add posts, given as (id, created_at) tuples, to the queue."""
+
+    if not posts:
+        return
+
+    await session.execute(insert(EmbeddingTask), [
+        {'post_id': post_id, 'post_created_at': created_at, 'attempts': 0}
+        for post_id, created_at in posts
+    ])
+
+
+async def claim_posts(session: AsyncSession, limit: int, lease: timedelta = DEFAULT_LEASE) -> Claim:
+    """
+    Claim up to `limit` posts, oldest first, which are not claimed by another worker.
+
+    Tasks of posts which no longer exist, or which are excluded from embedding, are removed from
+    the queue instead of returned. Tasks claimed `MAX_ATTEMPTS` times are removed as well, see
+    `fail_exhausted_posts`.
+    """
+
+    await fail_exhausted_posts(session, limit)
+
+    claim_id = uuid.uuid4()
+
+    claimable = (select(EmbeddingTask.post_id, EmbeddingTask.post_created_at)
+                 .where(or_(EmbeddingTask.leased_until.is_(None), EmbeddingTask.leased_until < func.now()),
+                        EmbeddingTask.attempts < MAX_ATTEMPTS_SQL)
+                 .order_by(EmbeddingTask.post_id)
+                 .limit(limit)
+                 .with_for_update(skip_locked=True)
+                 .cte('claimable'))
+
+    claimed = (update(EmbeddingTask)
+               .where(EmbeddingTask.post_id == claimable.c.post_id,
+                      EmbeddingTask.post_created_at == claimable.c.post_created_at)
+               .values(claim_id=claim_id, leased_until=func.now() + literal(lease, Interval()),
+                       attempts=EmbeddingTask.attempts + 1)
+               .returning(EmbeddingTask.post_id, EmbeddingTask.post_created_at)
+               .cte('claimed'))
+
+    stmt = (select(claimed.c.post_id, claimed.c.post_created_at, Post.post_text, Post.exclude_for_embedding)
+            .outerjoin(Post, and_(Post.id == claimed.c.post_id, Post.created_at == claimed.c.post_created_at))
+            .order_by(claimed.c.post_id))
+
+    posts = []
+    stale = []
+    for post_id, created_at, post_text, exclude in await session.execute(stmt):
+        if post_text is None or exclude:
+            stale.append((post_id, created_at))
+        else:
+            posts.append(ClaimedPost(post_id, created_at, post_text))
+
+    if stale:
+        await session.execute(
+            delete(EmbeddingTask)
+            .where(tuple_(EmbeddingTask.post_id, EmbeddingTask.post_created_at).in_(stale))
+        )
+
+    return Claim(claim_id, posts)
+
+
+async def complete_posts(session: AsyncSession, claim_id: uuid.UUID,
+                         posts: Sequence[ClaimedPost]) -> set[int]:
+    """
+    Remove posts from the queue, if still claimed by `claim_id`.
+
+    Returns the IDs of the removed posts. Posts missing from the result were claimed by another
+    worker after the lease expired, and their embeddings should not be stored.
+    """
+
+    if not posts:
+        return set()
+
+    result = await session.execute(
+        delete(EmbeddingTask)
+        .where(tuple_(EmbeddingTask.post_id, EmbeddingTask.post_created_at).in_(
+                   [(post.id, post.created_at) for post in posts]),
+               EmbeddingTask.claim_id == claim_id)
+        .returning(EmbeddingTask.post_id)
+    )
+
+    return set(result.scalars())
+
+
+async def release_posts(session: AsyncSession, claim_id: uuid.UUID, posts: Sequence[ClaimedPost],
+                        count_attempt: bool = False):
+    """
+    Release the claim on posts, such that they can be claimed again right away.
+
+    Unless `count_attempt` is set, the claim doesn't count towards `MAX_ATTEMPTS`, e.g., for posts
+    of a batch which failed because of other posts.
+    """
+
+    if not posts:
+        return
+
+    values = {'claim_id': None, 'leased_until': None}
+    if not count_attempt:
+        values['attempts'] = func.greatest(EmbeddingTask.attempts - 1, 0)
+
+    await session.execute(
+        update(EmbeddingTask)
+        .where(tuple_(EmbeddingTask.post_id, EmbeddingTask.post_created_at).in_(
+                   [(post.id, post.created_at) for post in posts]),
+               EmbeddingTask.claim_id == claim_id)
+        .values(**values)
+    )
+
+
+async def fail_posts(session: AsyncSession, claim_id: uuid.UUID, failures: Sequence[PostFailure]):
+    """
+    Remove posts from the queue, if still claimed by `claim_id`, and exclude them for embedding.
+
+    The stage and exception class of each failure are recorded in `embedding_failures`.
+    """
+
+    if not failures:
+        return
+
+    await exclude_failed_posts(session, failures)
+    await complete_posts(session, claim_id, [failure.post for failure in failures])
+
+
+async def exclude_failed_posts(session: AsyncSession, failures: Sequence[PostFailure]):
+    """Exclude posts for embedding, and record the failures, for posts which are not in the queue."""
+
+    if not failures:
+        return
+
+    await record_failures(session, [
+        {'post_id': failure.post.id, 'post_created_at': failure.post.created_at, 'stage': failure.stage,
+         'error': type(failure.error).__name__, 'message': str(failure.error)}
+        for failure in failures
+    ])
+
+
+async def fail_exhausted_posts(session: AsyncSession, limit: int) -> int:
+    """
+    Remove up to `limit` tasks claimed `MAX_ATTEMPTS` times without completing, of which the
+    last lease expired, and record them as failed in the `lease` stage. Returns the number of
+    removed tasks.
+
+    These posts repeatedly crashed or stalled the worker claiming them, e.g., by running out
+    of memory.
+    """
+
+    exhausted = (select(EmbeddingTask.post_id, EmbeddingTask.post_created_at)
+                 .where(EmbeddingTask.attempts >= MAX_ATTEMPTS_SQL,
+                        or_(EmbeddingTask.leased_until.is_(None), EmbeddingTask.leased_until < func.now()))
+                 .limit(limit)
+                 .with_for_update(skip_locked=True)
+                 .cte('exhausted'))
+
+    result = await session.execute(
+        delete(EmbeddingTask)
+        .where(EmbeddingTask.post_id == exhausted.c.post_id,
+               EmbeddingTask.post_created_at == exhausted.c.post_created_at)
+        .returning(EmbeddingTask.post_id, EmbeddingTask.post_created_at)
+    )
+    posts = result.all()
+
+    if posts:
+        await record_failures(session, [
+            {'post_id': post_id, 'post_created_at': created_at, 'stage': 'lease', 'error': 'AttemptsExhausted',
+             'message': f"Claimed {MAX_ATTEMPTS} times without completing"}
+            for post_id, created_at in posts
+        ])
+
+    return len(posts)
+
+
+async def record_failures(session: AsyncSession, failures: list[dict]):
+    """Record failures in `embedding_failures`, and exclude the failed posts for embedding."""
+
+    stmt = postgresql.insert(EmbeddingFailure)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[EmbeddingFailure.post_id, EmbeddingFailure.post_created_at],
+        set_={'stage': stmt.excluded.stage, 'error': stmt.excluded.error, 'message': stmt.excluded.message,
+              'failed_at': func.now()},
+    )
+
+    await session.execute(stmt, failures)
+
+    await session.execute(
+        update(Post)
+        .where(tuple_(Post.id, Post.created_at).in_([(f['post_id'], f['post_created_at']) for f in failures]))
+        .values(exclude_for_embedding=True)
+    )
+
+
+async def retry_failed_posts(session: AsyncSession, stage: str | None = None, error: str | None = None) -> int:
+    """
+    Add failed posts back to the queue, optionally only those that failed in `stage`, or with
+    exception class `error`. Returns the number of queued posts.
+    """
+
+    retried = (delete(EmbeddingFailure)
+               .returning(EmbeddingFailure.post_id, EmbeddingFailure.post_created_at))
+    if stage:
+        retried = retried.where(EmbeddingFailure.stage == stage)
+    if error:
+        retried = retried.where(EmbeddingFailure.error == error)
+
+    retried = retried.cte('retried')
+
+    included = (update(Post)
+                .where(Post.id == retried.c.post_id, Post.created_at == retried.c.post_created_at)
+                .values(exclude_for_embedding=False)
+                .returning(Post.id, Post.created_at)
+                .cte('included'))
+
+    result = await session.execute(enqueue_stmt(included).returning(EmbeddingTask.post_id))
+
+    return len(result.all())
+
+
+async def count_failures(session: AsyncSession) -> list[tuple[str, str, int]]:
+    """Number of failed posts by stage and exception class."""
+
+    result = await session.execute(
+        select(EmbeddingFailure.stage, EmbeddingFailure.error, func.count())
+        .group_by(EmbeddingFailure.stage, EmbeddingFailure.error)
+        .order_by(func.count().desc())
+    )
+
+    return [tuple(row) for row in result]
+
+
+async def count_queued(session: AsyncSession) -> int:
+    return await session.scalar(select(func.count()).select_from(EmbeddingTask))
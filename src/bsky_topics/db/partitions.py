@@ -0,0 +1,170 @@
+"""
+Manage daily range partitions of the `posts` and `post_embeddings` tables
+
+Functions in this module take a synchronous connection, use `AsyncConnection.run_sync` to call
+them from async code. Each day has a partition named `<table>_pYYYYMMDD`, covering
+`[day, day + 1)`. A default partition catches rows outside the created partitions, which are
+moved to the daily partition when it is created.
+"""
+
+from __future__ import annotations
+from datetime import date, datetime, timedelta
+import logging
+
+from sqlalchemy import Connection, text
+
+logger = logging.getLogger(__name__)
+
+# Partitioned tables, referenced tables first
+PARTITIONED_TABLES = ['posts', 'post_embeddings']
+
+# Partition key of each partitioned table
+PARTITION_KEYS = {'posts': 'created_at', 'post_embeddings': 'post_created_at'}
+
+# Name of the foreign key of `post_embeddings` referencing `posts`
+EMBEDDINGS_FKEY = 'post_embeddings_post_fkey'
+
+
+def partition_name(table: str, day: date) -> str:
+    return f"{table}_p{day:%Y%m%d}"
+
+
+def create_partitions(conn: Connection, start: date, end: date) -> list[str]:
+    """
+    Create daily partitions for all days in `[start, end]`, if they don't exist yet.
+
+    Postgres refuses to create a partition for a day with rows in the default partition, so
+    these rows are moved out of the default partition first, and into the new partition after.
+    This locks the default partitions until the transaction ends, so use a transaction per day
+    when the collector is running.
+    """
+
+    default_days = days_in_default_partitions(conn, start, end)
+
+    created = []
+    day = start
+    while day <= end:
+        if day in default_days:
+            logger.info("Moving rows of %s out of the default partitions", day)
+            moved = move_from_default_partitions(conn, day)
+
+        for table in PARTITIONED_TABLES:
+            name = partition_name(table, day)
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF {table} "
+                f"FOR VALUES FROM ('{day.isoformat()}') TO ('{(day + timedelta(days=1)).isoformat()}')"
+            ))
+            created.append(name)
+
+        if day in default_days:
+            for table in PARTITIONED_TABLES:
+                conn.execute(text(f"INSERT INTO {table} SELECT * FROM {moved[table]}"))
+                conn.execute(text(f"DROP TABLE {moved[table]}"))
+
+        day += timedelta(days=1)
+
+    return created
+
+
+def days_in_default_partitions(conn: Connection, start: date, end: date) -> set[date]:
+    """Days in `[start, end]` with rows in any of the default partitions."""
+
+    days = set()
+    for table in PARTITIONED_TABLES:
+        if conn.execute(text(f"SELECT to_regclass('{table}_default')")).scalar() is None:
+            continue
+
+        key = PARTITION_KEYS[table]
+        result = conn.execute(text(f"""
+            SELECT DISTINCT {key}::date FROM {table}_default WHERE {key} >= :start AND {key} < :end
+        """), {'start': start, 'end': end + timedelta(days=1)})
+
+        days.update(day for (day,) in result)
+
+    return days
+
+
+def move_from_default_partitions(conn: Connection, day: date) -> dict[str, str]:
+    """
+    Move rows of a day out of the default partitions into temporary tables, and return the name
+    of the temporary table of each partitioned table.
+    """
+
+    # Keep writers from adding rows for this day until the partitions are created
+    for table in PARTITIONED_TABLES:
+        conn.execute(text(f"LOCK TABLE {table}_default IN SHARE ROW EXCLUSIVE MODE"))
+
+    moved = {}
+    start, end = day, day + timedelta(days=1)
+
+    # Embeddings reference posts, so move them first
+    for table in reversed(PARTITIONED_TABLES):
+        key = PARTITION_KEYS[table]
+        moved[table] = f"moved_{partition_name(table, day)}"
+
+        conn.execute(text(f"CREATE TEMPORARY TABLE {moved[table]} (LIKE {table}_default)"))
+        conn.execute(text(f"""
+            WITH deleted AS (
+                DELETE FROM {table}_default WHERE {key} >= :start AND {key} < :end RETURNING *
+            )
+            INSERT INTO {moved[table]} SELECT * FROM deleted
+        """), {'start': start, 'end': end})
+
+    return moved
+
+
+def create_default_partitions(conn: Connection):
+    for table in PARTITIONED_TABLES:
+        conn.execute(text(f"CREATE TABLE IF NOT EXISTS {table}_default PARTITION OF {table} DEFAULT"))
+
+
+def list_partitions(conn: Connection, table: str) -> list[tuple[str, date]]:
+    """List daily partitions of a table, oldest first. Excludes the default partition."""
+
+    result = conn.execute(text("""
+        SELECT child.relname
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relname = :table
+    """), {'table': table})
+
+    partitions = []
+    prefix = f"{table}_p"
+    for (name,) in result:
+        if name.startswith(prefix):
+            partitions.append((name, datetime.strptime(name.removeprefix(prefix), "%Y%m%d").date()))
+
+    return sorted(partitions, key=lambda p: p[1])
+
+
+def prune_partitions(conn: Connection, before: date, archive: bool = False) -> list[str]:
+    """
+    Remove daily partitions of days before `before`.
+
+    If `archive` is True, partitions are detached and renamed to `archive_<partition>` instead of
+    dropped, such that they can be dumped or queried separately.
+    """
+
+    removed = []
+    for table in reversed(PARTITIONED_TABLES):
+        for name, day in list_partitions(conn, table):
+            if day >= before:
+                continue
+
+            conn.execute(text(f"ALTER TABLE {table} DETACH PARTITION {name}"))
+
+            if archive:
+                # The detached embeddings keep their foreign key to `posts`, which would prevent
+                # detaching the posts partition.
+                if table == 'post_embeddings':
+                    conn.execute(text(f"ALTER TABLE {name} DROP CONSTRAINT IF EXISTS {EMBEDDINGS_FKEY}"))
+
+                conn.execute(text(f"ALTER TABLE {name} RENAME TO archive_{name}"))
+            else:
+                conn.execute(text(f"DROP TABLE {name}"))
+
+            logger.info("%s partition %s", "Archived" if archive else "Dropped", name)
+            removed.append(name)
+
+    return removed
@@ -1,23 +1,56 @@
 from datetime import datetime
 from typing import Optional
+import uuid
 
-from sqlalchemy import String, Boolean, ForeignKey, Index, func
+import numpy
+from sqlalchemy import (String, Text, Boolean, BigInteger, DateTime, LargeBinary, ForeignKeyConstraint, Index, Table,
+                        Column, TypeDecorator, REAL, Sequence, func)
 from sqlalchemy.schema import UniqueConstraint
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 from sqlalchemy.ext.asyncio import AsyncAttrs
 from sqlalchemy.dialects.postgresql import ARRAY
 
-from pgvector.sqlalchemy import Vector
+from pgvector import HalfVector
+from pgvector.sqlalchemy import Vector, HALFVEC
 
 
 class Base(AsyncAttrs, DeclarativeBase):
     pass
 
 
+class HalfVec(TypeDecorator):
+    """
+    pgvector `halfvec`, a vector of 16-bit floats. Loaded as float32 numpy arrays, like `Vector`.
+    """
+
+    impl = HALFVEC
+    cache_ok = True
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+
+        # Depending on the version, pgvector returns a list or a `HalfVector`
+        if isinstance(value, HalfVector):
+            value = value.to_numpy()
+
+        return numpy.asarray(value, dtype=numpy.float32)
+
+
 class Post(Base):
+    """
+    A BlueSky post.
+
+    The table is partitioned by day on `created_at`, see `bsky_topics.db.partitions`. Unlike
+    `indexed_at`, `created_at` is derived from the record key, such that a post received twice
+    ends up in the same partition, and the unique constraint on (did, rkey, created_at) skips
+    duplicates.
+    """
+
     __tablename__ = 'posts'
 
-    id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    created_at: Mapped[datetime] = mapped_column(primary_key=True)
     did: Mapped[str] = mapped_column(String(255))
     rkey: Mapped[str] = mapped_column(String(100))
     cid: Mapped[str] = mapped_column(String(255))
@@ -27,24 +60,188 @@ class Post(Base):
     exclude_for_embedding: Mapped[Optional[bool]] = mapped_column(Boolean(), default=False)
 
     __table_args__ = (
-        UniqueConstraint('did', 'rkey', name='did_record_key'),
+        UniqueConstraint('did', 'rkey', 'created_at', name='did_record_key'),
+        {'postgresql_partition_by': 'RANGE (created_at)'},
     )
 
 
+class IngestCheckpoint(Base):
+    """
+    Highest Jetstream event time (microseconds since Unix epoch) of which all posts are committed.
+
+    Updated in the same transaction as each batch of posts, and used as cursor when
+    (re)connecting to Jetstream.
+    """
+
+    __tablename__ = 'ingest_checkpoints'
+
+    name: Mapped[str] = mapped_column(String(100), primary_key=True)
+    time_us: Mapped[int] = mapped_column(BigInteger())
+    updated_at: Mapped[datetime] = mapped_column(insert_default=func.now())
+
+
+class PostDeletion(Base):
+    """
+    A post deleted by its author, to be removed together with its embedding.
+
+    The collector records deletions as they are received, and periodically removes matching
+    posts in bulk, see `bsky_topics.db.deletions`. The deletion is kept until all posts
+    received before it are written, such that a post still queued for writing is removed as
+    well.
+    """
+
+    __tablename__ = 'post_deletions'
+
+    did: Mapped[str] = mapped_column(String(255), primary_key=True)
+    rkey: Mapped[str] = mapped_column(String(100), primary_key=True)
+    time_us: Mapped[int] = mapped_column(BigInteger(), index=True)
+
+
+# Unlogged table used by the COPY-based post writer. Rows are moved into `posts` in the same
+# transaction they are copied in, so this table is always empty outside a transaction.
+posts_staging = Table(
+    'posts_staging',
+    Base.metadata,
+    Column('did', String(255), nullable=False),
+    Column('rkey', String(100), nullable=False),
+    Column('cid', String(255), nullable=False),
+    Column('post_text', Text(), nullable=False),
+    Column('language', ARRAY(String(8))),
+    Column('created_at', DateTime(), nullable=False),
+    prefixes=['UNLOGGED'],
+)
+
+
 class PostEmbedding(Base):
+    """
+    Embedding of a post, partitioned by day on the `created_at` of the post.
+
+    Embeddings are stored in half precision, see `bsky_topics.db.search` for similarity search.
+    Posts are assigned the topic with the nearest centroid when embedded, with the cosine
+    distance to the centroid, see `bsky_topics.topic_assignment`.
+    """
+
     __tablename__ = 'post_embeddings'
 
-    id: Mapped[int] = mapped_column(primary_key=True)
-    post_id: Mapped[int] = mapped_column(ForeignKey('posts.id'))
-    embedding: Mapped[list] = mapped_column(Vector(384))
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    post_created_at: Mapped[datetime] = mapped_column(primary_key=True)
+    post_id: Mapped[int]
+    embedding: Mapped[list] = mapped_column(HalfVec(384))
+    topic_id: Mapped[Optional[int]]
+    topic_distance: Mapped[Optional[float]] = mapped_column(REAL)
 
     post: Mapped[Post] = relationship()
 
+    __table_args__ = (
+        ForeignKeyConstraint(['post_id', 'post_created_at'], ['posts.id', 'posts.created_at'],
+                             name='post_embeddings_post_fkey'),
+        {'postgresql_partition_by': 'RANGE (post_created_at)'},
+    )
+
+
+class EmbeddingTask(Base):
+    """
+    A post waiting for its embedding to be computed.
+
+    Post writers add new posts to this queue. Embed workers claim posts for a limited time (the
+    lease), and remove them once their embeddings are stored, see `bsky_topics.db.embedding_queue`.
+    The post is not referenced by a foreign key, such that posts can be deleted or their
+    partitions dropped independently, tasks of missing posts are removed when claimed.
+    """
+
+    __tablename__ = 'embedding_queue'
+
+    post_id: Mapped[int] = mapped_column(primary_key=True)
+    post_created_at: Mapped[datetime] = mapped_column(primary_key=True)
+    enqueued_at: Mapped[datetime] = mapped_column(insert_default=func.now())
+
+    # Set when claimed by a worker, the claim expires at `leased_until`
+    claim_id: Mapped[Optional[uuid.UUID]]
+    leased_until: Mapped[Optional[datetime]]
+    attempts: Mapped[int] = mapped_column(default=0)
+
+
+class EmbeddingFailure(Base):
+    """
+    Why computing the embedding of a post failed.
+
+    Failed posts are excluded for embedding. The failure is recorded by the stage of the embed
+    pipeline, and the class of the raised exception, such that posts can be retried by failure
+    class once the cause is fixed.
+    """
+
+    __tablename__ = 'embedding_failures'
+
+    post_id: Mapped[int] = mapped_column(primary_key=True)
+    post_created_at: Mapped[datetime] = mapped_column(primary_key=True)
+    stage: Mapped[str] = mapped_column(String(20))
+    error: Mapped[str] = mapped_column(String(100), index=True)
+    message: Mapped[str] = mapped_column(Text)
+    failed_at: Mapped[datetime] = mapped_column(insert_default=func.now())
+
+
+# Topic IDs are never reused, see `Topic`
+topic_id_seq = Sequence('topic_id_seq', metadata=Base.metadata)
+
+
+class Topic(Base):
+    """
+    A topic, represented by the centroid of the embeddings of its posts, and its keywords.
+
+    Not referenced by a foreign key from `post_embeddings`, such that topics can be replaced by
+    a new topic model without rewriting all embeddings. The topics of a new model get new IDs
+    from `topic_id_seq`, such that embeddings assigned to a replaced topic don't end up in an
+    unrelated topic. They refer to a missing topic until assigned again.
+    """
+
+    __tablename__ = 'topics'
+
+    id: Mapped[int] = mapped_column(topic_id_seq, primary_key=True)
+    centroid: Mapped[list] = mapped_column(Vector(384))
+    keywords: Mapped[list[str]] = mapped_column(ARRAY(Text), default=list)
+    num_posts: Mapped[int] = mapped_column(BigInteger, default=0)
+    updated_at: Mapped[datetime] = mapped_column(insert_default=func.now())
+
+
+class CachedEmbedding(Base):
+    """
+    Embedding of a post text seen multiple times, see `bsky_topics.embedding_cache`.
+
+    Old embeddings are removed with `bsky-topics db cache prune`, texts still repeated are stored
+    again once seen twice by a worker.
+    """
+
+    __tablename__ = 'embedding_cache'
+
+    text_hash: Mapped[bytes] = mapped_column(LargeBinary(16), primary_key=True)
+    embedding: Mapped[list] = mapped_column(Vector(384))
+    created_at: Mapped[datetime] = mapped_column(insert_default=func.now(), index=True)
+
 
 embedding_index = Index(
     'post_embedding_idx',
     PostEmbedding.embedding,
     postgresql_using='hnsw',
     postgresql_with={'m': 16, 'ef_construction': 64},
-    postgresql_ops={'embedding': 'vector_cosine_ops'}
+    postgresql_ops={'embedding': 'halfvec_cosine_ops'}
+)
+
+# Partial indexes on tasks claimed fewer than `MAX_ATTEMPTS` times and on exhausted tasks, see
+# `bsky_topics.db.embedding_queue`, such that claiming doesn't scan past exhausted tasks.
+claimable_task_index = Index(
+    'embedding_queue_claimable_idx',
+    EmbeddingTask.post_id,
+    postgresql_where=EmbeddingTask.attempts < 5,
+)
+
+exhausted_task_index = Index(
+    'embedding_queue_exhausted_idx',
+    EmbeddingTask.leased_until,
+    postgresql_where=EmbeddingTask.attempts >= 5,
+)
+
+topic_index = Index(
+    'post_embedding_topic_idx',
+    PostEmbedding.topic_id,
+    PostEmbedding.post_created_at.desc(),
 )
@@ -0,0 +1,97 @@
+"""
+Find posts with similar embeddings
+
+Embeddings are stored in half precision, with an HNSW index on cosine distance. Optionally, a
+second, much smaller HNSW index on binary quantized embeddings (one bit per dimension) is used
+to shortlist candidates by Hamming distance, which are then re-ranked by cosine distance of the
+stored embeddings. The binary index is faster to build and more of it fits in memory, at the
+cost of some recall, which re-ranking a larger shortlist recovers.
+"""
+
+from __future__ import annotations
+from datetime import datetime
+from typing import NamedTuple
+
+import numpy
+from sqlalchemy import Connection, select, cast, func, text
+from sqlalchemy.ext.asyncio import AsyncSession
+from pgvector.sqlalchemy import BIT
+
+from bsky_topics.db.schema import HalfVec, PostEmbedding
+
+EMBEDDING_DIM = 384
+BINARY_INDEX_NAME = 'post_embedding_binary_idx'
+
+# Upper limit of `hnsw.ef_search`
+MAX_EF_SEARCH = 1000
+
+
+class SimilarPost(NamedTuple):
+    post_id: int
+    post_created_at: datetime
+    distance: float
+
+
+def binary_quantize(embedding):
+    """SQL expression of the binary quantized form of `embedding`, same as in the binary index."""
+    return cast(func.binary_quantize(embedding), BIT(EMBEDDING_DIM))
+
+
+def create_binary_index(conn: Connection):
+    """Create the HNSW index on binary quantized embeddings, for each partition."""
+
+    conn.execute(text(f"""
+        CREATE INDEX IF NOT EXISTS {BINARY_INDEX_NAME} ON post_embeddings
+        USING hnsw ((binary_quantize(embedding)::bit({EMBEDDING_DIM})) bit_hamming_ops)
+        WITH (m = 16, ef_construction = 64)
+    """))
+
+
+def drop_binary_index(conn: Connection):
+    conn.execute(text(f"DROP INDEX IF EXISTS {BINARY_INDEX_NAME}"))
+
+
+async def similar_posts(session: AsyncSession, embedding: numpy.ndarray, limit: int = 10, rerank: int | None = None,
+                        since: datetime | None = None, until: datetime | None = None) -> list[SimilarPost]:
+    """
+    Find the `limit` posts with the embeddings closest to `embedding` by cosine distance,
+    optionally restricted to posts created in [`since`, `until`).
+
+    If `rerank` is given, `rerank * limit` candidates are shortlisted using the binary index,
+    which must exist, and re-ranked by cosine distance. Otherwise, the regular HNSW index is used.
+    """
+
+    query = cast(numpy.asarray(embedding, dtype=numpy.float32), HalfVec(EMBEDDING_DIM))
+
+    filters = []
+    if since:
+        filters.append(PostEmbedding.post_created_at >= since)
+    if until:
+        filters.append(PostEmbedding.post_created_at < until)
+
+    if rerank:
+        num_candidates = limit * rerank
+
+        # The index scan returns at most `ef_search` rows
+        await session.execute(text(f"SET LOCAL hnsw.ef_search = {min(max(num_candidates, 40), MAX_EF_SEARCH)}"))
+
+        candidates = (select(PostEmbedding.post_id, PostEmbedding.post_created_at, PostEmbedding.embedding)
+                      .where(*filters)
+                      .order_by(binary_quantize(PostEmbedding.embedding).hamming_distance(binary_quantize(query)))
+                      .limit(num_candidates)
+                      .subquery('candidates'))
+
+        distance = candidates.c.embedding.cosine_distance(query)
+        stmt = (select(candidates.c.post_id, candidates.c.post_created_at, distance)
+                .order_by(distance)
+                .limit(limit))
+    else:
+        distance = PostEmbedding.embedding.cosine_distance(query)
+        stmt = (select(PostEmbedding.post_id, PostEmbedding.post_created_at, distance)
+                .where(*filters)
+                .order_by(distance)
+                .limit(limit))
+
+    result = await session.execute(stmt)
+
+    return [SimilarPost(*row) for row in result]
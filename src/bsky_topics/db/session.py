@@ -1,3 +1,5 @@
+import asyncpg
+from sqlalchemy import text
 from sqlalchemy.ext.asyncio import async_sessionmaker
 from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.ext.asyncio import create_async_engine
@@ -12,3 +14,20 @@ def configure_db(db_url: str, *args, **kwargs):
     async_session.configure(bind=engine)
 
     return engine
+
+
+async def get_driver_connection(session: AsyncSession) -> asyncpg.Connection:
+    """
+    Obtain the asyncpg connection underlying a session, e.g., to use COPY.
+
+    SQLAlchemy's asyncpg adapter only issues BEGIN when executing the first statement, so we
+    execute a no-op first to ensure anything run on the raw connection is part of the
+    session transaction.
+    """
+
+    await session.execute(text("SELECT 1"))
+
+    conn = await session.connection()
+    raw_conn = await conn.get_raw_connection()
+
+    return raw_conn.driver_connection
@@ -0,0 +1,216 @@
+"""
+Strategies to write batches of collected posts, and of post embeddings, to the database
+"""
+
+from datetime import datetime
+from typing import Sequence
+
+import asyncpg
+import numpy
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bsky_topics.db.embedding_queue import enqueue_posts, enqueue_stmt
+from bsky_topics.db.session import get_driver_connection
+from bsky_topics.db.schema import Post, PostEmbedding, EmbeddingTask, posts_staging
+from bsky_topics.topic_assignment import TopicAssignment
+
+POST_COLUMNS = ['did', 'rkey', 'cid', 'post_text', 'language', 'created_at']
+EMBEDDING_COLUMNS = ['post_id', 'post_created_at', 'embedding']
+TOPIC_COLUMNS = ['topic_id', 'topic_distance']
+
+# Binary COPY format, see https://www.postgresql.org/docs/current/sql-copy.html#id-1.9.3.55.9.4
+COPY_HEADER = b'PGCOPY\n\xff\r\n\0' + (0).to_bytes(4, 'big') + (0).to_bytes(4, 'big')
+COPY_TRAILER = (-1).to_bytes(2, 'big', signed=True)
+POSTGRES_EPOCH = numpy.datetime64('2000-01-01T00:00:00', 'us')
+
+
+class PostWriter:
+    """
+    Base class for writing a batch of posts as part of a session transaction.
+
+    Writers do not commit, the caller is responsible for committing the session. Posts that
+    already exist in the database are skipped. Keys in `rows` other than `POST_COLUMNS` are
+    ignored. Newly inserted posts are added to the embedding queue in the same transaction.
+    """
+
+    async def write(self, session: AsyncSession, rows: Sequence[dict]) -> list[int]:
+        """Write posts and return the IDs of newly inserted posts."""
+        raise NotImplementedError
+
+
+class InsertPostWriter(PostWriter):
+    """
+    Write posts using a multi-row `INSERT ... ON CONFLICT DO NOTHING` statement.
+    """
+
+    async def write(self, session: AsyncSession, rows: Sequence[dict]) -> list[int]:
+        stmt = (insert(Post)
+                .on_conflict_do_nothing()
+                .returning(Post.id, Post.created_at))
+
+        result = await session.execute(stmt, [{c: row[c] for c in POST_COLUMNS} for row in rows])
+        inserted = [tuple(post) for post in result]
+
+        await enqueue_posts(session, inserted)
+
+        return [post_id for post_id, _ in inserted]
+
+
+class CopyPostWriter(PostWriter):
+    """
+    Write posts using binary COPY into an unlogged staging table.
+
+    Rows are streamed with asyncpg's `copy_records_to_table` into `posts_staging`, and
+    subsequently moved into `posts` with a single `DELETE ... RETURNING` / `INSERT ... ON
+    CONFLICT DO NOTHING` statement, which also adds the inserted posts to the embedding queue.
+    Staged rows are only visible to the current transaction, so multiple writers can use the
+    staging table concurrently.
+    """
+
+    def __init__(self):
+        moved = (delete(posts_staging)
+                 .returning(*posts_staging.c)
+                 .cte('moved'))
+
+        inserted = (insert(Post)
+                    .from_select(POST_COLUMNS, select(*(moved.c[c] for c in POST_COLUMNS)))
+                    .on_conflict_do_nothing()
+                    .returning(Post.id, Post.created_at)
+                    .cte('inserted'))
+
+        self.merge_stmt = (enqueue_stmt(inserted)
+                           .returning(EmbeddingTask.post_id))
+
+    async def write(self, session: AsyncSession, rows: Sequence[dict]) -> list[int]:
+        conn: asyncpg.Connection = await get_driver_connection(session)
+
+        await conn.copy_records_to_table(
+            posts_staging.name,
+            records=[tuple(row[c] for c in POST_COLUMNS) for row in rows],
+            columns=POST_COLUMNS,
+        )
+
+        result = await session.execute(self.merge_stmt)
+
+        return list(result.scalars())
+
+
+WRITE_MODES: dict[str, type[PostWriter]] = {
+    'insert': InsertPostWriter,
+    'copy': CopyPostWriter,
+}
+
+
+class EmbeddingWriter:
+    """
+    Base class for writing a batch of post embeddings as part of a session transaction.
+
+    Writers do not commit, the caller is responsible for committing the session. Posts are
+    given as (id, created_at) tuples, with the embedding of post `i` in row `i` of `embeddings`.
+    If `topics` is given, the assigned topic of each post is stored as well.
+    """
+
+    async def write(self, session: AsyncSession, posts: Sequence[tuple[int, datetime]],
+                    embeddings: numpy.ndarray, topics: TopicAssignment | None = None) -> int:
+        """Write embeddings and return the number of written rows."""
+        raise NotImplementedError
+
+
+class InsertEmbeddingWriter(EmbeddingWriter):
+    """
+    Write embeddings using a multi-row `INSERT`, which sends each vector in pgvector's text format.
+    """
+
+    async def write(self, session: AsyncSession, posts: Sequence[tuple[int, datetime]],
+                    embeddings: numpy.ndarray, topics: TopicAssignment | None = None) -> int:
+        if not posts:
+            return 0
+
+        rows = [
+            {'post_id': post_id, 'post_created_at': created_at, 'embedding': embedding}
+            for (post_id, created_at), embedding in zip(posts, embeddings)
+        ]
+
+        if topics:
+            for row, topic_id, distance in zip(rows, *topics):
+                row['topic_id'] = int(topic_id)
+                row['topic_distance'] = float(distance)
+
+        await session.execute(insert(PostEmbedding), rows)
+
+        return len(posts)
+
+
+class CopyEmbeddingWriter(EmbeddingWriter):
+    """
+    Write embeddings using binary COPY into `post_embeddings`.
+
+    Vectors are sent in pgvector's binary `halfvec` format, which avoids formatting and parsing
+    each vector as text. The COPY data of a whole batch is built at once with numpy.
+    """
+
+    async def write(self, session: AsyncSession, posts: Sequence[tuple[int, datetime]],
+                    embeddings: numpy.ndarray, topics: TopicAssignment | None = None) -> int:
+        if not posts:
+            return 0
+
+        conn: asyncpg.Connection = await get_driver_connection(session)
+
+        await conn.copy_to_table(
+            PostEmbedding.__tablename__,
+            source=embedding_copy_data(posts, embeddings, topics),
+            columns=EMBEDDING_COLUMNS + (TOPIC_COLUMNS if topics else []),
+            format='binary',
+        )
+
+        return len(posts)
+
+
+def embedding_copy_data(posts: Sequence[tuple[int, datetime]], embeddings: numpy.ndarray,
+                        topics: TopicAssignment | None = None) -> bytes:
+    """Encode rows of `EMBEDDING_COLUMNS`, followed by `TOPIC_COLUMNS` if given, in the binary COPY format."""
+
+    embeddings = numpy.asarray(embeddings)
+    dim = embeddings.shape[1]
+
+    # Each field is prefixed with its length in bytes
+    fields = [
+        ('num_fields', '>i2'),
+        ('post_id_size', '>i4'), ('post_id', '>i4'),
+        ('created_at_size', '>i4'), ('created_at', '>i8'),
+        ('embedding_size', '>i4'), ('dim', '>u2'), ('unused', '>u2'), ('embedding', '>f2', (dim,)),
+    ]
+    if topics:
+        fields += [('topic_id_size', '>i4'), ('topic_id', '>i4'), ('topic_distance_size', '>i4'),
+                   ('topic_distance', '>f4')]
+
+    rows = numpy.empty(len(posts), dtype=numpy.dtype(fields))
+    rows['num_fields'] = len(EMBEDDING_COLUMNS) + (len(TOPIC_COLUMNS) if topics else 0)
+    rows['post_id_size'] = 4
+    rows['post_id'] = [post_id for post_id, _ in posts]
+
+    # Timestamps are microseconds since 2000-01-01
+    rows['created_at_size'] = 8
+    created_at = numpy.array([created_at for _, created_at in posts], dtype='datetime64[us]')
+    rows['created_at'] = (created_at - POSTGRES_EPOCH).astype(numpy.int64)
+
+    rows['embedding_size'] = 4 + 2 * dim
+    rows['dim'] = dim
+    rows['unused'] = 0
+    rows['embedding'] = embeddings
+
+    if topics:
+        rows['topic_id_size'] = 4
+        rows['topic_id'] = topics.topic_ids
+        rows['topic_distance_size'] = 4
+        rows['topic_distance'] = topics.distances
+
+    return COPY_HEADER + rows.tobytes() + COPY_TRAILER
+
+
+EMBEDDING_WRITE_MODES: dict[str, type[EmbeddingWriter]] = {
+    'insert': InsertEmbeddingWriter,
+    'copy': CopyEmbeddingWriter,
+}
@@ -0,0 +1,167 @@
+"""
+`bsky_topics.embedding_cache` - Reuse embeddings of posts with the same text
+
+Many posts repeat the same text, e.g., greetings, bots and spam. Embeddings are cached by a hash
+of the normalized post text, in two tiers: an in-process LRU cache, and the `embedding_cache`
+table shared by all embed workers. Embeddings stored before a given time are removed from the
+table with `prune_cache`.
+"""
+
+from __future__ import annotations
+from collections import OrderedDict
+from datetime import datetime
+import hashlib
+import re
+from typing import Iterable
+
+import numpy
+from sqlalchemy import select, delete
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bsky_topics.db.schema import CachedEmbedding
+
+WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Normalize whitespace, which does not affect the embedding."""
+    return WHITESPACE.sub(" ", text).strip()
+
+
+class EmbeddingCache:
+    """
+    Two-tier cache of post embeddings, keyed by a hash of the normalized post text.
+
+    The in-process LRU tier holds up to `max_size` recently computed or used embeddings. To not
+    store an embedding for every post, an embedding is only stored in the table once its text is
+    seen a second time, i.e., on a hit in the LRU tier.
+
+    The `namespace` is included in the hash, and should identify the models and settings used to
+    compute embeddings, such that embeddings computed differently are never mixed.
+    """
+
+    def __init__(self, namespace: str, max_size: int = 50_000):
+        self.namespace: bytes = namespace.encode()
+        self.max_size: int = max_size
+
+        # Embeddings by key, and whether the embedding is stored in the table
+        self.entries: OrderedDict[bytes, tuple[numpy.ndarray, bool]] = OrderedDict()
+
+        # Embeddings to store in the table on the next call to `persist()`
+        self.pending: dict[bytes, numpy.ndarray] = {}
+
+    def key(self, text: str) -> bytes:
+        return hashlib.blake2b(self.namespace + b'\0' + normalize_text(text).encode(), digest_size=16).digest()
+
+    def get(self, key: bytes) -> numpy.ndarray | None:
+        """Look up an embedding in the LRU tier."""
+
+        entry = self.entries.get(key)
+        if entry is None:
+            return
+
+        self.entries.move_to_end(key)
+
+        embedding, persisted = entry
+        if not persisted:
+            self.pending[key] = embedding
+            self.entries[key] = (embedding, True)
+
+        return embedding
+
+    def put(self, key: bytes, embedding: numpy.ndarray, persisted: bool = False, repeated: bool = False):
+        """
+        Add an embedding to the LRU tier. If `repeated`, its text was seen more than once, and the
+        embedding is stored in the table as well.
+        """
+
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return
+
+        if repeated and not persisted:
+            self.pending[key] = embedding
+            persisted = True
+
+        self.entries[key] = (embedding, persisted)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def lookup(self, session: AsyncSession,
+                     keys: Iterable[bytes]) -> tuple[dict[bytes, numpy.ndarray], set[bytes]]:
+        """
+        Look up embeddings, first in the LRU tier, then in the table.
+
+        Returns the found embeddings, and the keys found in the LRU tier.
+        """
+
+        found = {}
+        missing = []
+        for key in set(keys):
+            embedding = self.get(key)
+            if embedding is None:
+                missing.append(key)
+            else:
+                found[key] = embedding
+
+        memory_hits = set(found)
+
+        if missing:
+            result = await session.execute(
+                select(CachedEmbedding.text_hash, CachedEmbedding.embedding)
+                .where(CachedEmbedding.text_hash.in_(missing))
+            )
+
+            for key, embedding in result:
+                found[key] = embedding
+                self.put(key, embedding, persisted=True)
+
+        return found, memory_hits
+
+    async def persist(self, session: AsyncSession) -> list[bytes]:
+        """
+        Store embeddings of texts seen more than once in the table, as part of the session transaction.
+
+        Returns the keys of the stored embeddings, pass them to `committed()` once the transaction is
+        committed. If it fails, the embeddings are stored again on the next call.
+        """
+
+        if not self.pending:
+            return []
+
+        keys = list(self.pending)
+
+        stmt = insert(CachedEmbedding).on_conflict_do_nothing()
+        await session.execute(stmt, [
+            {'text_hash': key, 'embedding': self.pending[key]} for key in keys
+        ])
+
+        return keys
+
+    def committed(self, keys: Iterable[bytes]):
+        """Remove embeddings stored by a committed transaction from the pending embeddings."""
+
+        for key in keys:
+            self.pending.pop(key, None)
+
+
+async def prune_cache(session: AsyncSession, before: datetime, limit: int = 10_000) -> int:
+    """
+    Remove up to `limit` embeddings stored in the table before `before`. Returns the number of
+    removed embeddings. Does not commit.
+    """
+
+    expired = (select(CachedEmbedding.text_hash)
+               .where(CachedEmbedding.created_at < before)
+               .limit(limit)
+               .scalar_subquery())
+
+    result = await session.execute(
+        delete(CachedEmbedding)
+        .where(CachedEmbedding.text_hash.in_(expired))
+        .returning(CachedEmbedding.text_hash)
+    )
+
+    return len(result.all())
@@ -3,15 +3,156 @@ Tools to calculate BlueSky post embeddings
 """
 
 from __future__ import annotations
+from dataclasses import dataclass
 import logging
+from pathlib import Path
+import platform
+import shutil
 
-import torch
 import numpy
+import torch
 from wtpsplit import SaT
 from sentence_transformers import SentenceTransformer
 
+from bsky_topics.metrics import EMBED_STAGE_SECONDS
+
 logger = logging.getLogger(__name__)
 
+SAT_MODEL = "sat-3l-sm"
+TRANSFORMER_MODEL = "all-MiniLM-L6-v2"
+
+BACKENDS = ['torch', 'onnx', 'onnx-int8']
+
+# Quantized models exported by this package are stored here
+MODEL_CACHE_DIR = Path.home() / ".cache" / "bsky_topics"
+
+
+def detect_device() -> str:
+    """Pick the fastest available PyTorch device."""
+
+    if torch.cuda.is_available():
+        return 'cuda'
+    elif torch.backends.mps.is_available():
+        return 'mps'
+    else:
+        return 'cpu'
+
+
+def ort_providers(device: str) -> list[str]:
+    """ONNX Runtime execution providers to use for a PyTorch device name."""
+
+    import onnxruntime
+
+    if device.startswith('cuda') and 'CUDAExecutionProvider' in onnxruntime.get_available_providers():
+        return ['CUDAExecutionProvider', 'CPUExecutionProvider']
+
+    return ['CPUExecutionProvider']
+
+
+def ort_session_options(num_threads: int | None = None):
+    import onnxruntime
+
+    options = onnxruntime.SessionOptions()
+    if num_threads:
+        options.intra_op_num_threads = num_threads
+
+    return options
+
+
+def quantized_transformer_file() -> str:
+    """
+    Dynamically int8 quantized ONNX export of the sentence transformer, as published in the
+    model repository, for the instruction set of this machine.
+    """
+
+    if platform.machine().lower() in ('arm64', 'aarch64'):
+        return "onnx/model_qint8_arm64.onnx"
+    else:
+        return "onnx/model_quint8_avx2.onnx"
+
+
+def quantized_sat_model(cache_dir: Path = MODEL_CACHE_DIR) -> Path:
+    """
+    Quantize the weights of the ONNX export of the segmentation model to int8, and return the
+    model directory to load with `SaT`. The quantized model is created once, and reused.
+    """
+
+    model_dir = cache_dir / f"{SAT_MODEL}-int8"
+    model_path = model_dir / "model_optimized.onnx"
+    if model_path.exists():
+        return model_dir
+
+    from huggingface_hub import hf_hub_download
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    logger.info("Quantizing %s to int8, saving to %s", SAT_MODEL, model_dir)
+
+    repo_id = f"segment-any-text/{SAT_MODEL}"
+    model_dir.mkdir(parents=True, exist_ok=True)
+    shutil.copy(hf_hub_download(repo_id, "config.json"), model_dir / "config.json")
+
+    # Write to a temporary file first, such that an interrupted run doesn't leave a broken model
+    tmp_path = model_dir / "model_optimized.onnx.tmp"
+    quantize_dynamic(hf_hub_download(repo_id, "model_optimized.onnx"), tmp_path, weight_type=QuantType.QInt8)
+    tmp_path.rename(model_path)
+
+    return model_dir
+
+
+def mean_pool(sentence_embeddings: numpy.ndarray, slices: list[slice]) -> numpy.ndarray:
+    """
+    Average the sentence embeddings of each post, given consecutive slices covering all
+    sentences. Posts without sentences get a zero embedding.
+    """
+
+    counts = numpy.fromiter((s.stop - s.start for s in slices), dtype=numpy.int64, count=len(slices))
+    starts = numpy.fromiter((s.start for s in slices), dtype=numpy.int64, count=len(slices))
+
+    post_embeddings = numpy.zeros((len(slices), sentence_embeddings.shape[1]), dtype=numpy.float32)
+
+    # Slices are consecutive, so summing from each start up to the next start sums each post
+    nonempty = counts > 0
+    if nonempty.any():
+        sums = numpy.add.reduceat(sentence_embeddings, starts[nonempty], axis=0, dtype=numpy.float32)
+        post_embeddings[nonempty] = sums / counts[nonempty, None]
+
+    return post_embeddings
+
+
+def token_budget_batches(lengths: numpy.ndarray, max_tokens: int) -> list[numpy.ndarray]:
+    """
+    Group sentences of similar length into batches, such that the padded size of each batch,
+    i.e., the number of sentences times the longest sentence, is at most `max_tokens`.
+
+    Returns the indices of the sentences in each batch. A sentence longer than `max_tokens` is
+    a batch by itself.
+    """
+
+    order = numpy.argsort(lengths, kind='stable')
+
+    batches = []
+    start = 0
+    for i, ix in enumerate(order):
+        # Sentences are sorted by length, so the current sentence is the longest of the batch
+        if i > start and (i + 1 - start) * lengths[ix] > max_tokens:
+            batches.append(order[start:i])
+            start = i
+
+    if start < len(order):
+        batches.append(order[start:])
+
+    return batches
+
+
+@dataclass
+class SegmentedPosts:
+    """
+    Sentences of a batch of posts, the sentences of post `i` are `sentences[slices[i]]`.
+    """
+
+    sentences: list[str]
+    slices: list[slice]
+
 
 class PostEmbedder:
     """
@@ -20,18 +161,97 @@ class PostEmbedder:
     To compute embeddings, we first split the post into seperate sentences using the
     Segment any Text model. Next, we compute embeddings for each sentence. The average of each
     sentence embedding will be returned as the post embedding.
+
+    Most posts are a single short sentence. Posts of at most `short_post_length` characters are
+    not segmented, but embedded as a single sentence. This is disabled if `short_post_length` is
+    None.
+
+    Both steps are available separately as `segment()` and `encode()`, such that they can run
+    concurrently on different batches. The time spent on each of these stages is recorded in
+    the `bsky_topics_embed_stage_seconds` histogram.
+
+    Both models run with the given `backend`, one of `BACKENDS`:
+
+    * `torch`: PyTorch, in half precision on GPU devices.
+    * `onnx`: ONNX Runtime, which is usually faster on CPU. The device only selects the CUDA
+      execution provider if available.
+    * `onnx-int8`: ONNX Runtime with int8 quantized weights, on CPU. Faster still, at the cost
+      of a small drift in embeddings.
+
+    The device is auto-detected if not given. `num_threads` sets the number of threads used
+    within an operator by both PyTorch and ONNX Runtime, by default all cores are used.
+
+    Sentences in a batch are padded to the longest sentence. If `max_batch_tokens` is given,
+    sentences are grouped by their number of tokens instead, into batches of at most
+    `max_batch_tokens` tokens including padding. Many posts are very short, so this avoids
+    spending most compute on padding. Otherwise, batches have a fixed number of sentences.
     """
 
-    def __init__(self, device=None):
-        self.sat = SaT("sat-3l-sm")
+    def __init__(self, device: str | None = None, short_post_length: int | None = None, backend: str = 'torch',
+                 num_threads: int | None = None, max_batch_tokens: int | None = None):
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown backend {backend!r}, should be one of {BACKENDS}")
+
+        self.device = device or detect_device()
+        self.backend = backend
+        self.short_post_length = short_post_length
+        self.max_batch_tokens = max_batch_tokens
+
+        if num_threads:
+            torch.set_num_threads(num_threads)
+
+        logger.info("Loading models with backend %s on device %s", backend, self.device)
+
+        if backend == 'torch':
+            self.sat = SaT(SAT_MODEL)
+            if self.device != 'cpu':
+                self.sat.half().to(self.device)
+
+            self.transformer = SentenceTransformer(TRANSFORMER_MODEL, device=self.device)
+        else:
+            providers = ort_providers(self.device) if backend == 'onnx' else ['CPUExecutionProvider']
+            model_kwargs = {
+                'provider': providers[0],
+                'session_options': ort_session_options(num_threads),
+            }
+
+            sat_model = SAT_MODEL
+            if backend == 'onnx-int8':
+                sat_model = str(quantized_sat_model())
+                model_kwargs['file_name'] = quantized_transformer_file()
+
+            self.sat = SaT(sat_model, ort_providers=providers,
+                           ort_kwargs={'sess_options': ort_session_options(num_threads)})
+
+            self.transformer = SentenceTransformer(TRANSFORMER_MODEL, device='cpu', backend='onnx',
+                                                   model_kwargs=model_kwargs)
+
+    @property
+    def settings_id(self) -> str:
+        """Identifies the models and settings determining the computed embeddings."""
 
-        if device:
-            self.sat.half().to(device)
+        settings_id = f"{SAT_MODEL}/{TRANSFORMER_MODEL}/short_post_length={self.short_post_length}"
 
-        self.transformer = SentenceTransformer("all-MiniLM-L6-v2", device=device)
+        # Keeps cache entries computed with PyTorch, from before backends were configurable
+        if self.backend != 'torch':
+            settings_id += f"/backend={self.backend}"
 
-    def embed(self, posts: list[str]) -> torch.tensor:
-        per_post_sentences = list(self.split_into_sentences(posts))
+        return settings_id
+
+    def embed(self, posts: list[str]) -> numpy.ndarray:
+        return self.encode(self.segment(posts))
+
+    def segment(self, posts: list[str]) -> SegmentedPosts:
+        if self.short_post_length is None:
+            long_posts = list(range(len(posts)))
+        else:
+            long_posts = [i for i, post in enumerate(posts) if len(post) > self.short_post_length]
+
+        per_post_sentences = [[post] for post in posts]
+        if long_posts:
+            with EMBED_STAGE_SECONDS.labels('segment').time():
+                for i, sentences in zip(long_posts, self.split_into_sentences([posts[i] for i in long_posts])):
+                    per_post_sentences[i] = sentences
 
         # Combine all sentences into a single batch
         flattened_sentences = [s for p in per_post_sentences for s in p]
@@ -46,17 +266,36 @@ class PostEmbedder:
 
             curr_ix += len(sentences)
 
-        sentence_embeddings = self.transformer.encode(flattened_sentences)
+        return SegmentedPosts(flattened_sentences, post_sentence_slices)
+
+    def encode(self, segmented: SegmentedPosts) -> numpy.ndarray:
+        with EMBED_STAGE_SECONDS.labels('encode').time():
+            sentence_embeddings = self.encode_sentences(segmented.sentences)
 
         # For each post, average embeddings of sentences to compute the final
         # post embedding
-        post_embeddings = numpy.zeros((len(posts), sentence_embeddings.shape[1]))
-        for i, post_slice in enumerate(post_sentence_slices):
-            post_embeddings[i] = sentence_embeddings[post_slice].mean(axis=0)
+        with EMBED_STAGE_SECONDS.labels('pool').time():
+            return mean_pool(sentence_embeddings, segmented.slices)
+
+    def encode_sentences(self, sentences: list[str]) -> numpy.ndarray:
+        """Compute the embedding of each sentence, in batches of at most `max_batch_tokens` tokens if set."""
 
-        return post_embeddings
+        if self.max_batch_tokens is None or not sentences:
+            return self.transformer.encode(sentences)
+
+        # Number of tokens of each sentence, as truncated by the model
+        input_ids = self.transformer.tokenizer(sentences, truncation=True,
+                                               max_length=self.transformer.max_seq_length)['input_ids']
+        lengths = numpy.fromiter((len(ids) for ids in input_ids), dtype=numpy.int64, count=len(sentences))
+
+        embeddings = numpy.empty((len(sentences), self.transformer.get_sentence_embedding_dimension()),
+                                 dtype=numpy.float32)
+
+        for batch in token_budget_batches(lengths, self.max_batch_tokens):
+            embeddings[batch] = self.transformer.encode([sentences[i] for i in batch], batch_size=len(batch))
+
+        return embeddings
 
     def split_into_sentences(self, posts: list[str]) -> list[list[str]]:
         """Runs 'Segment any Text' model to split a post into multiple sentences."""
         return self.sat.split(posts)
-
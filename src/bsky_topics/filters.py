@@ -0,0 +1,150 @@
+"""
+`bsky_topics.filters` - Decide which Jetstream events to store
+"""
+
+from __future__ import annotations
+from typing import Iterable, Optional
+
+
+def extract_time_us(msg: bytes) -> int | None:
+    """
+    Extract the event time from a raw Jetstream message without parsing the JSON.
+
+    Jetstream always outputs `did`, `time_us` and `kind` as the first keys of a message.
+    """
+
+    start = msg.find(b'"time_us":', 0, 200)
+    if start < 0:
+        return None
+
+    start += len(b'"time_us":')
+    end = start
+    while end < len(msg) and 48 <= msg[end] <= 57:
+        end += 1
+
+    return int(msg[start:end]) if end > start else None
+
+
+def extract_did(msg: bytes) -> bytes | None:
+    """Extract the DID from a raw Jetstream message without parsing the JSON."""
+
+    if not msg.startswith(b'{"did":"'):
+        return None
+
+    end = msg.find(b'"', 8)
+    if end < 0:
+        return None
+
+    return msg[8:end]
+
+
+class PostFilter:
+    """
+    Filter rules for Jetstream events and posts.
+
+    Rules are applied in two stages: `reject_raw()` cheaply rejects messages based on the raw
+    bytes, before parsing the JSON, and `reject_post()` applies the remaining rules to parsed
+    posts. Raw checks only reject messages that would certainly be rejected after parsing.
+
+    Both methods return the name of the rule rejecting the message, or None if accepted. Post
+    deletions pass the raw rules, unless they concern an account excluded by the DID rules.
+
+    Parameters
+    ----------
+    languages
+        Only keep posts tagged with at least one of these languages (primary subtag, e.g., "en").
+    keep_unknown_language
+        When filtering on language, also keep posts without language tags.
+    did_allow
+        Only keep posts from these accounts.
+    did_deny
+        Never keep posts from these accounts.
+    min_text_length
+        Minimum number of characters of the post text, after removing surrounding whitespace.
+    """
+
+    def __init__(self, languages: Optional[Iterable[str]] = None, keep_unknown_language: bool = False,
+                 did_allow: Optional[Iterable[str]] = None, did_deny: Optional[Iterable[str]] = None,
+                 min_text_length: int = 1):
+        self.languages: set[str] = {lang.lower() for lang in languages or []}
+        self.keep_unknown_language: bool = keep_unknown_language
+        self.did_allow: set[str] = set(did_allow or [])
+        self.did_deny: set[str] = set(did_deny or [])
+        self.min_text_length: int = max(min_text_length, 1)
+
+        # The lowercased language tags of any post tagged with an accepted language contain at
+        # least one of these byte strings
+        self.raw_languages: list[bytes] = [b'"' + lang.encode() for lang in self.languages]
+
+        self.raw_did_allow: set[bytes] = {did.encode() for did in self.did_allow}
+        self.raw_did_deny: set[bytes] = {did.encode() for did in self.did_deny}
+
+    @classmethod
+    def from_config(cls, config: dict) -> PostFilter:
+        return cls(
+            languages=config.get('languages'),
+            keep_unknown_language=config.get('keep_unknown_language', False),
+            did_allow=config.get('did_allow'),
+            did_deny=config.get('did_deny'),
+            min_text_length=config.get('min_text_length', 1),
+        )
+
+    def reject_raw(self, msg: bytes) -> str | None:
+        # Keys and string values containing quotes are escaped in JSON, so these byte strings
+        # can't occur in the post text.
+        if b'"kind":"commit"' not in msg:
+            return "not_commit"
+
+        is_delete = b'"operation":"delete"' in msg
+        if not is_delete and b'"operation":"create"' not in msg:
+            return "operation"
+
+        if self.did_allow or self.did_deny:
+            did = extract_did(msg)
+            if did is not None:
+                if did in self.raw_did_deny:
+                    return "did_deny"
+
+                if self.did_allow and did not in self.raw_did_allow:
+                    return "did_allow"
+
+        # Deletions don't include the record, and posts from other accounts were never stored
+        if is_delete:
+            return
+
+        if self.raw_languages:
+            start = msg.find(b'"langs":[')
+            if start < 0:
+                return None if self.keep_unknown_language else "language"
+
+            start += len(b'"langs":[')
+            end = msg.find(b']', start)
+
+            # Leave tags with escape sequences to the parsed filter
+            if end < 0 or b'\\' in msg[start:end]:
+                return
+
+            langs = msg[start:end].strip().lower()
+            if not langs:
+                return None if self.keep_unknown_language else "language"
+
+            if not any(lang in langs for lang in self.raw_languages):
+                return "language"
+
+    def reject_post(self, post: dict) -> str | None:
+        if post['did'] in self.did_deny:
+            return "did_deny"
+
+        if self.did_allow and post['did'] not in self.did_allow:
+            return "did_allow"
+
+        if len(post['post_text']) < self.min_text_length:
+            return "min_text_length"
+
+        if self.languages:
+            if not post['language']:
+                if not self.keep_unknown_language:
+                    return "language"
+            elif not any(isinstance(lang, str) and lang.split('-')[0].lower() in self.languages
+                         for lang in post['language']):
+                return "language"
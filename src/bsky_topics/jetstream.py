@@ -1,26 +1,94 @@
 import asyncio
-from collections import deque
+from collections import deque, Counter
+from dataclasses import dataclass
 from datetime import datetime, timedelta
-from itertools import islice
+from itertools import count
 import logging
+from pathlib import Path
 import sys
+import time
 from typing import Optional, Sequence, AsyncIterator
 
 from rich.console import Console
 from rich.status import Status
 import orjson
 import websockets
-from websockets.asyncio.client import connect
+import zstandard
+from websockets.asyncio.client import connect, ClientConnection
 
-from sqlalchemy import select
+import asyncpg
+from sqlalchemy import func
 from sqlalchemy.exc import StatementError
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from bsky_topics.db import async_session
-from bsky_topics.db.schema import Post
+from bsky_topics.db.deletions import record_deletions, compact_deletions
+from bsky_topics.db.schema import IngestCheckpoint
+from bsky_topics.db.writers import WRITE_MODES
+from bsky_topics.filters import PostFilter, extract_time_us
+from bsky_topics.metrics import (MESSAGES_RECEIVED, BYTES_RECEIVED, MESSAGES_DROPPED, DUPLICATES, POSTS_RECEIVED,
+                                 POSTS_INSERTED, DELETIONS_RECEIVED, POSTS_DELETED, INSERT_SECONDS, COMMIT_SECONDS,
+                                 INGEST_LAG_SECONDS, QUEUED)
+from bsky_topics.segments import SpillSegments, FrameRecorder
 
 logger = logging.getLogger(__name__)
 
+# Upper bound on the size of a decompressed Jetstream message
+MAX_MESSAGE_SIZE = 2**20
+
+
+TID_ALPHABET = "234567abcdefghijklmnopqrstuvwxyz"
+
+# Accepted difference between the timestamp in a record key, and the Jetstream event time
+MAX_TID_AGE = timedelta(days=1)
+MAX_TID_AHEAD = timedelta(minutes=10)
+
+UNIX_EPOCH = datetime(1970, 1, 1)
+
+
+def tid_to_time_us(tid: str) -> int | None:
+    """
+    Decode the timestamp (microseconds since Unix epoch) of a timestamp identifier (TID).
+
+    Post record keys are TIDs: 13 base32-sortable characters encoding a 64-bit integer, of which
+    the 53 bits after the (zero) top bit represent the creation time, and the last 10 bits a
+    clock identifier.
+    """
+
+    if len(tid) != 13:
+        return None
+
+    value = 0
+    for char in tid:
+        ix = TID_ALPHABET.find(char)
+        if ix < 0:
+            return None
+
+        value = (value << 5) | ix
+
+    return value >> 10
+
+
+def post_created_at(rkey: str, time_us: int) -> datetime:
+    """
+    Determine the creation time of a post, used to partition posts.
+
+    Uses the timestamp in the record key, such that the same post always gets the same creation
+    time. Record keys are set by the client however, so fall back to the event time if the
+    record key is not a TID or its timestamp is implausible.
+    """
+
+    event_time = UNIX_EPOCH + timedelta(microseconds=time_us)
+
+    tid_time_us = tid_to_time_us(rkey)
+    if tid_time_us is not None:
+        tid_time = UNIX_EPOCH + timedelta(microseconds=tid_time_us)
+        if event_time - MAX_TID_AGE <= tid_time <= event_time + MAX_TID_AHEAD:
+            return tid_time
+
+    return event_time
+
 
 def exp_average(history: Sequence[int | float], alpha: float = 0.5):
     """Calculate the exponential average of a list of values.
@@ -38,29 +106,83 @@ def exp_average(history: Sequence[int | float], alpha: float = 0.5):
 class CollectorMetrics:
     """
     Keeps track of collector events and calculates a running average
+
+    Per-tick counts are also added to the Prometheus counters in `bsky_topics.metrics` on
+    each tick.
     """
 
     def __init__(self, max_history=5):
-        self.max_history = 5
+        self.max_history = max_history
 
         self.num_received: int = 0
         self.num_inserted: int = 0
+        self.num_deletions: int = 0
+
+        # Raw websocket messages, their size on the wire, and CPU time spent decompressing
+        # and parsing them
+        self.num_messages: int = 0
+        self.num_bytes: int = 0
+        self.decode_time_ns: int = 0
+
+        # Totals since start, not reset every tick
+        self.total_messages: int = 0
+        self.total_inserted: int = 0
+
+        # Received post deletions, and the number of posts removed because of them
+        self.total_deletions: int = 0
+        self.total_deleted_posts: int = 0
+
+        # Events skipped because they were already received from another endpoint
+        self.total_duplicates: int = 0
+
+        # Number of messages dropped by each filter rule
+        self.num_dropped: int = 0
+        self.total_dropped: Counter[str] = Counter()
+
+        # Time in seconds to write and commit each of the most recent batches
+        self.write_latencies = deque([], maxlen=10_000)
 
         self.history_received = deque([])
         self.history_inserted = deque([])
+        self.history_deletions = deque([])
+        self.history_messages = deque([])
+        self.history_bytes = deque([])
+        self.history_decode_time_ns = deque([])
+        self.history_dropped = deque([])
+
+    def drop(self, rule: str):
+        self.num_dropped += 1
+        self.total_dropped[rule] += 1
+        MESSAGES_DROPPED.labels(rule).inc()
 
     def tick(self):
+        MESSAGES_RECEIVED.inc(self.num_messages)
+        BYTES_RECEIVED.inc(self.num_bytes)
+        POSTS_RECEIVED.inc(self.num_received)
+        POSTS_INSERTED.inc(self.num_inserted)
+        DELETIONS_RECEIVED.inc(self.num_deletions)
+
         self.history_received.appendleft(self.num_received)
         self.history_inserted.appendleft(self.num_inserted)
-
-        while len(self.history_received) > self.max_history:
-            self.history_received.pop()
-
-        while len(self.history_inserted) > self.max_history:
-            self.history_inserted.pop()
+        self.history_deletions.appendleft(self.num_deletions)
+        self.history_messages.appendleft(self.num_messages)
+        self.history_bytes.appendleft(self.num_bytes)
+        self.history_decode_time_ns.appendleft(self.decode_time_ns)
+        self.history_dropped.appendleft(self.num_dropped)
+
+        for history in (self.history_received, self.history_inserted, self.history_deletions,
+                        self.history_messages, self.history_bytes, self.history_decode_time_ns,
+                        self.history_dropped):
+            while len(history) > self.max_history:
+                history.pop()
 
         self.num_received = 0
         self.num_inserted = 0
+        self.num_deletions = 0
+        self.num_messages = 0
+        self.num_bytes = 0
+        self.decode_time_ns = 0
+        self.num_dropped = 0
 
     def get_avg_received_per_tick(self):
         return exp_average(self.history_received)
@@ -68,56 +190,250 @@ class CollectorMetrics:
     def get_avg_inserted_per_tick(self):
         return exp_average(self.history_inserted)
 
+    def get_avg_deletions_per_tick(self):
+        return exp_average(self.history_deletions)
+
+    def get_avg_dropped_per_tick(self):
+        return exp_average(self.history_dropped)
+
+    def get_avg_bytes_per_tick(self):
+        return exp_average(self.history_bytes)
+
+    def get_avg_decode_time_per_message(self) -> float:
+        """Average CPU time in microseconds spent decoding a single message."""
+        num_messages = exp_average(self.history_messages)
+        if not num_messages:
+            return 0.0
+
+        return exp_average(self.history_decode_time_ns) / num_messages / 1000
+
+
+class RecentlySeen:
+    """
+    Bounded set of recently seen keys, the oldest keys are evicted first.
+    """
+
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self.keys: set = set()
+        self.order: deque = deque()
+
+    def add(self, key) -> bool:
+        """Add a key to the set, returns False if the key was already seen."""
+
+        if key in self.keys:
+            return False
+
+        self.keys.add(key)
+        self.order.append(key)
+
+        if len(self.order) > self.max_size:
+            self.keys.discard(self.order.popleft())
+
+        return True
+
+
+@dataclass
+class JetstreamEndpoint:
+    """
+    Connection state of a single Jetstream instance.
+    """
+
+    hostname: str
+    url: str
+
+    # Event time of the last message parsed from this endpoint
+    last_time_us: int | None = None
+
+    ws: ClientConnection | None = None
+    paused_until: float = 0.0
+
+    @property
+    def lag(self) -> float | None:
+        """Seconds between now and the event time of the last message."""
+
+        if self.last_time_us is None:
+            return None
+
+        return time.time() - self.last_time_us / 1e6
+
+
+@dataclass
+class PostBatch:
+    """
+    A batch of posts to be written to the database.
+
+    Batches created by the collector are numbered in the order they were received. Batches
+    recovered from spill segments have no sequence number.
+    """
+
+    seq: int | None
+    rows: list[dict]
+
+    @property
+    def min_time_us(self) -> int:
+        return min(row['time_us'] for row in self.rows)
+
+    @property
+    def max_time_us(self) -> int:
+        return max(row['time_us'] for row in self.rows)
+
+
+class DeletionBatch(PostBatch):
+    """
+    A batch of post deletions to be recorded in the database.
+
+    Numbered in the same sequence as post batches, such that the checkpoint accounts for both.
+    """
+
 
 class JetstreamCollector:
-    def __init__(self, console: Console, ws_hostname: str, batch_size: Optional[int] = 64):
+    """
+    Listens to the Jetstream websocket and stores new posts in the database.
+
+    The collector consists of independent stages connected by bounded queues: a websocket
+    reader for each Jetstream instance in `ws_hostnames`, a parser which filters messages and
+    collects posts in batches, and `num_writers` concurrent database writers. Which posts are
+    stored is determined by `post_filter`, see `bsky_topics.filters.PostFilter`. Batches are
+    handed to the writers when `batch_size` posts have been collected, or when `flush_interval`
+    seconds have passed since the last batch. The `write_mode` determines how posts are written,
+    see `bsky_topics.db.writers.WRITE_MODES`.
+
+    If the database can't keep up and the write queue is full, batches are spilled to segment
+    files in `spill_dir`. These are written to the database once the write queue is empty.
+
+    If `zstd_dictionary` is given, the collector requests zstd compressed messages from Jetstream,
+    which are decompressed using the given dictionary. If a `recorder` is given, all received
+    messages are recorded to disk, such that they can be replayed later, see `replay()`.
+
+    When connected to multiple Jetstream instances, only the first copy of each event is
+    processed. If an instance lags more than `max_lag` seconds behind the others, it is
+    disconnected for `lag_cooldown` seconds.
+
+    Post deletions are collected in separate batches, and recorded by a dedicated writer, such
+    that bursts of deletions don't hold up new posts. Every `compact_interval` seconds, posts
+    matching recorded deletions are removed in bulk, see `bsky_topics.db.deletions`.
+    """
+
+    def __init__(self, console: Console, ws_hostnames: str | list[str], batch_size: Optional[int] = 64,
+                 flush_interval: Optional[float] = None, write_mode: str = 'insert',
+                 zstd_dictionary: Optional[bytes] = None, num_writers: int = 2,
+                 spill_dir: str | Path = "spill", max_queued_messages: int = 10_000,
+                 max_queued_batches: int = 16, recorder: Optional[FrameRecorder] = None,
+                 checkpoint_name: str = "jetstream", max_lag: float = 10.0, lag_cooldown: float = 60.0,
+                 post_filter: Optional[PostFilter] = None, compact_interval: float = 10.0):
         self.console: Console = console
         self.console_status: Status | None = None
 
-        self.ws_url: str = f"wss://{ws_hostname}/subscribe?wantedCollections=app.bsky.feed.post"
+        if isinstance(ws_hostnames, str):
+            ws_hostnames = [ws_hostnames]
+
+        self.endpoints: list[JetstreamEndpoint] = []
+        for hostname in ws_hostnames:
+            # Hostnames without scheme refer to public Jetstream instances, but allow e.g.
+            # ws://localhost:6008 for a local replay server.
+            base_url = hostname if "://" in hostname else f"wss://{hostname}"
+            url = f"{base_url}/subscribe?wantedCollections=app.bsky.feed.post"
+
+            if zstd_dictionary:
+                url += "&compress=true"
+
+            self.endpoints.append(JetstreamEndpoint(hostname, url))
+
+        self.recorder: FrameRecorder | None = recorder
+        self.post_filter: PostFilter = post_filter or PostFilter()
+
+        # Reuse a single decompression context with the preloaded dictionary for all messages
+        self.decompressor: zstandard.ZstdDecompressor | None = None
+        if zstd_dictionary:
+            self.decompressor = zstandard.ZstdDecompressor(
+                dict_data=zstandard.ZstdCompressionDict(zstd_dictionary)
+            )
+
+        # Suppress duplicate events received from multiple endpoints
+        self.recently_seen: RecentlySeen | None = RecentlySeen() if len(self.endpoints) > 1 else None
+        self.max_lag: float = max_lag
+        self.lag_cooldown: float = lag_cooldown
+
         self.batch_size: int = batch_size
-        self.batch = deque([])
+        self.batch: list[dict] = []
+        self.deletions: list[dict] = []
+        self.batch_seq = count()
+
+        self.flush_interval: float | None = flush_interval
+        self.last_flush: float = time.monotonic()
+        self.writer = WRITE_MODES[write_mode]()
+        self.num_writers: int = num_writers
 
-        self.postgres_update_task: asyncio.Task | None = None
+        # Queues connecting the pipeline stages
+        self.message_queue: asyncio.Queue[tuple[JetstreamEndpoint | None, bytes]] = asyncio.Queue(
+            max_queued_messages)
+        self.write_queue: asyncio.Queue[PostBatch] = asyncio.Queue(max_queued_batches)
+        self.spill = SpillSegments(spill_dir)
+
+        # Deletions are small, and recording them is cheap, so this queue is not bounded
+        self.deletion_queue: asyncio.Queue[DeletionBatch] = asyncio.Queue()
+        self.compact_interval: float = compact_interval
+
+        # Earliest event time of each queued or in-flight batch, by sequence number
+        self.uncommitted: dict[int, int] = {}
+
+        # Event time of the most recent message parsed from any endpoint
+        self.last_time_us: int | None = None
+
+        self.tasks: list[asyncio.Task] = []
         self.stats_task: asyncio.Task | None = None
 
+        self.checkpoint_name: str = checkpoint_name
+
         self.metrics = CollectorMetrics()
 
-    async def get_last_processed_message(self) -> int | None:
+    async def get_checkpoint(self) -> int | None:
         """
-        Obtain the timestamp of the processed post.
+        Obtain the Jetstream event time of the last committed post.
 
         Timestamp represents the number of microseconds since Unix epoch, which can be used
         in the Jetstream websocket connection URL.
         """
 
         async with async_session() as session:
-            stmt = (select(Post.indexed_at)
-                    .order_by(Post.indexed_at.desc())
-                    .limit(1))
-            results = await session.scalars(stmt)
+            checkpoint = await session.get(IngestCheckpoint, self.checkpoint_name)
+
+            if checkpoint:
+                return checkpoint.time_us
+
+    async def update_checkpoint(self, session: AsyncSession, time_us: int):
+        """
+        Store the event time of the last written post, as part of the session transaction.
 
-            result = next(iter(results), None)
-            if result:
-                unix_epoch = datetime(1970, 1, 1)
-                time_us = (result - unix_epoch) / timedelta(microseconds=1)
+        The checkpoint only moves forward, even if batches are committed out of order.
+        """
+
+        stmt = insert(IngestCheckpoint).values(name=self.checkpoint_name, time_us=time_us)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[IngestCheckpoint.name],
+            set_={
+                'time_us': func.greatest(IngestCheckpoint.time_us, stmt.excluded.time_us),
+                'updated_at': func.now(),
+            }
+        )
 
-                return time_us
+        await session.execute(stmt)
 
-    async def gen_jetstream_url(self):
+    async def gen_jetstream_url(self, endpoint: JetstreamEndpoint):
         """
-        Generate the websocket URL.
+        Generate the websocket URL for an endpoint.
 
-        It queries the database to obtain the date and time of last processed post, and determines a cursor
-        to be included in the URL when approriate.
+        On reconnect, the event time of the last message parsed from this endpoint is used as
+        cursor. On startup, it queries the checkpoint table to obtain the event time of the last
+        committed post. Jetstream replays events from the cursor onwards, already stored posts are
+        skipped when writing.
         """
 
-        ws_url = self.ws_url
-        last_indexed = await self.get_last_processed_message()
-        if last_indexed:
-            # Substract two seconds
-            last_indexed -= 2000
-            ws_url += f"&cursor={last_indexed:.0f}"
+        ws_url = endpoint.url
+        last_time_us = endpoint.last_time_us or self.last_time_us or await self.get_checkpoint()
+        if last_time_us:
+            ws_url += f"&cursor={last_time_us}"
 
         return ws_url
 
@@ -135,127 +451,549 @@ class JetstreamCollector:
         except websockets.exceptions.ConnectionClosedOK:
             return
 
-    async def listen(self):
-        # Start metrics tracking task
+    def decode(self, msg: bytes, endpoint: JetstreamEndpoint | None = None) -> dict | None:
+        """
+        Decompress (if applicable) and parse a Jetstream message.
+
+        Messages rejected by the raw filter rules are not parsed. Also keeps track of the event time,
+        the number of bytes received and CPU time spent decoding.
+        """
+
+        start = time.thread_time_ns()
+        self.metrics.num_messages += 1
+        self.metrics.total_messages += 1
+        self.metrics.num_bytes += len(msg)
+
+        try:
+            if self.decompressor:
+                msg = self.decompressor.decompress(msg, max_output_size=MAX_MESSAGE_SIZE)
+
+            time_us = extract_time_us(msg)
+            if time_us:
+                self.last_time_us = max(self.last_time_us or 0, time_us)
+
+                if endpoint:
+                    endpoint.last_time_us = time_us
+
+            reason = self.post_filter.reject_raw(msg)
+            if reason:
+                self.metrics.drop(reason)
+                return
+
+            return orjson.loads(msg)
+        except zstandard.ZstdError as e:
+            logger.error("Could not decompress message:")
+            logger.exception(e)
+        except orjson.JSONDecodeError as e:
+            logger.error("Could not parse JSON:")
+            logger.exception(e)
+        finally:
+            self.metrics.decode_time_ns += time.thread_time_ns() - start
+
+    def start_pipeline(self):
+        """Start the metrics, parser, writer, spill drain and deletion tasks."""
+
         self.stats_task = asyncio.create_task(self.update_stats())
 
-        ws_url = await self.gen_jetstream_url()
-        print("WS URL:", ws_url)
+        self.tasks.append(asyncio.create_task(self.parse_messages()))
+        self.tasks.extend(
+            asyncio.create_task(self.write_batches()) for _ in range(self.num_writers)
+        )
+        self.tasks.append(asyncio.create_task(self.drain_spill()))
+        self.tasks.append(asyncio.create_task(self.write_deletions()))
+        self.tasks.append(asyncio.create_task(self.compact_periodically()))
+
+        if self.flush_interval:
+            self.tasks.append(asyncio.create_task(self.flush_periodically()))
+
+    async def listen(self):
+        self.start_pipeline()
+
+        if len(self.endpoints) > 1:
+            self.tasks.append(asyncio.create_task(self.monitor_lag()))
+
+        await asyncio.gather(*(self.read_endpoint(endpoint) for endpoint in self.endpoints))
+
+    async def read_endpoint(self, endpoint: JetstreamEndpoint):
+        """Pipeline stage reading messages from a single Jetstream instance."""
+
+        ws_url = await self.gen_jetstream_url(endpoint)
+        logger.info("WS URL: %s", ws_url)
 
         # Factory keeps retrying to connect on failure/disconnects with exponential backoff mechanism
         ws_factory = connect(ws_url)
         async for ws in ws_factory:
-            logger.info("Connected to jetstream.")
+            logger.info("Connected to jetstream %s.", endpoint.hostname)
+            endpoint.ws = ws
 
             try:
                 async for msg in self.read(ws):
-                    try:
-                        data = orjson.loads(msg)
-                    except orjson.JSONDecodeError as e:
-                        logger.error("Could not parse JSON:")
-                        logger.exception(e)
-                        continue
+                    if self.recorder:
+                        self.recorder.write(msg)
 
-                    if data.get('kind') != "commit":
-                        continue
+                    await self.message_queue.put((endpoint, msg))
+            except websockets.exceptions.ConnectionClosedError:
+                logger.warning("Connection to %s closed. Reconnecting...", endpoint.hostname)
 
-                    commit = data.get('commit', {})
-                    if not commit:
-                        continue
+            endpoint.ws = None
 
-                    if commit.get('operation') != "create":
-                        continue
+            if endpoint.paused_until:
+                await asyncio.sleep(max(endpoint.paused_until - time.monotonic(), 0))
 
-                    if commit.get('collection') != "app.bsky.feed.post":
-                        continue
+                # Continue where the other endpoints are, instead of where this one lagged behind
+                endpoint.paused_until = 0.0
+                endpoint.last_time_us = None
 
-                    record = commit.get('record', {})
-                    if not record:
-                        continue
+            # Update cursor in WS URL. Messages still in the queue are not yet reflected in the
+            # cursor, those are received again and skipped when writing.
+            ws_factory.uri = await self.gen_jetstream_url(endpoint)
 
-                    if record.get('$type', "") != "app.bsky.feed.post":
-                        continue
+    async def monitor_lag(self):
+        """Disconnect endpoints lagging behind the other endpoints for a while."""
 
-                    if not data.get('did'):
-                        continue
+        while True:
+            await asyncio.sleep(1)
 
-                    if not commit.get('rkey'):
-                        continue
+            lags = {
+                endpoint.hostname: endpoint.lag
+                for endpoint in self.endpoints if endpoint.ws and endpoint.lag is not None
+            }
+            if not lags:
+                continue
 
-                    if not commit.get('cid'):
-                        continue
+            min_lag = min(lags.values())
+            for endpoint in self.endpoints:
+                lag = lags.get(endpoint.hostname)
+                if lag is None or lag - min_lag <= self.max_lag:
+                    continue
+
+                logger.warning("Jetstream %s lags %.1fs behind, disconnecting for %.0fs.", endpoint.hostname,
+                               lag - min_lag, self.lag_cooldown)
+
+                endpoint.paused_until = time.monotonic() + self.lag_cooldown
+                await endpoint.ws.close()
+
+    async def replay(self, messages: AsyncIterator[bytes]):
+        """
+        Process messages from an iterator instead of the websocket, e.g., recorded traffic.
+
+        Returns once all posts are written to the database.
+        """
+
+        self.start_pipeline()
+
+        async for msg in messages:
+            await self.message_queue.put((None, msg))
+
+        await self.drain()
+
+    async def drain(self):
+        """
+        Wait until all received posts, including spilled posts, are written to the database, and
+        all received deletions are applied.
+        """
 
-                    post_text = record.get('text').strip().replace('\x00', '')
-                    if not post_text:
+        await self.message_queue.join()
+        self.flush()
+        self.flush_deletions()
+        await self.write_queue.join()
+        await self.deletion_queue.join()
+
+        while self.spill.num_batches:
+            await asyncio.sleep(0.1)
+
+        while await self.compact():
+            pass
+
+    async def parse_messages(self):
+        """Pipeline stage parsing messages, and collecting new posts in batches."""
+
+        while True:
+            endpoint, msg = await self.message_queue.get()
+
+            try:
+                data = self.decode(msg, endpoint)
+                if data is None:
+                    continue
+
+                if self.recently_seen is not None and not self.is_first_copy(data):
+                    self.metrics.total_duplicates += 1
+                    DUPLICATES.inc()
+                    continue
+
+                if (data.get('commit') or {}).get('operation') == "delete":
+                    deletion = self.parse_deletion(data)
+                    if not deletion:
+                        self.metrics.drop("invalid")
                         continue
 
-                    self.batch.append({
-                        'did': data['did'],
-                        'rkey': commit['rkey'],
-                        'cid': commit['cid'],
-                        'post_text': post_text,
-                        'language': record.get('langs', [])
-                    })
-                    self.metrics.num_received += 1
-
-                    if len(self.batch) >= self.batch_size:
-                        # If previous batch not inserted yet, wait until done
-                        if self.postgres_update_task and not self.postgres_update_task.done():
-                            await self.postgres_update_task
-
-                        self.postgres_update_task = asyncio.create_task(
-                            self.process_batch()
-                        )
-            except websockets.exceptions.ConnectionClosedError:
-                # On disconnect, ensure we process remaining posts in the batch
-                if self.postgres_update_task and not self.postgres_update_task.done():
-                    await self.postgres_update_task
+                    self.deletions.append(deletion)
+                    self.metrics.num_deletions += 1
+                    self.metrics.total_deletions += 1
+
+                    if len(self.deletions) >= self.batch_size:
+                        self.flush_deletions()
+
+                    continue
 
-                await self.process_batch()
+                post = self.parse_post(data)
+                if not post:
+                    self.metrics.drop("invalid")
+                    continue
 
-                # Update cursor in WS URL
-                ws_factory.uri = await self.gen_jetstream_url()
+                reason = self.post_filter.reject_post(post)
+                if reason:
+                    self.metrics.drop(reason)
+                    continue
 
-                logger.warning("Connection closed. Reconnecting...")
+                self.batch.append(post)
+                self.metrics.num_received += 1
+
+                if len(self.batch) >= self.batch_size:
+                    self.flush()
+            finally:
+                self.message_queue.task_done()
+
+    def is_first_copy(self, data: dict) -> bool:
+        """Check whether an event was not already received from another endpoint."""
+
+        commit = data.get('commit')
+        if not commit:
+            return True
+
+        key = (data.get('did'), commit.get('rkey'), commit.get('operation'))
+
+        return self.recently_seen.add(key)
+
+    def parse_post(self, data: dict) -> dict | None:
+        """Extract a new post from a Jetstream event, returns None for any other event."""
+
+        if data.get('kind') != "commit":
+            return
+
+        commit = data.get('commit', {})
+        if not commit:
+            return
+
+        if commit.get('operation') != "create":
+            return
+
+        if commit.get('collection') != "app.bsky.feed.post":
+            return
+
+        record = commit.get('record', {})
+        if not record:
+            return
+
+        if record.get('$type', "") != "app.bsky.feed.post":
+            return
+
+        if not data.get('did'):
+            return
+
+        if not commit.get('rkey'):
+            return
+
+        if not commit.get('cid'):
+            return
+
+        if not data.get('time_us'):
+            return
+
+        post_text = (record.get('text') or '').strip().replace('\x00', '')
+        if not post_text:
+            return
+
+        return {
+            'time_us': data['time_us'],
+            'created_at': post_created_at(commit['rkey'], data['time_us']),
+            'did': data['did'],
+            'rkey': commit['rkey'],
+            'cid': commit['cid'],
+            'post_text': post_text,
+            'language': record.get('langs', [])
+        }
+
+    def parse_deletion(self, data: dict) -> dict | None:
+        """Extract a deleted post from a Jetstream event, returns None for any other event."""
+
+        if data.get('kind') != "commit":
+            return
+
+        commit = data.get('commit', {})
+        if not commit:
+            return
+
+        if commit.get('operation') != "delete":
+            return
+
+        if commit.get('collection') != "app.bsky.feed.post":
+            return
+
+        if not data.get('did') or not commit.get('rkey') or not data.get('time_us'):
+            return
+
+        return {
+            'time_us': data['time_us'],
+            'did': data['did'],
+            'rkey': commit['rkey'],
+        }
+
+    def flush(self):
+        """
+        Hand the current batch to the database writers.
+
+        If the write queue is full, the batch is spilled to disk instead.
+        """
 
-    async def process_batch(self):
         if not self.batch:
             return
 
+        batch = PostBatch(next(self.batch_seq), self.batch)
+        self.batch = []
+        self.last_flush = time.monotonic()
+
+        try:
+            self.uncommitted[batch.seq] = batch.min_time_us
+            self.write_queue.put_nowait(batch)
+        except asyncio.QueueFull:
+            # Spilled batches are durable, so don't hold back the checkpoint
+            del self.uncommitted[batch.seq]
+            self.spill.append(batch.rows)
+
+    def flush_deletions(self):
+        """Hand the current batch of deletions to the deletion writer."""
+
+        if not self.deletions:
+            return
+
+        batch = DeletionBatch(next(self.batch_seq), self.deletions)
+        self.deletions = []
+
+        self.uncommitted[batch.seq] = batch.min_time_us
+        self.deletion_queue.put_nowait(batch)
+
+    async def flush_periodically(self):
+        """Ensure posts and deletions are written at least every `flush_interval` seconds."""
+
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            if self.batch and time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+            self.flush_deletions()
+
+    async def write_batches(self):
+        """Pipeline stage writing batches from the write queue to the database."""
+
+        while True:
+            batch = await self.write_queue.get()
+
+            try:
+                await self.process_batch(batch)
+            finally:
+                self.write_queue.task_done()
+
+    async def drain_spill(self):
+        """
+        Write spilled batches to the database, once the database has caught up with live data.
+        """
+
+        while True:
+            await asyncio.sleep(1)
+
+            if not self.spill.num_batches or not self.write_queue.empty():
+                continue
+
+            self.spill.rotate()
+            for path in self.spill.closed_segments():
+                for rows in self.spill.read_segment(path):
+                    if not await self.process_batch(PostBatch(None, rows)):
+                        # Retry the whole segment later, already stored posts are skipped
+                        break
+                else:
+                    self.spill.remove(path)
+
+                # Give priority to live data
+                if not self.write_queue.empty():
+                    break
+
+    async def write_deletions(self):
+        """Pipeline stage recording batches of deletions in the database."""
+
+        while True:
+            batch = await self.deletion_queue.get()
+
+            try:
+                await self.process_deletions(batch)
+            finally:
+                self.deletion_queue.task_done()
+
+    async def process_deletions(self, batch: DeletionBatch) -> bool:
+        async with async_session() as session:
+            try:
+                await record_deletions(session, batch.rows)
+
+                checkpoint = self.get_safe_checkpoint(batch)
+                if checkpoint:
+                    await self.update_checkpoint(session, checkpoint)
+
+                await session.commit()
+            except (StatementError, asyncpg.PostgresError) as e:
+                logger.exception(e)
+                return False
+            finally:
+                del self.uncommitted[batch.seq]
+
+        return True
+
+    def get_compaction_watermark(self) -> int | None:
+        """
+        Determine up to which event time recorded deletions can be applied.
+
+        A post is always created before it is deleted, so a deletion can be applied once all
+        posts received before it are written. This excludes posts still in the current batch,
+        in the write queue, or spilled to disk.
+        """
+
+        if self.spill.num_batches:
+            return
+
+        pending = list(self.uncommitted.values())
+        if self.batch:
+            pending.append(min(row['time_us'] for row in self.batch))
+
+        if pending:
+            return min(pending)
+
+        return self.last_time_us
+
+    async def compact(self) -> bool:
+        """
+        Apply recorded deletions up to the watermark. Returns True if there may be more
+        deletions to apply.
+        """
+
+        watermark = self.get_compaction_watermark()
+        if not watermark:
+            return False
+
+        max_deletions = 10_000
         async with async_session() as session:
-            stmt = (insert(Post)
-                    .on_conflict_do_nothing()
-                    .returning(Post.id))
+            try:
+                num_deletions, num_posts = await compact_deletions(session, watermark, max_deletions)
+                await session.commit()
+            except (StatementError, asyncpg.PostgresError) as e:
+                logger.exception(e)
+                return False
+
+        if num_deletions:
+            logger.debug("Applied %d deletions, removed %d posts.", num_deletions, num_posts)
+
+        self.metrics.total_deleted_posts += num_posts
+        POSTS_DELETED.inc(num_posts)
+
+        return num_deletions >= max_deletions
+
+    async def compact_periodically(self):
+        """Apply recorded deletions every `compact_interval` seconds."""
+
+        while True:
+            await asyncio.sleep(self.compact_interval)
+
+            # Keep going while catching up with a burst of deletions
+            while await self.compact():
+                await asyncio.sleep(0)
+
+    def get_safe_checkpoint(self, batch: PostBatch) -> int | None:
+        """
+        Determine the checkpoint to store together with the given batch.
 
-            batch_size = len(self.batch)
+        Batches may be committed out of order by concurrent writers. The checkpoint must not
+        move past posts of earlier batches that are still in the write queue or being written,
+        otherwise these are not replayed when restarting.
+        """
+
+        if batch.seq is None:
+            # Batches recovered from spill segments are older than the current checkpoint
+            return
+
+        earlier = [time_us for seq, time_us in self.uncommitted.items() if seq < batch.seq]
 
+        # Posts and deletions are batched separately, so those not yet flushed may be older
+        earlier.extend(min(row['time_us'] for row in rows) for rows in (self.batch, self.deletions) if rows)
+
+        return min(earlier) if earlier else batch.max_time_us
+
+    async def process_batch(self, batch: PostBatch) -> bool:
+        start = time.perf_counter()
+
+        async with async_session() as session:
             try:
-                result = await session.execute(
-                    stmt,
-                    self.batch
-                )
+                inserted = await self.writer.write(session, batch.rows)
+
+                checkpoint = self.get_safe_checkpoint(batch)
+                if checkpoint:
+                    await self.update_checkpoint(session, checkpoint)
+
+                commit_start = time.perf_counter()
                 await session.commit()
-            except StatementError as e:
+            except (StatementError, asyncpg.PostgresError) as e:
                 logger.exception(e)
-                self.console.print(list(islice(self.batch, self.batch_size)))
-                result = []
+                self.console.print(batch.rows)
+                return False
+            finally:
+                if batch.seq is not None:
+                    del self.uncommitted[batch.seq]
 
-            # Remove processed entries
-            for _ in range(batch_size):
-                self.batch.popleft()
+            end = time.perf_counter()
+            INSERT_SECONDS.observe(commit_start - start)
+            COMMIT_SECONDS.observe(end - commit_start)
+            INGEST_LAG_SECONDS.observe(time.time() - batch.min_time_us / 1e6)
 
-            inserted = list(result)
             self.metrics.num_inserted += len(inserted)
+            self.metrics.total_inserted += len(inserted)
+            self.metrics.write_latencies.append(end - start)
+
+            return True
+
+    def format_lags(self) -> str:
+        if len(self.endpoints) < 2:
+            return ""
+
+        lags = [
+            f"{endpoint.hostname} {endpoint.lag:.1f}s" if endpoint.ws and endpoint.lag is not None
+            else f"{endpoint.hostname} disconnected"
+            for endpoint in self.endpoints
+        ]
+
+        return f", duplicates: {self.metrics.total_duplicates}, lag: {', '.join(lags)}"
 
     async def update_stats(self):
         await asyncio.sleep(1)
         self.metrics.tick()
 
+        QUEUED.labels('messages').set(self.message_queue.qsize())
+        QUEUED.labels('batches').set(self.write_queue.qsize())
+        QUEUED.labels('deletion_batches').set(self.deletion_queue.qsize())
+        QUEUED.labels('spilled_batches').set(self.spill.num_batches)
+
         if sys.stdout.isatty():
             recv_per_s = self.metrics.get_avg_received_per_tick()
+            drop_per_s = self.metrics.get_avg_dropped_per_tick()
             ins_per_s = self.metrics.get_avg_inserted_per_tick()
-
-            print(f"Receiving {recv_per_s:.0f} msg/s, inserting {ins_per_s:.0f} msg/s", end='\r',
-                  file=sys.stderr)
+            kib_per_s = self.metrics.get_avg_bytes_per_tick() / 1024
+            decode_us = self.metrics.get_avg_decode_time_per_message()
+
+            del_per_s = self.metrics.get_avg_deletions_per_tick()
+
+            print(f"Receiving {recv_per_s:.0f} msg/s ({kib_per_s:.0f} KiB/s, {decode_us:.1f} µs/msg decode, "
+                  f"{drop_per_s:.0f} msg/s dropped), "
+                  f"inserting {ins_per_s:.0f} msg/s, "
+                  f"deletions: {del_per_s:.0f} msg/s ({self.metrics.total_deleted_posts} posts removed), "
+                  f"queued: {self.message_queue.qsize()} msgs, {self.write_queue.qsize()} batches, "
+                  f"{self.deletion_queue.qsize()} deletion batches, "
+                  f"spilled: {self.spill.num_batches} batches{self.format_lags()}", end='\r', file=sys.stderr)
 
         self.stats_task = asyncio.create_task(self.update_stats())
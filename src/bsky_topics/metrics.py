@@ -0,0 +1,67 @@
+"""
+`bsky_topics.metrics` - Prometheus metrics of the collector and embedder
+
+Metrics are registered in the default registry, and exposed over HTTP with
+`start_metrics_server()`.
+"""
+
+import logging
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+logger = logging.getLogger(__name__)
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0)
+LAG_BUCKETS = (.1, .25, .5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0, 900.0, 3600.0)
+
+
+# Collector
+MESSAGES_RECEIVED = Counter('bsky_topics_messages_received', "Jetstream messages received.")
+BYTES_RECEIVED = Counter('bsky_topics_received_bytes', "Size of received Jetstream messages on the wire.")
+MESSAGES_DROPPED = Counter('bsky_topics_messages_dropped', "Messages dropped, by filter rule.", ['rule'])
+DUPLICATES = Counter('bsky_topics_duplicates', "Events skipped because they were received from another endpoint.")
+
+POSTS_RECEIVED = Counter('bsky_topics_posts_received', "New posts accepted by the filter rules.")
+POSTS_INSERTED = Counter('bsky_topics_posts_inserted', "Posts inserted in the database.")
+DELETIONS_RECEIVED = Counter('bsky_topics_deletions_received', "Post deletions received.")
+POSTS_DELETED = Counter('bsky_topics_posts_deleted', "Posts removed from the database because they were deleted.")
+
+INSERT_SECONDS = Histogram('bsky_topics_insert_seconds', "Time to write a batch of posts, excluding commit.",
+                           buckets=LATENCY_BUCKETS)
+COMMIT_SECONDS = Histogram('bsky_topics_commit_seconds', "Time to commit a batch of posts.",
+                           buckets=LATENCY_BUCKETS)
+INGEST_LAG_SECONDS = Histogram('bsky_topics_ingest_lag_seconds',
+                               "Time between the Jetstream event time of the oldest post in a batch, and "
+                               "committing the batch.", buckets=LAG_BUCKETS)
+
+QUEUED = Gauge('bsky_topics_queued', "Number of items waiting in each collector queue.", ['queue'])
+
+
+# Embedder
+EMBED_BACKLOG = Gauge('bsky_topics_embed_backlog', "Number of posts waiting for an embedding.")
+POSTS_EMBEDDED = Counter('bsky_topics_posts_embedded', "Posts for which an embedding was stored.")
+POSTS_EXCLUDED = Counter('bsky_topics_posts_excluded', "Posts excluded because their embedding failed.")
+EMBED_STAGE_SECONDS = Histogram('bsky_topics_embed_stage_seconds', "Time spent on each stage of an embed batch.",
+                                ['stage'], buckets=LATENCY_BUCKETS)
+EMBED_STAGE_BUSY_SECONDS = Counter('bsky_topics_embed_stage_busy_seconds',
+                                   "Time each embed pipeline stage spent working rather than waiting for input "
+                                   "or for room in its output queue.", ['stage'])
+EMBED_STAGE_UTILISATION = Gauge('bsky_topics_embed_stage_utilisation',
+                                "Fraction of time each embed pipeline stage was busy, over the last interval.",
+                                ['stage'])
+EMBED_CACHE_LOOKUPS = Counter('bsky_topics_embed_cache_lookups',
+                              "Posts looked up in the embedding cache, by result: hit in the in-process cache "
+                              "(memory), hit in the database (table), or miss.", ['result'])
+EMBED_CACHE_SAVED_SECONDS = Counter('bsky_topics_embed_cache_saved_seconds',
+                                    "Estimated segmentation and encoding time saved by embedding cache hits.")
+EMBED_QUEUED = Gauge('bsky_topics_embed_queued', "Number of batches waiting in each embed pipeline queue.",
+                     ['queue'])
+
+
+def start_metrics_server(address: str):
+    """Serve metrics in Prometheus text format on HOST:PORT, in a background thread."""
+
+    host, _, port = address.rpartition(':')
+    start_http_server(int(port), host or 'localhost')
+
+    logger.info("Serving metrics on http://%s:%s/metrics", host or 'localhost', port)
@@ -0,0 +1,114 @@
+"""
+`bsky_topics.replay` - Replay recorded Jetstream traffic
+"""
+
+from __future__ import annotations
+import asyncio
+from dataclasses import dataclass
+import logging
+from pathlib import Path
+import time
+from typing import AsyncIterator
+
+import numpy
+from websockets.asyncio.server import serve, ServerConnection
+
+from bsky_topics.jetstream import JetstreamCollector
+from bsky_topics.segments import read_frames
+
+logger = logging.getLogger(__name__)
+
+
+async def paced_frames(directory: str | Path, speed: float = 1.0) -> AsyncIterator[bytes]:
+    """
+    Yield recorded frames at `speed` times the pace they were recorded.
+
+    A speed of zero yields frames as fast as possible.
+    """
+
+    start = time.monotonic()
+    first_time_ns = None
+
+    for time_ns, frame in read_frames(directory):
+        if speed > 0:
+            if first_time_ns is None:
+                first_time_ns = time_ns
+
+            delay = (time_ns - first_time_ns) / 1e9 / speed - (time.monotonic() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+        yield frame
+
+
+async def serve_frames(directory: str | Path, host: str, port: int, speed: float = 1.0):
+    """
+    Run a local websocket server standing in for Jetstream.
+
+    Each connecting client receives all recorded frames from the start, regardless of cursor.
+    The connection stays open after all frames are sent.
+    """
+
+    async def handler(ws: ServerConnection):
+        logger.info("Client connected, replaying %s", directory)
+
+        async for frame in paced_frames(directory, speed):
+            await ws.send(frame)
+
+        # Keep the connection open, otherwise the collector reconnects and receives everything again
+        logger.info("Replay finished.")
+        await ws.wait_closed()
+
+    async with serve(handler, host, port, max_size=None) as server:
+        await server.serve_forever()
+
+
+@dataclass
+class ReplayResult:
+    num_messages: int
+    num_inserted: int
+    elapsed: float
+    catch_up_time: float
+    write_latencies: numpy.ndarray
+
+    @property
+    def messages_per_sec(self) -> float:
+        return self.num_messages / self.elapsed if self.elapsed else 0.0
+
+    def write_latency_percentile(self, q: float) -> float:
+        if not len(self.write_latencies):
+            return 0.0
+
+        return float(numpy.percentile(self.write_latencies, q))
+
+
+async def replay_into_collector(collector: JetstreamCollector, directory: str | Path,
+                                speed: float = 0.0) -> ReplayResult:
+    """
+    Feed recorded frames directly into the collector pipeline.
+
+    Catch-up time is the time between the last frame fed to the collector, and all posts
+    being written to the database.
+    """
+
+    last_fed = None
+
+    async def frames():
+        nonlocal last_fed
+
+        async for frame in paced_frames(directory, speed):
+            yield frame
+
+        last_fed = time.perf_counter()
+
+    start = time.perf_counter()
+    await collector.replay(frames())
+    end = time.perf_counter()
+
+    return ReplayResult(
+        collector.metrics.total_messages,
+        collector.metrics.total_inserted,
+        end - start,
+        end - last_fed,
+        numpy.array(collector.metrics.write_latencies),
+    )
@@ -0,0 +1,193 @@
+"""
+`bsky_topics.segments` - Append-only segment files to store collector data on disk
+"""
+
+from __future__ import annotations
+from datetime import datetime
+import logging
+from pathlib import Path
+import struct
+import time
+from typing import BinaryIO, Iterator
+
+import orjson
+import zstandard
+
+logger = logging.getLogger(__name__)
+
+
+class SpillSegments:
+    """
+    Temporarily stores batches of posts on disk when the database can't keep up.
+
+    Batches are appended as JSON lines to the current segment file. Segments are rotated after
+    `max_segment_batches` batches, or explicitly using `rotate()`. Closed segments can be read
+    back in the order they were written, and should be removed once their batches are stored in
+    the database.
+    """
+
+    SUFFIX = ".spill"
+
+    def __init__(self, directory: str | Path, max_segment_batches: int = 1000):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.max_segment_batches = max_segment_batches
+
+        self.current_path: Path | None = None
+        self.current_file: BinaryIO | None = None
+
+        # Number of batches in each segment, including those left behind by a previous run.
+        # Corrupt batches are not counted, as they are skipped when reading the segment.
+        self.segment_batches: dict[Path, int] = {
+            path: sum(1 for _ in self.read_batches(path)) for path in self.closed_segments()
+        }
+
+    @property
+    def num_batches(self) -> int:
+        return sum(self.segment_batches.values())
+
+    def append(self, rows: list[dict]):
+        if not self.current_file:
+            self.current_path = self.directory / f"{time.time_ns()}{self.SUFFIX}"
+            self.current_file = open(self.current_path, 'ab')
+            self.segment_batches[self.current_path] = 0
+
+        self.current_file.write(orjson.dumps(rows) + b'\n')
+        self.current_file.flush()
+
+        self.segment_batches[self.current_path] += 1
+        if self.segment_batches[self.current_path] >= self.max_segment_batches:
+            self.rotate()
+
+    def rotate(self):
+        """Close the current segment, new batches will be written to a new segment."""
+        if self.current_file:
+            self.current_file.close()
+
+        self.current_path = None
+        self.current_file = None
+
+    def closed_segments(self) -> list[Path]:
+        """List segments not being written to, oldest first."""
+        return sorted(
+            (p for p in self.directory.glob(f"*{self.SUFFIX}") if p != self.current_path),
+            key=lambda p: int(p.stem)
+        )
+
+    def read_batches(self, path: Path) -> Iterator[list[dict]]:
+        """Read the batches of a segment as stored, skipping corrupt batches."""
+
+        with open(path, 'rb') as ifile:
+            for line in ifile:
+                try:
+                    yield orjson.loads(line)
+                except orjson.JSONDecodeError:
+                    # Incomplete last line after a crash
+                    logger.warning("Skipping corrupt batch in spill segment %s", path)
+
+    def read_segment(self, path: Path) -> Iterator[list[dict]]:
+        for rows in self.read_batches(path):
+            # Timestamps are serialized as ISO 8601 strings
+            for row in rows:
+                row['created_at'] = datetime.fromisoformat(row['created_at'])
+
+            yield rows
+
+    def remove(self, path: Path):
+        """Remove a segment once all its batches are stored."""
+
+        path.unlink()
+        self.segment_batches.pop(path, None)
+
+
+class FrameRecorder:
+    """
+    Records raw websocket frames to rotating zstd compressed segment files.
+
+    Each frame is stored with the time it was received (nanoseconds since Unix epoch), such that
+    traffic can be replayed at the original pace. Frames are stored as received, i.e., when
+    collecting with `--compress`, the recorded frames are compressed with the Jetstream
+    dictionary.
+    """
+
+    SUFFIX = ".frames.zst"
+    HEADER = struct.Struct('<qI')
+
+    def __init__(self, directory: str | Path, max_segment_frames: int = 100_000, level: int = 3):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+        self.max_segment_frames = max_segment_frames
+        self.compressor = zstandard.ZstdCompressor(level=level)
+
+        self.current_file: BinaryIO | None = None
+        self.current_frames: int = 0
+
+    def write(self, frame: bytes, time_ns: int | None = None):
+        if not self.current_file:
+            path = self.directory / f"{time.time_ns()}{self.SUFFIX}"
+            self.current_file = self.compressor.stream_writer(open(path, 'wb'))
+            self.current_frames = 0
+
+        self.current_file.write(self.HEADER.pack(time_ns or time.time_ns(), len(frame)))
+        self.current_file.write(frame)
+
+        self.current_frames += 1
+        if self.current_frames >= self.max_segment_frames:
+            self.rotate()
+
+    def rotate(self):
+        """Close the current segment, new frames will be written to a new segment."""
+        if self.current_file:
+            self.current_file.close()
+
+        self.current_file = None
+
+    def close(self):
+        self.rotate()
+
+
+def read_frames(directory: str | Path) -> Iterator[tuple[int, bytes]]:
+    """
+    Read recorded frames from all segments in a directory, in the order they were recorded.
+
+    Yields tuples with the receive time in nanoseconds and the raw frame.
+    """
+
+    paths = sorted(Path(directory).glob(f"*{FrameRecorder.SUFFIX}"),
+                   key=lambda p: int(p.name.removesuffix(FrameRecorder.SUFFIX)))
+    decompressor = zstandard.ZstdDecompressor()
+
+    for path in paths:
+        with open(path, 'rb') as ifile, decompressor.stream_reader(ifile) as reader:
+            try:
+                while True:
+                    header = _read_exact(reader, FrameRecorder.HEADER.size)
+                    if len(header) < FrameRecorder.HEADER.size:
+                        break
+
+                    time_ns, length = FrameRecorder.HEADER.unpack(header)
+                    frame = _read_exact(reader, length)
+                    if len(frame) < length:
+                        break
+
+                    yield time_ns, frame
+            except zstandard.ZstdError:
+                # Incomplete segment after a crash
+                logger.warning("Segment %s is truncated, skipping remaining frames.", path)
+
+
+def _read_exact(reader: BinaryIO, size: int) -> bytes:
+    """Read `size` bytes from a stream, unless end of stream is reached."""
+
+    chunks = []
+    while size > 0:
+        chunk = reader.read(size)
+        if not chunk:
+            break
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return b''.join(chunks)
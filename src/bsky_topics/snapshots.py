@@ -0,0 +1,261 @@
+"""
+Export post embeddings to memory-mapped snapshots on disk
+
+Each day of embeddings is stored as two NumPy files in the snapshot directory: `YYYY-MM-DD.ids.npy`
+with the post ids, and `YYYY-MM-DD.embeddings.npy` with their float32 embeddings, in the same order.
+Days are exported by streaming rows over a server-side cursor directly into the memory-mapped
+files, such that memory usage doesn't depend on the number of posts, and are opened lazily with
+`open_snapshots`.
+"""
+
+from __future__ import annotations
+from datetime import date, datetime, time, timedelta
+import logging
+from pathlib import Path
+
+import numpy
+from numpy.lib.format import open_memmap
+
+from bsky_topics.db import async_session
+from bsky_topics.db.search import EMBEDDING_DIM
+from bsky_topics.db.session import get_driver_connection
+
+logger = logging.getLogger(__name__)
+
+# Number of rows fetched from the cursor at a time
+FETCH_SIZE = 10_000
+
+# pgvector's binary `halfvec` format, as returned by `halfvec_send`
+HALFVEC_DTYPE = numpy.dtype([
+    ('dim', '>u2'),
+    ('unused', '>u2'),
+    ('values', '>f2', (EMBEDDING_DIM,)),
+])
+
+
+def snapshot_paths(directory: str | Path, day: date) -> tuple[Path, Path]:
+    """Paths of the post ids and embeddings files of a day."""
+
+    directory = Path(directory)
+    return directory / f"{day.isoformat()}.ids.npy", directory / f"{day.isoformat()}.embeddings.npy"
+
+
+def snapshot_days(directory: str | Path) -> list[date]:
+    """List days with a complete snapshot, oldest first."""
+
+    days = []
+    for ids_path in Path(directory).glob("*.ids.npy"):
+        day = date.fromisoformat(ids_path.name.removesuffix(".ids.npy"))
+        if snapshot_paths(directory, day)[1].is_file():
+            days.append(day)
+
+    return sorted(days)
+
+
+async def export_day(directory: str | Path, day: date) -> int:
+    """
+    Export embeddings of posts created on `day` to the snapshot directory, and return the number
+    of embeddings exported.
+
+    The row count and the cursor use the same snapshot of the database, so the files can be
+    allocated up front. Files are written under a temporary name, and renamed when complete.
+    """
+
+    ids_path, embeddings_path = snapshot_paths(directory, day)
+    ids_tmp, embeddings_tmp = ids_path.with_suffix(".tmp"), embeddings_path.with_suffix(".tmp")
+
+    start = datetime.combine(day, time())
+    end = start + timedelta(days=1)
+
+    async with async_session() as session:
+        await session.connection(execution_options={'isolation_level': 'REPEATABLE READ'})
+        conn = await get_driver_connection(session)
+
+        num_rows = await conn.fetchval("""
+            SELECT COUNT(*) FROM post_embeddings WHERE post_created_at >= $1 AND post_created_at < $2
+        """, start, end)
+
+        post_ids = open_memmap(ids_tmp, mode='w+', dtype=numpy.int64, shape=(num_rows,))
+        embeddings = open_memmap(embeddings_tmp, mode='w+', dtype=numpy.float32, shape=(num_rows, EMBEDDING_DIM))
+
+        # Fetch embeddings in their binary format, to decode them in bulk instead of parsing text
+        cursor = await conn.cursor("""
+            SELECT post_id, halfvec_send(embedding) FROM post_embeddings
+            WHERE post_created_at >= $1 AND post_created_at < $2
+        """, start, end)
+
+        offset = 0
+        while rows := await cursor.fetch(FETCH_SIZE):
+            vectors = numpy.frombuffer(b"".join(row[1] for row in rows), dtype=HALFVEC_DTYPE)
+
+            post_ids[offset:offset+len(rows)] = [row[0] for row in rows]
+            embeddings[offset:offset+len(rows)] = vectors['values']
+            offset += len(rows)
+
+    if offset != num_rows:
+        raise RuntimeError(f"Expected {num_rows} embeddings for {day}, got {offset}.")
+
+    post_ids.flush()
+    embeddings.flush()
+    del post_ids, embeddings
+
+    # The ids file marks a complete snapshot, so rename it last
+    embeddings_tmp.replace(embeddings_path)
+    ids_tmp.replace(ids_path)
+
+    return num_rows
+
+
+async def count_embeddings(since: date, until: date) -> dict[date, int]:
+    """Number of embeddings of posts created on each day in [`since`, `until`), days without posts are missing."""
+
+    async with async_session() as session:
+        conn = await get_driver_connection(session)
+
+        rows = await conn.fetch("""
+            SELECT post_created_at::date, COUNT(*) FROM post_embeddings
+            WHERE post_created_at >= $1 AND post_created_at < $2
+            GROUP BY 1
+        """, datetime.combine(since, time()), datetime.combine(until, time()))
+
+    return {day: num_rows for day, num_rows in rows}
+
+
+async def outdated_snapshots(directory: str | Path, days: list[date]) -> set[date]:
+    """
+    Days of which the snapshot has a different number of embeddings than the database, e.g.,
+    because posts were embedded after the day was exported.
+    """
+
+    if not days:
+        return set()
+
+    counts = await count_embeddings(min(days), max(days) + timedelta(days=1))
+
+    outdated = set()
+    for day in days:
+        ids_path, _ = snapshot_paths(directory, day)
+        if len(numpy.load(ids_path, mmap_mode='r')) != counts.get(day, 0):
+            outdated.add(day)
+
+    return outdated
+
+
+async def export_snapshots(directory: str | Path, since: date, until: date, overwrite: bool = False,
+                           recheck_days: int = 7) -> list[tuple[date, int]]:
+    """
+    Export embeddings of each day in [`since`, `until`) without a snapshot, or of all days if
+    `overwrite` is set. Returns the exported days, with their number of embeddings.
+
+    Embeddings can be written after their day was exported, e.g., when the embed workers lag
+    behind, a claim is retried, or posts are backfilled. Snapshots of the last `recheck_days`
+    days before `until` are therefore exported again if their number of embeddings changed.
+    """
+
+    Path(directory).mkdir(parents=True, exist_ok=True)
+    existing = set() if overwrite else set(snapshot_days(directory))
+
+    recent = [day for day in existing if since <= day < until and day >= until - timedelta(days=recheck_days)]
+    outdated = await outdated_snapshots(directory, recent)
+    if outdated:
+        logger.info("Exporting %d outdated snapshots again", len(outdated))
+        existing -= outdated
+
+    exported = []
+    day = since
+    while day < until:
+        if day not in existing:
+            num_rows = await export_day(directory, day)
+            logger.info("Exported %d embeddings of %s", num_rows, day)
+
+            exported.append((day, num_rows))
+
+        day += timedelta(days=1)
+
+    return exported
+
+
+class SnapshotArray:
+    """
+    Array-like concatenation of the memory-mapped arrays of consecutive days.
+
+    Supports indexing with integers, slices, integer arrays and boolean masks. Only the
+    requested rows are read from disk, and returned as a regular numpy array.
+    """
+
+    def __init__(self, chunks: list[numpy.ndarray]):
+        self.chunks = chunks
+        self.offsets = numpy.cumsum([0] + [len(chunk) for chunk in chunks])
+
+    @property
+    def shape(self) -> tuple[int, ...]:
+        return (int(self.offsets[-1]), *self.chunks[0].shape[1:])
+
+    @property
+    def dtype(self) -> numpy.dtype:
+        return self.chunks[0].dtype
+
+    def __len__(self) -> int:
+        return int(self.offsets[-1])
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, numpy.integer)):
+            if item < 0:
+                item += len(self)
+            if not 0 <= item < len(self):
+                raise IndexError(f"Index {item} out of range for length {len(self)}")
+
+            chunk = numpy.searchsorted(self.offsets, item, side='right') - 1
+            return numpy.array(self.chunks[chunk][item - self.offsets[chunk]])
+
+        if isinstance(item, slice):
+            indices = numpy.arange(*item.indices(len(self)))
+        else:
+            indices = numpy.asarray(item)
+            if indices.dtype == numpy.bool_:
+                if indices.shape != (len(self),):
+                    raise IndexError(f"Boolean index of shape {indices.shape} doesn't match length {len(self)}")
+                indices = numpy.flatnonzero(indices)
+            else:
+                indices = numpy.where(indices < 0, indices + len(self), indices).astype(numpy.int64, copy=False)
+                if indices.size and (indices.min() < 0 or indices.max() >= len(self)):
+                    raise IndexError(f"Index out of range for length {len(self)}")
+
+        result = numpy.empty((len(indices), *self.shape[1:]), dtype=self.dtype)
+        chunk_ix = numpy.searchsorted(self.offsets, indices, side='right') - 1
+        for chunk in numpy.unique(chunk_ix):
+            mask = chunk_ix == chunk
+            result[mask] = self.chunks[chunk][indices[mask] - self.offsets[chunk]]
+
+        return result
+
+    def __array__(self, dtype=None, copy=None) -> numpy.ndarray:
+        return numpy.concatenate(self.chunks).astype(dtype or self.dtype, copy=False)
+
+    def iter_chunks(self):
+        """Iterate over the memory-mapped array of each day."""
+
+        yield from self.chunks
+
+
+def open_snapshots(directory: str | Path, since: date | None = None,
+                   until: date | None = None) -> tuple[SnapshotArray, SnapshotArray]:
+    """
+    Memory-map the snapshots of each day in [`since`, `until`), and return the post ids and their
+    embeddings.
+    """
+
+    days = [day for day in snapshot_days(directory)
+            if (since is None or day >= since) and (until is None or day < until)]
+
+    if not days:
+        raise FileNotFoundError(f"No snapshots in {directory} for the given date range.")
+
+    post_ids = []
+    embeddings = []
+    for day in days:
+        ids_path, embeddings_path = snapshot_paths(directory, day)
+        post_ids.append(numpy.load(ids_path, mmap_mode='r'))
+        embeddings.append(numpy.load(embeddings_path, mmap_mode='r'))
+
+    return SnapshotArray(post_ids), SnapshotArray(embeddings)
@@ -0,0 +1,212 @@
+"""
+`bsky_topics.topic_assignment` - Assign new posts to the topic with the nearest centroid
+
+Topics are stored in the `topics` table, each with the centroid of the embeddings of its posts.
+Embed workers keep all centroids in memory as a single matrix, such that the topics of a batch
+of posts are found with one matrix multiply, and store the topic with the embedding. Feeds of
+a topic are then a lookup on the topic index of `post_embeddings`, see `topic_posts`.
+"""
+
+from __future__ import annotations
+from datetime import datetime, UTC
+from typing import NamedTuple
+
+import numpy
+from sqlalchemy import select, delete, update, func, bindparam
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from bsky_topics.db.schema import Topic, PostEmbedding, topic_id_seq
+
+
+class TopicAssignment(NamedTuple):
+    topic_ids: numpy.ndarray
+
+    # Cosine distance of each post to the centroid of its topic
+    distances: numpy.ndarray
+
+
+def normalize_rows(X: numpy.ndarray) -> numpy.ndarray:
+    X = numpy.asarray(X, dtype=numpy.float32)
+    return X / numpy.maximum(numpy.linalg.norm(X, axis=1, keepdims=True), 1e-12)
+
+
+class TopicAssigner:
+    """
+    Assigns embeddings to the topic with the most similar centroid.
+
+    With a `decay` rate, centroids follow the posts assigned to them: each post moves its
+    centroid a fraction `decay` towards it, such that the influence of older posts decays
+    exponentially. Updated centroids are written back with `persist()`. Only one worker should
+    update centroids, as concurrent workers overwrite each other's updates.
+    """
+
+    def __init__(self, topic_ids: numpy.ndarray, centroids: numpy.ndarray, num_posts: numpy.ndarray | None = None,
+                 decay: float = 0.0):
+        self.topic_ids = numpy.asarray(topic_ids, dtype=numpy.int64)
+        self.centroids = normalize_rows(centroids)
+        self.num_posts = (numpy.zeros(len(self.topic_ids), dtype=numpy.int64) if num_posts is None
+                          else numpy.asarray(num_posts, dtype=numpy.int64))
+        self.decay = decay
+
+        # Time the topics were loaded, to detect when they are replaced
+        self.loaded_at: datetime | None = None
+
+    def __len__(self) -> int:
+        return len(self.topic_ids)
+
+    @classmethod
+    async def load(cls, session: AsyncSession, decay: float = 0.0) -> TopicAssigner | None:
+        """Load all topics, returns None if there are none."""
+
+        result = await session.execute(select(Topic.id, Topic.centroid, Topic.num_posts).order_by(Topic.id))
+        rows = result.all()
+        if not rows:
+            return None
+
+        assigner = cls(numpy.array([row.id for row in rows]), numpy.stack([row.centroid for row in rows]),
+                       numpy.array([row.num_posts for row in rows]), decay)
+        assigner.loaded_at = await last_topic_update(session)
+
+        return assigner
+
+    def assign(self, embeddings: numpy.ndarray) -> TopicAssignment:
+        """Find the topic with the most similar centroid for each embedding, and update centroids."""
+
+        embeddings = normalize_rows(embeddings)
+        similarities = embeddings @ self.centroids.T
+
+        nearest = similarities.argmax(axis=1)
+        distances = 1 - similarities[numpy.arange(len(embeddings)), nearest]
+
+        counts = numpy.bincount(nearest, minlength=len(self))
+        self.num_posts += counts
+
+        if self.decay:
+            self.update_centroids(embeddings, nearest, counts)
+
+        return TopicAssignment(self.topic_ids[nearest], distances)
+
+    def update_centroids(self, embeddings: numpy.ndarray, nearest: numpy.ndarray, counts: numpy.ndarray):
+        """
+        Move each centroid towards the mean of its assigned embeddings. Applying the decay for
+        each of `n` posts in turn is approximated by a single step with weight 1 - (1 - decay)^n.
+        """
+
+        assigned = counts > 0
+
+        sums = numpy.zeros_like(self.centroids)
+        numpy.add.at(sums, nearest, embeddings)
+        means = sums[assigned] / counts[assigned, None]
+
+        weight = 1 - (1 - self.decay) ** counts[assigned, None]
+        self.centroids[assigned] = normalize_rows((1 - weight) * self.centroids[assigned] + weight * means)
+
+    async def persist(self, session: AsyncSession):
+        """
+        Write updated centroids and post counts to the topics table. Topics which were replaced
+        in the meantime are skipped.
+        """
+
+        now = datetime.now(UTC).replace(tzinfo=None)
+
+        # A Core update, unlike the ORM bulk update by primary key, doesn't fail on missing rows
+        topics = Topic.__table__
+        await session.execute(update(topics).where(topics.c.id == bindparam('topic_id')), [
+            {'topic_id': int(topic_id), 'centroid': centroid, 'num_posts': int(num_posts), 'updated_at': now}
+            for topic_id, centroid, num_posts in zip(self.topic_ids, self.centroids, self.num_posts)
+        ])
+
+
+async def last_topic_update(session: AsyncSession) -> datetime | None:
+    return await session.scalar(select(func.max(Topic.updated_at)))
+
+
+async def replace_topics(session: AsyncSession, centroids: numpy.ndarray, keywords: list[list[str]] | None = None,
+                         num_posts: numpy.ndarray | None = None) -> list[int]:
+    """
+    Replace all topics with a new topic model, with centroids `centroids`. Returns the ID of each
+    topic, new topics never reuse the ID of a replaced topic.
+
+    Embed workers pick up the new topics within their sync interval. Posts embedded before keep
+    the ID of their old topic, which no longer exists, until assigned again with
+    `assign_existing_posts`.
+    """
+
+    await session.execute(delete(Topic))
+
+    if not len(centroids):
+        return []
+
+    result = await session.scalars(select(topic_id_seq.next_value())
+                                   .select_from(func.generate_series(1, len(centroids))))
+    topic_ids = sorted(result)
+
+    await session.execute(insert(Topic), [
+        {
+            'id': topic_id,
+            'centroid': centroid,
+            'keywords': keywords[i] if keywords else [],
+            'num_posts': int(num_posts[i]) if num_posts is not None else 0,
+        }
+        for i, (topic_id, centroid) in enumerate(zip(topic_ids, normalize_rows(centroids)))
+    ])
+
+    return topic_ids
+
+
+async def topic_posts(session: AsyncSession, topic_id: int, limit: int = 50,
+                      before: datetime | None = None) -> list[tuple[int, datetime]]:
+    """
+    The most recent posts of a topic, as (post_id, created_at) tuples, newest first. Page
+    through older posts by passing the `created_at` of the last post as `before`.
+    """
+
+    stmt = (select(PostEmbedding.post_id, PostEmbedding.post_created_at)
+            .where(PostEmbedding.topic_id == topic_id)
+            .order_by(PostEmbedding.post_created_at.desc())
+            .limit(limit))
+
+    if before:
+        stmt = stmt.where(PostEmbedding.post_created_at < before)
+
+    result = await session.execute(stmt)
+
+    return [tuple(row) for row in result]
+
+
+async def assign_existing_posts(session: AsyncSession, assigner: TopicAssigner, since: datetime, until: datetime,
+                                batch_size: int = 10_000) -> int:
+    """
+    Assign topics to the embeddings of posts created in [`since`, `until`), e.g., after replacing
+    the topics. Returns the number of assigned posts. Commits after each batch.
+    """
+
+    last_id = 0
+    num_assigned = 0
+    while True:
+        result = await session.execute(
+            select(PostEmbedding.id, PostEmbedding.post_created_at, PostEmbedding.embedding)
+            .where(PostEmbedding.post_created_at >= since, PostEmbedding.post_created_at < until,
+                   PostEmbedding.id > last_id)
+            .order_by(PostEmbedding.id)
+            .limit(batch_size)
+        )
+        rows = result.all()
+        if not rows:
+            break
+
+        assignment = assigner.assign(numpy.stack([row.embedding for row in rows]))
+
+        # Updates by primary key, which includes the partition key
+        await session.execute(update(PostEmbedding), [
+            {'id': row.id, 'post_created_at': row.post_created_at, 'topic_id': int(topic_id),
+             'topic_distance': float(distance)}
+            for row, topic_id, distance in zip(rows, *assignment)
+        ])
+        await session.commit()
+
+        last_id = rows[-1].id
+        num_assigned += len(rows)
+
+    return num_assigned
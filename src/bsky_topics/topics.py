@@ -3,36 +3,60 @@
 """
 
 from __future__ import annotations
-from datetime import datetime
+import asyncio
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, time, timedelta
+import logging
+import os
+from pathlib import Path
 
 import numpy
+import scipy.sparse
 from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
+import torch
 from torch.utils.data import Dataset, DataLoader
 from sklearn.cluster import MiniBatchKMeans
+from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import CountVectorizer
+from sklearn.preprocessing import normalize
+from sklearn.utils import murmurhash3_32
 
 from bertopic import BERTopic
 from bertopic.vectorizers import ClassTfidfTransformer
 from bertopic.representation import MaximalMarginalRelevance
+from hdbscan import HDBSCAN
+from umap import UMAP
 
 from bsky_topics.db import async_session
 from bsky_topics.db.schema import Post, PostEmbedding
+from bsky_topics.snapshots import SnapshotArray, open_snapshots, snapshot_days
+from bsky_topics.topic_assignment import replace_topics
+
+logger = logging.getLogger(__name__)
 
 
 class PostsDataset(Dataset):
     """
-    Loads post embeddings in memory to be used as a PyTorch dataset
+    Post embeddings to be used as a PyTorch dataset
+
+    Embeddings are either loaded in memory from the database, or memory-mapped from snapshots
+    exported with `bsky-topics snapshot export`, which is faster and uses constant memory.
 
-    TODO: load batches from database on demand for less memory usage.
+    `created_range` is the range [start, end) of the creation times of the posts, if known, such
+    that queries of their texts only scan the partitions of these days.
     """
 
-    def __init__(self, post_ids: numpy.ndarray, post_embeddings: numpy.ndarray):
+    def __init__(self, post_ids: numpy.ndarray | SnapshotArray, post_embeddings: numpy.ndarray | SnapshotArray,
+                 created_range: tuple[datetime, datetime] | None = None):
         self.return_embedding = True
 
         assert len(post_ids) == len(post_embeddings)
 
         self.post_ids = post_ids
         self.post_embeddings = post_embeddings
+        self.created_range = created_range
 
     def return_post_texts(self):
         self.return_embedding = False
@@ -51,74 +75,746 @@ class PostsDataset(Dataset):
 
     @classmethod
     async def load_for_date_range(cls, date_start: datetime, date_end: datetime) -> PostsDataset:
+        """
+        Load embeddings of posts created in the given date range.
+
+        Filters on the partition keys of both tables, such that only the partitions of the
+        requested days are scanned. Needs several times the size of the embeddings in memory,
+        use `from_snapshots` for longer ranges.
+        """
+
         async with async_session() as session:
             stmt = (select(Post.id, PostEmbedding.embedding)
                     .join(PostEmbedding)
-                    .filter(Post.indexed_at >= date_start, Post.indexed_at < date_end))
+                    .filter(Post.created_at >= date_start, Post.created_at < date_end,
+                            PostEmbedding.post_created_at >= date_start,
+                            PostEmbedding.post_created_at < date_end))
 
             post_ids = []
             post_embeddings = []
-            for partition in await session.execute(stmt).yield_per(1024).partitions():
+            result = await session.stream(stmt.execution_options(yield_per=1024))
+            async for partition in result.partitions():
                 for post_id, post_embedding in partition:
-                    post_ids.append(post_ids)
+                    post_ids.append(post_id)
                     post_embeddings.append(post_embedding)
 
             post_ids = numpy.array(post_ids)
             post_embeddings = numpy.vstack(post_embeddings)
 
-            return cls(post_ids, post_embeddings)
+            return cls(post_ids, post_embeddings, (date_start, date_end))
 
+    @classmethod
+    def from_snapshots(cls, directory: str | Path, date_start: date | None = None,
+                       date_end: date | None = None) -> PostsDataset:
+        """
+        Open the snapshots of each day in the given date range, without loading them in memory.
+        """
 
-class PostClusters:
+        post_ids, post_embeddings = open_snapshots(directory, date_start, date_end)
+
+        days = snapshot_days(directory)
+        created_range = (datetime.combine(date_start or days[0], time()),
+                         datetime.combine(date_end or days[-1] + timedelta(days=1), time()))
+
+        return cls(post_ids, post_embeddings, created_range)
+
+
+def squared_distances(X: torch.Tensor, centroids: torch.Tensor) -> torch.Tensor:
+    """Squared Euclidean distances between rows of `X` and `centroids`, as a single matrix multiply."""
+
+    distances = (X * X).sum(dim=1, keepdim=True) - 2 * X @ centroids.T + (centroids * centroids).sum(dim=1)
+    return distances.clamp_(min=0)
+
+
+def nearest_centroids(X: torch.Tensor, centroids: torch.Tensor,
+                      max_elements: int = 2**26) -> tuple[torch.Tensor, torch.Tensor]:
+    """
+    Find the nearest centroid of each row of `X`, and return the squared distances and labels.
+
+    Rows are processed in chunks, such that each distance matrix has at most `max_elements`
+    entries.
+    """
+
+    chunk_size = max(1, max_elements // len(centroids))
+
+    distances = torch.empty(len(X), dtype=X.dtype, device=X.device)
+    labels = torch.empty(len(X), dtype=torch.int64, device=X.device)
+    for start in range(0, len(X), chunk_size):
+        distances[start:start+chunk_size], labels[start:start+chunk_size] = (
+            squared_distances(X[start:start+chunk_size], centroids).min(dim=1))
+
+    return distances, labels
+
+
+class TorchMiniBatchKMeans:
     """
-    Use scikit-learn's MiniBatchKMeans to compute cluster centroids of posts.
+    Mini-batch k-means implemented with PyTorch.
+
+    Distances of a batch to all centroids are computed with a single matrix multiply, which
+    PyTorch runs multithreaded, or on the GPU. In spherical mode, for normalized embeddings,
+    rows and centroids are normalized to unit length, such that posts are clustered by cosine
+    similarity.
+
+    Centroids are initialized with k-means|| on a sample of `init_size` rows: a few rounds of
+    oversampling candidates proportional to their distance to the nearest candidate, which are
+    then weighted by the number of sample rows closest to them and clustered into `n_clusters`
+    centroids. Each batch then moves centroids towards the mean of their assigned rows, with
+    a learning rate of one over the number of rows assigned so far. Like scikit-learn, centroids
+    which are rarely assigned rows are periodically moved to rows far from their centroid.
+
+    Training state can be saved to a checkpoint, and resumed at the batch it stopped.
+    """
+
+    def __init__(self, n_clusters: int = 10_000, batch_size: int = 4096, spherical: bool = True,
+                 init_size: int | None = None, oversampling: float = 0.5, init_rounds: int = 5,
+                 reassignment_ratio: float = 0.01, num_threads: int | None = None, device: str = 'cpu',
+                 seed: int = 0):
+        self.n_clusters = n_clusters
+        self.batch_size = batch_size
+        self.spherical = spherical
+        self.init_size = init_size or 10 * n_clusters
+        self.oversampling = oversampling
+        self.init_rounds = init_rounds
+        self.reassignment_ratio = reassignment_ratio
+        self.num_threads = num_threads
+        self.device = device
+        self.seed = seed
+
+        self.centroids: torch.Tensor | None = None
+        self.counts: torch.Tensor | None = None
+
+        # Position in training, to resume from a checkpoint
+        self.epoch = 0
+        self.step = 0
+        self.steps_since_reassign = 0
+
+        self.generator = torch.Generator(device).manual_seed(seed)
+
+    def fit(self, X: numpy.ndarray | SnapshotArray, epochs: int = 1, checkpoint: str | Path | None = None,
+            checkpoint_every: int = 1000) -> TorchMiniBatchKMeans:
+        """
+        Fit centroids on `X`, an array of shape (n, dim), which may be memory-mapped.
+
+        Each epoch visits the rows in a new random order. If `checkpoint` exists, training
+        resumes from it, and the training state is saved to it every `checkpoint_every` batches.
+        The next batch is read from `X` while the current batch is processed.
+        """
+
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+
+        if checkpoint and Path(checkpoint).is_file():
+            self.load_state(torch.load(checkpoint, weights_only=True))
+            logger.info("Resuming k-means from epoch %d, batch %d", self.epoch, self.step)
+
+        if self.centroids is None:
+            rng = numpy.random.default_rng(self.seed)
+            sample = numpy.sort(rng.choice(len(X), min(self.init_size, len(X)), replace=False))
+            self.init_centroids(self.to_tensor(X[sample]))
+
+        with ThreadPoolExecutor(1) as loader:
+            while self.epoch < epochs:
+                batches = self.epoch_batches(len(X))[self.step:]
+
+                next_batch = loader.submit(lambda ix: self.to_tensor(X[ix]), batches[0]) if batches else None
+                for i in range(len(batches)):
+                    batch = next_batch.result()
+                    if i + 1 < len(batches):
+                        next_batch = loader.submit(lambda ix: self.to_tensor(X[ix]), batches[i+1])
+
+                    self.update(batch)
+                    self.step += 1
+
+                    if checkpoint and self.step % checkpoint_every == 0:
+                        self.save(checkpoint)
+
+                self.epoch += 1
+                self.step = 0
+
+        if checkpoint:
+            self.save(checkpoint)
+
+        return self
+
+    def partial_fit(self, X: numpy.ndarray) -> TorchMiniBatchKMeans:
+        """Update centroids with a single batch. The first batch initializes the centroids."""
+
+        batch = self.to_tensor(X)
+        if self.centroids is None:
+            self.init_centroids(batch)
+
+        self.update(batch)
+
+        return self
+
+    def predict(self, X: numpy.ndarray | SnapshotArray) -> numpy.ndarray:
+        """Label of the nearest centroid of each row, `X` is read in batches."""
+
+        labels = numpy.empty(len(X), dtype=numpy.int64)
+        for start in range(0, len(X), self.batch_size):
+            _, batch_labels = nearest_centroids(self.to_tensor(X[start:start+self.batch_size]), self.centroids)
+            labels[start:start+self.batch_size] = batch_labels.cpu().numpy()
+
+        return labels
+
+    @property
+    def cluster_centers_(self) -> numpy.ndarray:
+        return self.centroids.cpu().numpy()
+
+    def to_tensor(self, X: numpy.ndarray) -> torch.Tensor:
+        X = torch.as_tensor(numpy.asarray(X, dtype=numpy.float32), device=self.device)
+        if self.spherical:
+            X = torch.nn.functional.normalize(X, dim=1)
+
+        return X
+
+    def epoch_batches(self, num_rows: int) -> list[numpy.ndarray]:
+        """
+        Row indices of each batch in the current epoch. Sorted within each batch, to read
+        memory-mapped arrays mostly sequentially.
+        """
+
+        order = numpy.random.default_rng((self.seed, self.epoch)).permutation(num_rows)
+        return [numpy.sort(order[start:start+self.batch_size]) for start in range(0, num_rows, self.batch_size)]
+
+    def init_centroids(self, sample: torch.Tensor):
+        """Initialize centroids with k-means|| on `sample`."""
+
+        if len(sample) < self.n_clusters:
+            raise ValueError(f"Need at least {self.n_clusters} rows to initialize centroids, got {len(sample)}.")
+
+        candidates = sample[torch.randint(len(sample), (1,), generator=self.generator, device=self.device)]
+        distances, _ = nearest_centroids(sample, candidates)
+
+        for _ in range(self.init_rounds):
+            probs = (self.oversampling * self.n_clusters * distances / distances.sum()).clamp_(max=1)
+            new_candidates = sample[torch.rand(len(sample), generator=self.generator, device=self.device) < probs]
+            if len(new_candidates) == 0:
+                break
+
+            candidates = torch.cat([candidates, new_candidates])
+            distances = torch.minimum(distances, nearest_centroids(sample, new_candidates)[0])
+
+        # Too few candidates when the sample has many duplicates, add random rows
+        if len(candidates) < self.n_clusters:
+            extra = torch.randint(len(sample), (self.n_clusters - len(candidates),), generator=self.generator,
+                                  device=self.device)
+            candidates = torch.cat([candidates, sample[extra]])
+
+        _, labels = nearest_centroids(sample, candidates)
+        weights = torch.bincount(labels, minlength=len(candidates)).to(sample.dtype).clamp_(min=1)
+
+        self.centroids = self.weighted_kmeans(candidates, weights)
+        self.counts = torch.zeros(self.n_clusters, dtype=sample.dtype, device=self.device)
+
+    def weighted_kmeans(self, X: torch.Tensor, weights: torch.Tensor, n_iter: int = 10) -> torch.Tensor:
+        """Cluster weighted rows with k-means, seeded with weighted k-means++."""
+
+        centroids = torch.empty((self.n_clusters, X.shape[1]), dtype=X.dtype, device=self.device)
+        centroids[0] = X[torch.multinomial(weights, 1, generator=self.generator)]
+        distances = squared_distances(X, centroids[:1])[:, 0]
+
+        for i in range(1, self.n_clusters):
+            probs = weights * distances
+            if probs.sum() <= 0:
+                probs = weights
+
+            centroids[i] = X[torch.multinomial(probs, 1, generator=self.generator)]
+            distances = torch.minimum(distances, squared_distances(X, centroids[i:i+1])[:, 0])
+
+        for _ in range(n_iter):
+            _, labels = nearest_centroids(X, centroids)
+
+            cluster_weights = torch.bincount(labels, weights, minlength=self.n_clusters)
+            sums = torch.zeros_like(centroids).index_add_(0, labels, X * weights[:, None])
+
+            non_empty = cluster_weights > 0
+            centroids[non_empty] = sums[non_empty] / cluster_weights[non_empty, None]
+            if self.spherical:
+                centroids = torch.nn.functional.normalize(centroids, dim=1)
+
+        return centroids
+
+    def update(self, batch: torch.Tensor):
+        """Move each centroid towards the mean of its assigned rows in `batch`."""
+
+        distances, labels = nearest_centroids(batch, self.centroids)
+
+        batch_counts = torch.bincount(labels, minlength=self.n_clusters).to(batch.dtype)
+        sums = torch.zeros_like(self.centroids).index_add_(0, labels, batch)
+        self.counts += batch_counts
+
+        assigned = batch_counts > 0
+        learning_rate = (batch_counts[assigned] / self.counts[assigned])[:, None]
+        means = sums[assigned] / batch_counts[assigned, None]
+
+        centroids = self.centroids[assigned]
+        centroids += learning_rate * (means - centroids)
+        if self.spherical:
+            centroids = torch.nn.functional.normalize(centroids, dim=1)
+
+        self.centroids[assigned] = centroids
+
+        self.steps_since_reassign += 1
+        if self.reassignment_ratio and self.steps_since_reassign * self.batch_size >= 10 * self.n_clusters:
+            self.reassign(batch, distances)
+            self.steps_since_reassign = 0
+
+    def reassign(self, batch: torch.Tensor, distances: torch.Tensor):
+        """
+        Move centroids with few assigned rows to rows of `batch`, sampled proportional to their
+        squared distance to the nearest centroid.
+        """
+
+        to_reassign = (self.counts < self.reassignment_ratio * self.counts.max()).nonzero()[:, 0]
+        to_reassign = to_reassign[:len(batch) // 2]
+        if len(to_reassign) == 0 or distances.sum() <= 0:
+            return
+
+        rows = torch.multinomial(distances, len(to_reassign), replacement=False, generator=self.generator)
+        self.centroids[to_reassign] = batch[rows]
+
+        # Give reassigned centroids the weight of the least assigned remaining centroid
+        keep = torch.ones(self.n_clusters, dtype=torch.bool, device=self.device)
+        keep[to_reassign] = False
+        self.counts[to_reassign] = self.counts[keep].min() if keep.any() else 0
+
+        logger.debug("Reassigned %d centroids", len(to_reassign))
+
+    def state_dict(self) -> dict:
+        return {
+            'n_clusters': self.n_clusters,
+            'spherical': self.spherical,
+            'seed': self.seed,
+            'centroids': self.centroids.cpu(),
+            'counts': self.counts.cpu(),
+            'epoch': self.epoch,
+            'step': self.step,
+            'steps_since_reassign': self.steps_since_reassign,
+            'generator': self.generator.get_state(),
+        }
+
+    def load_state(self, state: dict):
+        if state['n_clusters'] != self.n_clusters or state['spherical'] != self.spherical:
+            raise ValueError("Checkpoint was trained with different settings.")
+
+        self.seed = state['seed']
+        self.centroids = state['centroids'].to(self.device)
+        self.counts = state['counts'].to(self.device)
+        self.epoch = state['epoch']
+        self.step = state['step']
+        self.steps_since_reassign = state['steps_since_reassign']
+        self.generator.set_state(state['generator'])
+
+    def save(self, path: str | Path):
+        """Save the training state, written to a temporary file first to not corrupt the checkpoint."""
+
+        tmp_path = Path(path).with_suffix(".tmp")
+        torch.save(self.state_dict(), tmp_path)
+        tmp_path.replace(path)
+
+    @classmethod
+    def load(cls, path: str | Path, **kwargs) -> TorchMiniBatchKMeans:
+        state = torch.load(path, weights_only=True)
+        kmeans = cls(state['n_clusters'], spherical=state['spherical'], seed=state['seed'], **kwargs)
+        kmeans.load_state(state)
+
+        return kmeans
 
-    We use MiniBatchKMeans for a memory-efficient approach to compute post clusters. We were
-    unable to run HDBSCAN on embeddings of more than 1M posts.
 
-    TODO: Implement minibatch k-means with PyTorch for GPU acceleration.
+class PostClusters:
+    """
+    Compute cluster centroids of posts with mini-batch k-means.
+
+    We use mini-batch k-means for a memory-efficient approach to compute post clusters. We were
+    unable to run HDBSCAN on embeddings of more than 1M posts, see `TwoLevelTopics` to run it on
+    the centroids instead. By default, uses
+    `TorchMiniBatchKMeans`, with `engine='sklearn'` uses scikit-learn's MiniBatchKMeans instead.
     """
 
-    def __init__(self, dataset: PostsDataset, n_clusters=10_000, batch_size=1024):
+    def __init__(self, dataset: PostsDataset, n_clusters=10_000, batch_size=4096,
+                 engine: str = 'torch', **kwargs):
         self.batch_size = batch_size
-        self.mkb = MiniBatchKMeans(
-            init="k-means++",
-            n_clusters=n_clusters,
-            batch_size=batch_size
-        )
+        self.engine = engine
+
+        if engine == 'torch':
+            self.kmeans = TorchMiniBatchKMeans(n_clusters, batch_size, **kwargs)
+        elif engine == 'sklearn':
+            # Initialization needs more rows than clusters, see `fit`
+            self.kmeans = MiniBatchKMeans(
+                init="k-means++",
+                n_clusters=n_clusters,
+                batch_size=batch_size,
+                init_size=3 * n_clusters,
+                **kwargs
+            )
+        else:
+            raise ValueError(f"Unknown k-means engine {engine!r}")
+
+        self.labels_: numpy.ndarray | None = None
+
+    def fit(self, data: PostsDataset, compute_labels: bool = True, **kwargs):
+        """
+        Fit centroids on the embeddings of `data`. Extra arguments are passed to
+        `TorchMiniBatchKMeans.fit`, e.g., the number of epochs and a checkpoint path.
+        """
+
+        if self.engine == 'torch':
+            self.kmeans.fit(data.post_embeddings, **kwargs)
+        else:
+            data_loader = DataLoader(data, batch_size=self.batch_size, shuffle=True, num_workers=1)
+
+            # The first call to `partial_fit` initializes the centroids, give it at least `init_size` rows
+            init_batches = []
+            for batch in data_loader:
+                if not hasattr(self.kmeans, 'cluster_centers_'):
+                    init_batches.append(batch)
+                    if sum(len(b) for b in init_batches) < self.kmeans.init_size:
+                        continue
+
+                    batch = torch.cat(init_batches)
+
+                self.kmeans.partial_fit(batch.numpy())
 
-    def fit(self, data: PostsDataset):
-        data_loader = DataLoader(data, batch_size=self.batch_size, shuffle=True, num_workers=1)
+        if compute_labels:
+            self.labels_ = self.predict(data.post_embeddings)
 
-        for batch in data_loader:
-            self.mkb.partial_fit(batch)
+    def predict(self, X: numpy.ndarray | SnapshotArray) -> numpy.ndarray:
+        if self.engine == 'torch':
+            return self.kmeans.predict(X)
 
-    def predict(self, X: numpy.ndarray) -> numpy.ndarray:
-        return self.mkb.predict(X)
+        return numpy.concatenate([self.kmeans.predict(numpy.asarray(X[start:start+self.batch_size]))
+                                  for start in range(0, len(X), self.batch_size)])
 
     @property
-    def labels_(self) -> numpy.ndarray:
-        return self.mkb.labels_
+    def cluster_centers_(self) -> numpy.ndarray:
+        return self.kmeans.cluster_centers_
+
+
+def count_cluster_terms(texts: list[str], labels: numpy.ndarray, n_clusters: int, n_features: int,
+                        stop_words: str | list[str] | None) -> tuple[scipy.sparse.csr_matrix, dict[int, str]]:
+    """
+    Tokenize `texts`, and count the terms of each cluster in a sparse cluster-by-term matrix.
+
+    Terms are hashed into `n_features` columns, like scikit-learn's `HashingVectorizer`. Also
+    returns the term of each column seen, to map columns back to terms. Runs in worker processes.
+    """
+
+    analyzer = CountVectorizer(stop_words=stop_words).build_analyzer()
+    tokens = [analyzer(text) for text in texts]
+
+    hasher = FeatureHasher(n_features, input_type='string', alternate_sign=False, dtype=numpy.int32)
+    post_terms = hasher.transform(tokens)
+
+    clusters = scipy.sparse.csr_matrix(
+        (numpy.ones(len(labels), dtype=numpy.int32), (labels, numpy.arange(len(labels)))),
+        shape=(n_clusters, len(labels))
+    )
+
+    terms = {}
+    for term in set(token for post_tokens in tokens for token in post_tokens):
+        terms[abs(murmurhash3_32(term, seed=0)) % n_features] = term
+
+    return (clusters @ post_terms).tocsr(), terms
+
+
+def sum_sparse(matrices: list[scipy.sparse.csr_matrix]) -> scipy.sparse.csr_matrix:
+    """Sum sparse matrices of the same shape at once, instead of pairwise."""
+
+    rows = [numpy.repeat(numpy.arange(m.shape[0]), numpy.diff(m.indptr)) for m in matrices]
+
+    return scipy.sparse.coo_matrix(
+        (numpy.concatenate([m.data for m in matrices]),
+         (numpy.concatenate(rows), numpy.concatenate([m.indices for m in matrices]))),
+        shape=matrices[0].shape
+    ).tocsr()
 
 
 class ClusterTFIDF:
     """
-    Computes per-cluster term frequency and inverse document frequencies.
+    Computes per-cluster term frequency and inverse document frequencies (c-TF-IDF), like BERTopic.
+
+    Post texts are streamed from the database in chunks of `chunk_size` posts, ordered by post
+    id, and tokenized in `num_workers` processes. Terms are hashed into `n_features` columns,
+    such that the vocabulary doesn't have to be known up front. Term counts of each chunk are
+    added to a sparse cluster-by-term matrix, so only a few chunks of texts are held in memory
+    at a time.
+
+    Each column maps back to the first term seen with that hash; with the default number of
+    features, hash collisions are rare enough to not affect the top terms of a cluster.
     """
 
-    def __init__(self, posts: PostsDataset, clusters: PostClusters):
+    def __init__(self, posts: PostsDataset, clusters: PostClusters, n_features: int = 2**20,
+                 stop_words: str | list[str] | None = 'english', reduce_frequent_words: bool = True,
+                 chunk_size: int = 50_000, num_workers: int | None = None):
         self.posts = posts
         self.clusters = clusters
+        self.n_features = n_features
+        self.stop_words = stop_words
+        self.reduce_frequent_words = reduce_frequent_words
+        self.chunk_size = chunk_size
+        self.num_workers = num_workers or os.cpu_count()
+
+        self.term_counts: scipy.sparse.csr_matrix | None = None
+        self.terms: dict[int, str] = {}
+        self.ctfidf: scipy.sparse.csr_matrix | None = None
+
+    async def compute_term_counts(self) -> scipy.sparse.csr_matrix:
+        """Count the terms of each cluster over the texts of all posts."""
+
+        labels = numpy.asarray(self.clusters.labels_)
+
+        # Trailing clusters may have no posts, the rows must still line up with the centroids
+        n_clusters = len(self.clusters.cluster_centers_)
+
+        post_ids = numpy.asarray(self.posts.post_ids)
+        order = numpy.argsort(post_ids)
+        post_ids, labels = post_ids[order], labels[order]
+
+        self.term_counts = scipy.sparse.csr_matrix((n_clusters, self.n_features), dtype=numpy.int32)
+        self.terms = {}
+        pending_counts = []
+
+        def add_counts(future):
+            counts, terms = future.result()
+            pending_counts.append(counts)
+            for column, term in terms.items():
+                self.terms.setdefault(column, term)
+
+            # Merge once pending counts are as large as the total, to add each entry O(log n) times
+            if sum(c.nnz for c in pending_counts) >= max(self.term_counts.nnz, 10**6):
+                self.term_counts = sum_sparse([self.term_counts, *pending_counts])
+                pending_counts.clear()
+
+        loop = asyncio.get_running_loop()
+        with ProcessPoolExecutor(self.num_workers) as executor:
+            tasks = set()
+            async for texts, text_labels in self.stream_texts(post_ids, labels):
+                tasks.add(loop.run_in_executor(executor, count_cluster_terms, texts, text_labels, n_clusters,
+                                               self.n_features, self.stop_words))
+
+                # Bound the number of chunks in memory
+                if len(tasks) >= 2 * self.num_workers:
+                    done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    for future in done:
+                        add_counts(future)
+
+            if tasks:
+                done, _ = await asyncio.wait(tasks)
+                for future in done:
+                    add_counts(future)
+
+        self.term_counts = sum_sparse([self.term_counts, *pending_counts])
+
+        return self.term_counts
+
+    async def stream_texts(self, post_ids: numpy.ndarray, labels: numpy.ndarray):
+        """
+        Yield the texts and cluster labels of the posts in chunks, given post ids in sorted order.
+
+        Each chunk queries a range of post ids, and skips posts in the range not in the dataset.
+        The query is limited to the `created_range` of the dataset, if known, such that only the
+        partitions of these days are scanned.
+        """
+
+        async with async_session() as session:
+            for start in range(0, len(post_ids), self.chunk_size):
+                chunk_ids = post_ids[start:start+self.chunk_size]
+                chunk_labels = labels[start:start+self.chunk_size]
+
+                stmt = (select(Post.id, Post.post_text)
+                        .filter(Post.id >= int(chunk_ids[0]), Post.id <= int(chunk_ids[-1])))
+                if self.posts.created_range:
+                    created_start, created_end = self.posts.created_range
+                    stmt = stmt.filter(Post.created_at >= created_start, Post.created_at < created_end)
+                rows = (await session.execute(stmt)).all()
+
+                ids = numpy.fromiter((row[0] for row in rows), dtype=numpy.int64, count=len(rows))
+                ix = numpy.searchsorted(chunk_ids, ids).clip(max=len(chunk_ids) - 1)
+                found = chunk_ids[ix] == ids
+
+                texts = [row[1] for row, keep in zip(rows, found) if keep]
+                text_labels = chunk_labels[ix[found]]
+
+                # Noise, e.g., from HDBSCAN
+                keep = text_labels >= 0
+                if not keep.all():
+                    texts = [text for text, k in zip(texts, keep) if k]
+                    text_labels = text_labels[keep]
+
+                yield texts, text_labels
+
+    async def compute_ctfidf_matrix(self, groups: numpy.ndarray | None = None) -> scipy.sparse.csr_matrix:
+        """
+        Compute the c-TF-IDF weight of each term in each cluster, counting terms first if needed.
+
+        If `groups` is given, clusters are merged first: `groups[i]` is the group of cluster `i`,
+        or -1 to leave it out. Rows of the result are then groups, e.g., topics of centroids.
+
+        Term frequencies are normalized per cluster, and weighted by log(1 + A / f), with A the
+        average number of terms per cluster, and f the frequency of the term over all clusters.
+        With `reduce_frequent_words`, the square root of the term frequency is used instead.
+        """
+
+        if self.term_counts is None:
+            await self.compute_term_counts()
+
+        counts = self.term_counts.astype(numpy.float64)
+        if groups is not None:
+            in_group = numpy.flatnonzero(groups >= 0)
+            membership = scipy.sparse.csr_matrix(
+                (numpy.ones(len(in_group)), (groups[in_group], in_group)),
+                shape=(groups.max() + 1, len(groups))
+            )
+            counts = membership @ counts
+
+        term_frequencies = numpy.asarray(counts.sum(axis=0)).ravel()
+        avg_terms = counts.sum() / counts.shape[0]
+        idf = numpy.log(1 + avg_terms / numpy.maximum(term_frequencies, 1))
+
+        tf = normalize(counts, norm='l1', axis=1)
+        if self.reduce_frequent_words:
+            tf.data = numpy.sqrt(tf.data)
 
-    async def compute_ctfidf_matrix(self):
-        all_clusters = self.clusters.labels_.unique()
+        self.ctfidf = tf.multiply(idf).tocsr()
 
-        ix = numpy.arange(len(self.posts))
-        for cluster_id in all_clusters:
-            cluster_post_ids = self.posts.post_ids[self.clusters.labels_ == cluster_id]
+        return self.ctfidf
+
+    def top_terms(self, n: int = 10) -> dict[int, list[tuple[str, float]]]:
+        """The `n` terms with the highest c-TF-IDF weight of each cluster, with their weights."""
+
+        top = {}
+        for cluster_id in range(self.ctfidf.shape[0]):
+            row = self.ctfidf.getrow(cluster_id)
+            best = numpy.argsort(row.data)[::-1][:n]
+            top[cluster_id] = [(self.terms.get(int(row.indices[i]), ""), float(row.data[i])) for i in best]
+
+        return top
+
+
+class TwoLevelTopics:
+    """
+    Two-level topic model, which scales to the full corpus.
+
+    First, all posts are assigned to `n_centroids` fine-grained centroids with mini-batch k-means
+    (see `PostClusters`). Then, like BERTopic, the centroids are reduced with UMAP and clustered
+    into topics with HDBSCAN. The topic of each post is the topic of its centroid, so memory use
+    of UMAP and HDBSCAN depends on the number of centroids, not the number of posts.
+
+    HDBSCAN doesn't support weights. Centroids with fewer than `min_centroid_posts` posts are
+    left out of clustering, and assigned to the topic with the most similar centroid afterwards.
+    Topic centroids are the means of their centroids, weighted by their number of posts. With
+    `assign_outliers`, centroids HDBSCAN considers noise are assigned to the most similar topic
+    as well. Otherwise their posts are outliers, with topic -1.
+    """
+
+    def __init__(self, n_centroids: int = 10_000, min_topic_size: int = 10, min_centroid_posts: int = 5,
+                 n_neighbors: int = 15, n_components: int = 5, assign_outliers: bool = False,
+                 batch_size: int = 4096, seed: int = 0, **kwargs):
+        self.clusters: PostClusters | None = None
+        self.n_centroids = n_centroids
+        self.batch_size = batch_size
+        self.kmeans_kwargs = kwargs
+
+        self.umap = UMAP(n_neighbors=n_neighbors, n_components=n_components, min_dist=0.0, metric='cosine',
+                         random_state=seed)
+        self.hdbscan = HDBSCAN(min_cluster_size=min_topic_size, metric='euclidean',
+                               cluster_selection_method='eom')
+        self.min_centroid_posts = min_centroid_posts
+        self.assign_outliers = assign_outliers
+
+        # Number of posts of each centroid, and the topic of each centroid
+        self.centroid_sizes: numpy.ndarray | None = None
+        self.centroid_topics: numpy.ndarray | None = None
+
+        self.topic_centroids: numpy.ndarray | None = None
+        self.topic_sizes: numpy.ndarray | None = None
+
+    def fit(self, dataset: PostsDataset, **kwargs) -> TwoLevelTopics:
+        """
+        Fit centroids on all posts in `dataset`, and cluster the centroids into topics. Extra
+        arguments are passed to `PostClusters.fit`, e.g., the number of epochs and a checkpoint.
+        """
+
+        self.clusters = PostClusters(dataset, self.n_centroids, self.batch_size, **self.kmeans_kwargs)
+        self.clusters.fit(dataset, **kwargs)
+
+        self.centroid_sizes = numpy.bincount(self.clusters.labels_, minlength=self.n_centroids)
+        self.centroid_topics = self.cluster_centroids(self.clusters.cluster_centers_, self.centroid_sizes)
+
+        logger.info("Clustered %d centroids into %d topics", self.n_centroids, self.centroid_topics.max() + 1)
+
+        return self
+
+    def cluster_centroids(self, centroids: numpy.ndarray, sizes: numpy.ndarray) -> numpy.ndarray:
+        """Cluster centroids into topics, and return the topic of each centroid."""
+
+        centroids = normalize(centroids)
+        clustered = sizes >= self.min_centroid_posts
+
+        labels = numpy.full(len(centroids), -1, dtype=numpy.int64)
+        labels[clustered] = self.hdbscan.fit_predict(self.umap.fit_transform(centroids[clustered]))
+
+        num_topics = labels.max() + 1
+        if num_topics == 0:
+            raise ValueError("No topics found, try a smaller `min_topic_size`.")
+
+        self.topic_centroids, self.topic_sizes = self.weighted_topic_centroids(centroids, sizes, labels, num_topics)
+
+        # Assign centroids left out of clustering, and optionally noise, to the most similar topic
+        to_assign = ~clustered | (labels == -1) if self.assign_outliers else ~clustered & (sizes > 0)
+        if to_assign.any():
+            labels[to_assign] = (centroids[to_assign] @ self.topic_centroids.T).argmax(axis=1)
+            self.topic_centroids, self.topic_sizes = self.weighted_topic_centroids(centroids, sizes, labels,
+                                                                                   num_topics)
+
+        return labels
+
+    @staticmethod
+    def weighted_topic_centroids(centroids: numpy.ndarray, sizes: numpy.ndarray, labels: numpy.ndarray,
+                                 num_topics: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """Mean of the centroids of each topic, weighted by their number of posts."""
+
+        in_topic = labels >= 0
+        topic_centroids = numpy.zeros((num_topics, centroids.shape[1]), dtype=numpy.float64)
+        numpy.add.at(topic_centroids, labels[in_topic], centroids[in_topic] * sizes[in_topic, None])
+        topic_sizes = numpy.bincount(labels[in_topic], weights=sizes[in_topic], minlength=num_topics)
+
+        return normalize(topic_centroids).astype(numpy.float32), topic_sizes.astype(numpy.int64)
+
+    @property
+    def topics_(self) -> numpy.ndarray:
+        """Topic of each post, -1 for outliers."""
+        return self.centroid_topics[self.clusters.labels_]
+
+    async def compute_keywords(self, dataset: PostsDataset, n: int = 10, **kwargs) -> list[list[str]]:
+        """
+        The `n` top terms of each topic by c-TF-IDF. Terms are counted per centroid, and summed
+        per topic. Extra arguments are passed to `ClusterTFIDF`.
+        """
+
+        ctfidf = ClusterTFIDF(dataset, self.clusters, **kwargs)
+        await ctfidf.compute_term_counts()
+        await ctfidf.compute_ctfidf_matrix(self.centroid_topics)
+
+        top_terms = ctfidf.top_terms(n)
+        return [[term for term, _ in top_terms[topic_id]] for topic_id in range(len(self.topic_centroids))]
+
+    async def save(self, session: AsyncSession, keywords: list[list[str]] | None = None) -> list[int]:
+        """
+        Replace the topics assigned to new posts by the embed workers with these topics. Returns
+        the ID of each topic in the database.
+        """
+
+        return await replace_topics(session, self.topic_centroids, keywords, self.topic_sizes)
 
 
 def compute_topics(posts: list[str], embeddings: list[numpy.array]):
+    """
+    Fit BERTopic on posts held in memory. For more than about a million posts, use
+    `TwoLevelTopics`, which only clusters k-means centroids.
+    """
+
     # Ensure to reduce frequent words, such as common stop words
     ctfidf_model = ClassTfidfTransformer(reduce_frequent_words=True)
 
@@ -136,15 +832,22 @@ def compute_topics(posts: list[str], embeddings: list[numpy.array]):
 
 
 def get_indexed_posts_for_date_range(start: datetime | None = None, end: datetime | None = None):
+    """
+    Build a query selecting posts created in the given date range.
+
+    Filters on `Post.created_at`, the partition key, so only the partitions of the requested
+    days are scanned.
+    """
+
     if not start and not end:
         raise ValueError("Need at least one of `start` or `end`!")
 
     stmt = select(Post)
 
     if start:
-        stmt = stmt.filter(Post.indexed_at > start)
+        stmt = stmt.filter(Post.created_at > start)
 
     if end:
-        stmt = stmt.filter(Post.indexed_at < end)
+        stmt = stmt.filter(Post.created_at < end)
 
     return stmt